@@ -0,0 +1,169 @@
+"""
+Load-test comparison: gunicorn sync (2 workers × 4 threads) vs SERVE_MODE=async
+(1 gevent worker) on the I/O-bound routes.
+
+A local stub stands in for the Strava API and answers after --latency-ms, so the
+numbers show how many requests each mode can keep waiting on upstream at once.
+Each mode is started with the repo's gunicorn.conf.py, then --clients concurrent
+clients hit the routes with a signed session cookie.
+
+    python bench_load.py --requests 400 --clients 50 --latency-ms 300 [--output bench_output.txt]
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROUTES = ["/activities", "/me"]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_stub(latency_s):
+    activity = {"id": 1, "name": "Stub ride", "sport_type": "Ride", "distance": 42000.0,
+                "moving_time": 5400, "total_elevation_gain": 420.0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(latency_s)
+            if self.path.startswith("/athlete/activities"):
+                body = json.dumps([activity] * 10).encode()
+            else:
+                body = json.dumps({"id": 1, "firstname": "Stub", "lastname": "Athlete"}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", free_port()), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def session_cookie(env):
+    """Signed Flask session cookie for a fake connected athlete."""
+    os.environ.update(env)
+    sys.path.insert(0, HERE)
+    import main
+    serializer = main.app.session_interface.get_signing_serializer(main.app)
+    return serializer.dumps({"access_token": "bench", "athlete": {"id": 1}})
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/privacy", timeout=2).read()
+            return True
+        except Exception:
+            time.sleep(0.2)
+    return False
+
+
+def hammer(port, cookie, n_requests, clients):
+    def one(i):
+        req = urllib.request.Request(f"http://127.0.0.1:{port}{ROUTES[i % len(ROUTES)]}",
+                                     headers={"Cookie": f"session={cookie}"})
+        t0 = time.perf_counter()
+        try:
+            with urllib.request.urlopen(req, timeout=120) as r:
+                r.read()
+                ok = r.status == 200
+        except Exception:
+            ok = False
+        return ok, time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(one, range(n_requests)))
+    wall = time.perf_counter() - t0
+    lat = sorted(d for _ok, d in results)
+    return {
+        "ok": sum(1 for ok, _d in results if ok),
+        "rps": n_requests / wall,
+        "p50_ms": statistics.median(lat) * 1000,
+        "p95_ms": lat[int(len(lat) * 0.95) - 1] * 1000,
+        "wall_s": wall,
+    }
+
+
+def run_mode(mode, env, cookie, args):
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "main:app", "--config", "gunicorn.conf.py",
+         "--bind", f"127.0.0.1:{port}", "--log-level", "warning"],
+        cwd=HERE, env={**os.environ, **env, "SERVE_MODE": mode},
+    )
+    try:
+        if not wait_ready(port):
+            return None
+        hammer(port, cookie, min(20, args.requests), args.clients)  # warm-up
+        return hammer(port, cookie, args.requests, args.clients)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--requests", type=int, default=400)
+    ap.add_argument("--clients", type=int, default=50)
+    ap.add_argument("--latency-ms", type=float, default=300.0)
+    ap.add_argument("--modes", default="sync,async")
+    ap.add_argument("--output", help="also write the report to this file")
+    args = ap.parse_args()
+
+    stub = start_stub(args.latency_ms / 1000.0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        env = {
+            "STRAVA_CLIENT_ID": "bench",
+            "STRAVA_CLIENT_SECRET": "bench",
+            "STRAVA_REDIRECT_URI": "http://localhost/callback",
+            "APP_SECRET_KEY": "bench-secret",
+            "STRAVA_API_BASE": f"http://127.0.0.1:{stub.server_address[1]}",
+            "DB_PATH": os.path.join(tmpdir, "bench.db"),
+            "DATA_DIR": os.path.join(tmpdir, "data"),
+            "HTTP_CACHE_MAX_BYTES": "0",  # measure upstream waits, not cache hits
+        }
+        cookie = session_cookie(env)
+        lines = [f"{args.requests} requests, {args.clients} clients, upstream latency {args.latency_ms:.0f} ms, "
+                 f"routes {', '.join(ROUTES)}",
+                 f"{'mode':<8}{'ok':>6}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'wall s':>8}"]
+        for mode in args.modes.split(","):
+            res = run_mode(mode, env, cookie, args)
+            if res is None:
+                lines.append(f"{mode:<8}  failed to start (async needs requirements-async.txt)")
+                continue
+            lines.append(f"{mode:<8}{res['ok']:>6}{res['rps']:>9.1f}{res['p50_ms']:>9.0f}"
+                         f"{res['p95_ms']:>9.0f}{res['wall_s']:>8.1f}")
+    stub.shutdown()
+    report = "\n".join(lines)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
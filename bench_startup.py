@@ -0,0 +1,109 @@
+"""
+Cold-start benchmark for main.py.
+
+Imports main in fresh interpreters with `-X importtime` (dummy Strava env,
+throwaway DB_PATH / DATA_DIR), reports the slowest modules and the total
+import time, plus the one-time init_schema() cost. Exits 1 when the median
+import time is over --target-ms, so it can gate a deploy.
+
+    python bench_startup.py --target-ms 500 --top 15 [--output bench_output.txt]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PROBE = (
+    "import time; t0 = time.perf_counter(); import main; t1 = time.perf_counter(); "
+    "main.init_schema(); t2 = time.perf_counter(); "
+    "print(f'BENCH {(t1 - t0) * 1000:.1f} {(t2 - t1) * 1000:.1f}')"
+)
+
+
+def run_once(tmpdir, run):
+    env = dict(os.environ)
+    env.setdefault("STRAVA_CLIENT_ID", "bench")
+    env.setdefault("STRAVA_CLIENT_SECRET", "bench")
+    env.setdefault("STRAVA_REDIRECT_URI", "http://localhost/callback")
+    env["DB_PATH"] = os.path.join(tmpdir, f"bench{run}.db")
+    env["DATA_DIR"] = os.path.join(tmpdir, "data")
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE],
+        cwd=HERE, env=env, capture_output=True, text=True, check=True,
+    )
+    import_ms = schema_ms = None
+    for line in proc.stdout.splitlines():
+        if line.startswith("BENCH "):
+            import_ms, schema_ms = (float(x) for x in line.split()[1:3])
+    # "import time:   self [us] | cumulative | imported package", children listed
+    # before their parent and indented two spaces per level.
+    entries = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cum_us, name = line[len("import time:"):].split("|")
+        name = name[1:].rstrip()
+        depth = (len(name) - len(name.lstrip(" "))) // 2
+        entries.append((depth, name.strip(), int(self_us), int(cum_us)))
+    modules, direct = {}, {}
+    start = 0
+    for i, (depth, name, s, c) in enumerate(entries):
+        modules[name] = (s, c)
+        if depth == 0:
+            if name == "main":
+                direct = {n: cc for d, n, _s, cc in entries[start:i] if d == 1}
+            start = i + 1
+    return import_ms, schema_ms, modules, direct
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--top", type=int, default=15)
+    ap.add_argument("--target-ms", type=float, default=500.0)
+    ap.add_argument("--output", help="also write the report to this file")
+    args = ap.parse_args()
+
+    imports, schemas = [], []
+    self_us, cum_us = defaultdict(list), defaultdict(list)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for run in range(args.runs):
+            import_ms, schema_ms, modules, direct = run_once(tmpdir, run)
+            imports.append(import_ms)
+            schemas.append(schema_ms)
+            for name, (s, _c) in modules.items():
+                self_us[name].append(s)
+            for name, c in direct.items():
+                cum_us[name].append(c)
+
+    median_import = statistics.median(imports)
+    lines = [
+        f"import main: median {median_import:.1f} ms over {args.runs} runs "
+        f"(min {min(imports):.1f}, max {max(imports):.1f}) — target {args.target_ms:.0f} ms",
+        f"init_schema (fresh DB): median {statistics.median(schemas):.1f} ms",
+        "",
+        f"Top {args.top} imports made by main.py, cumulative (median, ms):",
+    ]
+    for name, values in sorted(cum_us.items(), key=lambda kv: -statistics.median(kv[1]))[:args.top]:
+        lines.append(f"  {statistics.median(values) / 1000:8.1f}  {name}")
+    lines += ["", f"Top {args.top} modules by self time (median, ms):"]
+    for name, values in sorted(self_us.items(), key=lambda kv: -statistics.median(kv[1]))[:args.top]:
+        lines.append(f"  {statistics.median(values) / 1000:8.1f}  {name}")
+    report = "\n".join(lines)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    if median_import > args.target_ms:
+        print(f"\nFAIL: cold import {median_import:.1f} ms > target {args.target_ms:.0f} ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
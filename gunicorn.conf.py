@@ -0,0 +1,49 @@
+# Gunicorn settings, picked up automatically from the working directory
+# (flags given on the command line still take precedence).
+#
+# SERVE_MODE=sync  (default): 2 workers × 4 threads, as before.
+# SERVE_MODE=async: gevent worker(s); Strava/Drive HTTP waits are cooperative, so
+#                   one worker serves WORKER_CONNECTIONS requests concurrently.
+#                   Needs `pip install -r requirements-async.txt`. Compare with bench_load.py.
+import os
+
+SERVE_MODE = os.environ.get("SERVE_MODE", "sync")
+
+if SERVE_MODE == "async":
+    # Patch before main.py (requests/ssl/socket) is preloaded below.
+    from gevent import monkey
+    monkey.patch_all()
+
+    worker_class = "gevent"
+    workers = int(os.environ.get("WEB_WORKERS", 1))
+    worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 200))
+else:
+    worker_class = "gthread"
+    workers = int(os.environ.get("WEB_WORKERS", 2))
+    threads = int(os.environ.get("WEB_THREADS", 4))
+
+timeout = 120
+
+# Import main.py once in the master; workers fork with the app already loaded,
+# so a worker (re)boot doesn't pay for imports again.
+preload_app = True
+
+
+def on_starting(server):
+    # One-time schema setup before any worker starts; workers then find
+    # PRAGMA user_version current and skip it.
+    import main
+    main.init_schema()
+
+
+def post_worker_init(worker):
+    # Every worker runs the scheduler loop; the SQLite lease makes exactly one of
+    # them execute jobs (see "Background scheduler" in main.py).
+    import main
+    main.start_scheduler()
+
+
+def worker_exit(server, worker):
+    # Hand the lease over right away instead of waiting for it to expire.
+    import main
+    main.stop_scheduler()
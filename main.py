@@ -1,20 +1,21 @@
-import os, time, datetime, math, requests
-import json, base64
+import os, sys, io, time, datetime, math, requests
+import json, base64, hashlib, tempfile, gzip, shutil, threading, struct, zlib, importlib, functools, re
 from collections import defaultdict
-from flask import Flask, request, redirect, session, url_for, jsonify
+from flask import Flask, request, redirect, session, url_for, jsonify, send_file, g
+from markupsafe import escape
 # --- Added for Strava webhook patch ---
 import sqlite3
 import csv
-import time
-from urllib.parse import urlencode
-# --- Google Drive integration imports ---
-try:
-    from google.oauth2 import service_account
-    from googleapiclient.discovery import build
-    from googleapiclient.http import MediaFileUpload
-except Exception as _drive_import_err:
-    # Libs might not be installed yet on Render. We'll handle at runtime.
-    pass
+import itertools
+import calendar
+import heapq
+import random
+import socket
+from array import array
+from urllib.parse import urlencode, urlsplit
+# --- Google Drive / FIT libraries are imported lazily (lazy_import) ---
+# googleapiclient, google.oauth2, google_auth_oauthlib and fitparse cost most of the
+# cold start; only the Drive/FIT code paths need them.
 
 # ----------------- App & Config -----------------
 app = Flask(__name__)
@@ -26,7 +27,7 @@ REDIRECT_URI = os.environ["STRAVA_REDIRECT_URI"]
 
 STRAVA_AUTH_URL = "https://www.strava.com/oauth/authorize"
 STRAVA_TOKEN_URL = "https://www.strava.com/oauth/token"
-STRAVA_API_BASE = "https://www.strava.com/api/v3"
+STRAVA_API_BASE = os.environ.get("STRAVA_API_BASE", "https://www.strava.com/api/v3").rstrip("/")
 
 GOOGLE_OAUTH_CLIENT_ID = os.environ.get("GOOGLE_OAUTH_CLIENT_ID")
 GOOGLE_OAUTH_CLIENT_SECRET = os.environ.get("GOOGLE_OAUTH_CLIENT_SECRET")
@@ -45,6 +46,160 @@ def _mask(s, keep=4):
     except Exception:
         return "?"
 
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+def admin_required(fn):
+    """Guard for admin endpoints that change server state: ?token= or X-Admin-Token must match ADMIN_TOKEN."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        sent = request.headers.get("X-Admin-Token") or request.args.get("token")
+        if not ADMIN_TOKEN or sent != ADMIN_TOKEN:
+            return jsonify({"ok": False, "error": "admin token required"}), 403
+        return fn(*args, **kwargs)
+    return wrapper
+
+# ===== Admission control & request coalescing =====
+# Expensive dashboard routes (full Strava crawls) go through @admission(route, key):
+#   - coalescing: concurrent requests with the same key (athlete) share one in-flight
+#     computation; followers get the leader's result (str/dict bodies only)
+#   - per-route limits: at most `limit` computations run per worker, at most `queue`
+#     more wait (up to ADMISSION_WAIT_S) for a slot
+#   - ADMISSION_SLOTS caps all guarded requests together (running, queued or coalesced)
+#     below the worker's thread count, so a thread is always left for /webhook and the
+#     light pages; anything beyond gets an immediate 503 with a Retry-After estimated
+#     from the route's recent durations. A follower gives its slot back while it waits
+#     for the leader (at most ADMISSION_FOLLOW_S, then 503) and only re-takes one if
+#     it has to compute on its own.
+ADMISSION_SLOTS = int(os.environ.get(
+    "ADMISSION_SLOTS",
+    50 if os.environ.get("SERVE_MODE") == "async" else max(1, int(os.environ.get("WEB_THREADS", 4)) - 1),
+))
+ADMISSION_WAIT_S = float(os.environ.get("ADMISSION_WAIT_S", 10))
+ADMISSION_FOLLOW_S = float(os.environ.get("ADMISSION_FOLLOW_S", 30))
+ADMISSION_LIMITS = {  # route -> (concurrent computations, queued requests) per worker
+    "stats": (1, 1),
+    "activities": (2, 2),
+    "me": (2, 2),
+}
+_admission_lock = threading.Lock()
+_admission_busy = 0
+_admission_routes = {}
+_in_flight = {}
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class CoalescedRequestError(RuntimeError):
+    """Raised in each follower when the leader it was waiting on failed (leader's error is the cause)."""
+
+def _retry_after(st):
+    limit = ADMISSION_LIMITS.get(st["name"], (1, 1))[0]
+    return min(60, max(1, math.ceil(st["ewma_s"] * (st["waiting"] + 1) / limit)))
+
+def _busy(st):
+    with _admission_lock:
+        st["rejected"] += 1
+    body = {"ok": False, "error": "server busy, retry later", "route": st["name"]}
+    return jsonify(body), 503, {"Retry-After": str(_retry_after(st))}
+
+def _run_admitted(st, fn, args, kwargs):
+    """Wait (bounded) for one of the route's slots, run fn, record its duration."""
+    limit, queue = ADMISSION_LIMITS.get(st["name"], (1, 1))
+    with _admission_lock:
+        if st["waiting"] >= queue + limit:
+            return None
+        st["waiting"] += 1
+    try:
+        if not st["sem"].acquire(timeout=ADMISSION_WAIT_S):
+            return None
+    finally:
+        with _admission_lock:
+            st["waiting"] -= 1
+    t0 = time.perf_counter()
+    try:
+        return (fn(*args, **kwargs),)
+    finally:
+        st["sem"].release()
+        with _admission_lock:
+            st["admitted"] += 1
+            st["ewma_s"] = 0.8 * st["ewma_s"] + 0.2 * (time.perf_counter() - t0)
+
+def admission(route, key=None):
+    limit = ADMISSION_LIMITS.get(route, (1, 1))[0]
+    st = _admission_routes.setdefault(route, {
+        "name": route, "sem": threading.BoundedSemaphore(limit), "waiting": 0, "ewma_s": 1.0,
+        "admitted": 0, "coalesced": 0, "rejected": 0,
+    })
+
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            global _admission_busy
+            k = key() if key else None
+            with _admission_lock:
+                full = _admission_busy >= ADMISSION_SLOTS
+                if not full:
+                    flight = _in_flight.get((route, k)) if k is not None else None
+                    leader = flight is None
+                    if leader:
+                        _admission_busy += 1
+                        if k is not None:
+                            flight = _in_flight[(route, k)] = _Flight()
+                    else:
+                        st["coalesced"] += 1  # waiting costs no slot
+            if full:
+                return _busy(st)
+            holding = leader
+            try:
+                if not leader:
+                    if not flight.done.wait(ADMISSION_FOLLOW_S):
+                        return _busy(st)
+                    if flight.error is not None:
+                        raise CoalescedRequestError(f"coalesced {route} request failed") from flight.error
+                    if isinstance(flight.result, (str, bytes, dict)):
+                        return flight.result
+                    with _admission_lock:  # busy / not shareable: on its own, with a slot
+                        holding = _admission_busy < ADMISSION_SLOTS
+                        if holding:
+                            _admission_busy += 1
+                    if not holding:
+                        return _busy(st)
+                    out = _run_admitted(st, fn, args, kwargs)
+                    return out[0] if out else _busy(st)
+                try:
+                    out = _run_admitted(st, fn, args, kwargs)
+                except Exception as e:
+                    if flight:
+                        flight.error = e
+                    raise
+                if flight and out:
+                    flight.result = out[0]
+                return out[0] if out else _busy(st)
+            finally:
+                with _admission_lock:
+                    if holding:
+                        _admission_busy -= 1
+                    if leader and k is not None:
+                        _in_flight.pop((route, k), None)
+                if leader and flight:
+                    flight.done.set()
+        return wrapper
+    return deco
+
+def _athlete_key():
+    return (session.get("athlete") or {}).get("id") or session.get("access_token")
+
+@app.route("/admin/admission")
+@admin_required
+def admin_admission():
+    with _admission_lock:
+        routes = {name: {k: v for k, v in st.items() if k not in ("sem", "name")} for name, st in _admission_routes.items()}
+        return {"ok": True, "pid": os.getpid(), "slots": ADMISSION_SLOTS, "busy": _admission_busy,
+                "in_flight": len(_in_flight), "limits": ADMISSION_LIMITS, "routes": routes}
+
 @app.route("/oauth_status")
 def oauth_status():
     """Quick visibility into config used by Google/Strava debug."""
@@ -54,10 +209,7 @@ def oauth_status():
     except NameError:
         base = None
     derived_redirect = f"{base}/oauth2callback" if base else None
-    try:
-        flow_ok = Flow is not None
-    except NameError:
-        flow_ok = False
+    flow_ok = lazy_import("google_auth_oauthlib.flow", "Flow") is not None
 
     return {
         # Google bits
@@ -110,6 +262,45 @@ def admin_ping_webhook():
 #   print("[WEBHOOK DEBUG] args:", dict(request.args), "token_matches:", request.args.get("hub.verify_token")==STRAVA_VERIFY_TOKEN)
 # ===== END DEBUG PATCH =====
 # ----------------- Helpers -----------------
+# One pooled, keep-alive HTTP client for Strava calls, shared by all threads (sync
+# mode) or greenlets (SERVE_MODE=async, gunicorn gevent worker: I/O is cooperative).
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 32))
+http_session = requests.Session()
+_http_adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+http_session.mount("https://", _http_adapter)
+http_session.mount("http://", _http_adapter)
+
+@functools.lru_cache(maxsize=None)
+def lazy_import(module, attr=None):
+    """Import an optional heavy dependency on first use; None if it isn't installed."""
+    try:
+        mod = importlib.import_module(module)
+        return getattr(mod, attr) if attr else mod
+    except Exception as e:
+        # Libs might not be installed yet on Render. We'll handle at runtime.
+        print(f"optional import {module} unavailable:", e)
+        return None
+
+def process_pool(max_workers):
+    """
+    Process pool for CPU-bound jobs. Children are spawned, not forked: forking a
+    threaded (or gevent-patched) worker can copy held locks into the child.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+def cores_per_web_worker():
+    """
+    This gunicorn worker's share of the host's cores. Every web worker builds its
+    own long-lived pools (and each child re-imports main.py), so pools sized off
+    os.cpu_count() alone would oversubscribe the host WEB_WORKERS times over.
+    Same WEB_WORKERS defaults as gunicorn.conf.py.
+    """
+    default = 1 if os.environ.get("SERVE_MODE") == "async" else 2
+    web_workers = max(1, int(os.environ.get("WEB_WORKERS", default)))
+    return max(1, (os.cpu_count() or 1) // web_workers)
+
 def unix(dt):  # datetime -> epoch seconds
     return int(time.mktime(dt.timetuple()))
 
@@ -136,9 +327,9 @@ def get_activities_between(token,
                            start_dt,
                            end_dt,
                            per_page=200,
-                           max_pages=12):
+                           max_pages=12,
+                           athlete_id=None):
     """Fetch all activities between two dates (UTC) with pagination."""
-    headers = {"Authorization": f"Bearer {token}"}
     after = unix(start_dt)
     before = unix(end_dt)
     all_acts = []
@@ -147,7 +338,7 @@ def get_activities_between(token,
         url = (
             f"{STRAVA_API_BASE}/athlete/activities?"
             f"after={after}&before={before}&per_page={per_page}&page={page}")
-        r = requests.get(url, headers=headers, timeout=25)
+        r = strava_get(url, token, athlete_id, timeout=25)
         if r.status_code != 200:
             break
         batch = r.json()
@@ -221,6 +412,7 @@ def html_foot():
     return """
       <div style="margin-top:30px;text-align:center;font-size:12px;color:#94a3b8">
         Powered by <a class="a" href="https://www.strava.com" target="_blank">Strava</a> •
+        <a class="a" href="/export">⬇️ Export my data</a> •
         <a class="a" href="/privacy">Privacy Policy</a>
       </div>
     </div></body></html>
@@ -261,6 +453,11 @@ def home():
   <a class="a" href="/me">Profile</a>
   <a class="a" href="/activities">Recent activities</a>
   <a class="a" href="/stats-2025">📊 2025 Stats</a>
+  <a class="a" href="/club">🏆 Club</a>
+  <a class="a" href="/search">🔎 Search</a>
+  <a class="a" href="/records">🏅 Records</a>
+  <a class="a" href="/climbs">⛰️ Climbs</a>
+  <a class="a" href="/progress">📈 Year over year</a>
   <a class="a" href="/privacy">Privacy Policy</a>  <!-- ✅ ici -->
   <a class="a" href="/logout">Log out</a>
 </div>
@@ -278,7 +475,7 @@ def privacy():
       <p class="subtitle">This personal app uses the Strava and Google Drive APIs to automate training analysis and file storage.</p>
 
       <ul class="small">
-        <li>📥 <b>Data retrieved (Strava):</b> athlete profile, activity list, performance metrics (distance, time, elevation gain, power/HR/cadence when available), and detailed per-second <i>streams</i> via webhook. Laps are only read if you manually upload a <code>.fit</code> file.</li>
+        <li>📥 <b>Data retrieved (Strava):</b> athlete profile, activity list, performance metrics (distance, time, elevation gain, power/HR/cadence when available), and detailed per-second <i>streams</i> (including GPS track) via webhook. Laps are only read if you manually upload a <code>.fit</code> file.</li>
 
         <li>💾 <b>Server-side storage:</b>
           <ul>
@@ -286,6 +483,18 @@ def privacy():
               <ul>
                 <li><code>users</code>: Strava tokens (access/refresh + expiry) per athlete.</li>
                 <li><code>meta</code>: Google OAuth credentials (refresh token) for Drive uploads.</li>
+                <li><code>activities</code> / <code>activity_metrics</code>: activity summaries and metrics derived from streams on ingest (NP, TSS, TRIMP, zones…).</li>
+                <li><code>training_load</code>: daily training load and fitness/fatigue/form (CTL/ATL/TSB) per athlete.</li>
+                <li><code>routes</code> (+ spatial index): simplified GPS track of each activity, used to find repeated routes.</li>
+                <li><code>heat_tracks</code>: lightly simplified GPS tracks used to draw your personal heatmap (tiles cached under <code>{DATA_DIR}/heatmap</code>).</li>
+                <li><code>weekly_totals</code>: weekly distance / elevation / time per athlete and sport, shown on the club leaderboard to other connected athletes.</li>
+                <li><code>{HTTP_CACHE_PATH}</code>: short-lived cache of Strava API responses (profile, activity lists), size-capped and evicted oldest-first.</li>
+                <li><code>activities_fts</code>: full-text index of your activity names, descriptions and sport types, used only by the search page.</li>
+                <li><code>best_efforts</code> / <code>personal_records</code>: your fastest times over standard distances, per activity and as records.</li>
+                <li><code>climbs</code>: climbs detected in your activities (length, gain, gradient, time, start/end position).</li>
+                <li><code>progress_curves</code>: your cumulative distance, elevation and time per day of each year.</li>
+                <li><code>stored_files</code>: local path, storage tier and Drive file id of each stored CSV / .fit.</li>
+                <li><code>fit_files</code>: content hash, file name and parsed summary of uploaded <code>.fit</code> files (duplicates are stored once).</li>
               </ul>
             </li>
             <li>Local files stored under <code>{DATA_DIR}</code> (CSV / .fit) and/or uploaded to your personal Google Drive.</li>
@@ -296,7 +505,7 @@ def privacy():
 
         <li>📤 <b>Data sharing:</b> no data is ever sold or shared with third parties. Files may be uploaded to your own Google Drive only if you explicitly authorize access (scope <code>drive.file</code>, limited to files created by this app).</li>
 
-        <li>⏳ <b>Retention:</b> tokens remain stored while automation is active. You can revoke access anytime from your Strava or Google account (“Third-party access”). Local files remain under <code>{DATA_DIR}</code> until manually deleted; Drive files remain in your selected folder.</li>
+        <li>⏳ <b>Retention:</b> tokens remain stored while automation is active. You can revoke access anytime from your Strava or Google account (“Third-party access”). Local files under <code>{DATA_DIR}</code> are gzip-compressed after {RETENTION_HOT_DAYS} days; if pruning is enabled, local copies older than {RETENTION_PRUNE_DAYS or "∞"} days are removed once an identical copy is confirmed on Drive. Drive files remain in your selected folder.</li>
 
         <li>❌ <b>Data deletion:</b> you can request deletion of all stored data (tokens and local files) by emailing <a class="a" href="mailto:ldmc.meyer@gmail.com">ldmc.meyer@gmail.com</a>. You can also log out to clear your browser session immediately.</li>
 
@@ -345,7 +554,7 @@ def callback():
         "code": code,
         "grant_type": "authorization_code"
     }
-    r = requests.post(STRAVA_TOKEN_URL, data=data, timeout=20)
+    r = http_session.post(STRAVA_TOKEN_URL, data=data, timeout=20)
     if r.status_code != 200:
         return f"Error while exchanging token: {r.text}", 400
     tok = r.json()
@@ -366,11 +575,12 @@ def logout():
 
 
 @app.route("/me")
+@admission("me", key=_athlete_key)
 def me():
     if "access_token" not in session:
         return redirect(url_for("home"))
-    headers = {"Authorization": f"Bearer {session['access_token']}"}
-    r = requests.get(f"{STRAVA_API_BASE}/athlete", headers=headers, timeout=20)
+    r = strava_get(f"{STRAVA_API_BASE}/athlete", session["access_token"],
+                   (session.get("athlete") or {}).get("id"), timeout=20)
     if r.status_code != 200:
         return f"Error calling /athlete: {r.text}", 400
     a = r.json()
@@ -385,13 +595,12 @@ def me():
 
 
 @app.route("/activities")
+@admission("activities", key=_athlete_key)
 def activities():
     if "access_token" not in session:
         return redirect(url_for("home"))
-    headers = {"Authorization": f"Bearer {session['access_token']}"}
-    r = requests.get(f"{STRAVA_API_BASE}/athlete/activities?per_page=10",
-                     headers=headers,
-                     timeout=25)
+    r = strava_get(f"{STRAVA_API_BASE}/athlete/activities?per_page=10", session["access_token"],
+                   (session.get("athlete") or {}).get("id"), timeout=25)
     if r.status_code != 200:
         return f"Error calling /athlete/activities: {r.text}", 400
     acts = r.json()
@@ -420,6 +629,7 @@ def activities():
 
 
 @app.route("/stats-2025/data")
+@admission("stats", key=_athlete_key)
 def stats_2025_data():
     if "access_token" not in session:
         return redirect(url_for("home"))
@@ -429,7 +639,12 @@ def stats_2025_data():
     start = datetime.datetime(2025, 1, 1)
     end = datetime.datetime(2026, 1, 1)
 
-    acts = get_activities_between(token, start, end)
+    athlete_id = (session.get("athlete") or {}).get("id")
+    acts = get_activities_between(token, start, end, athlete_id=athlete_id)
+    try:
+        sync_activity_summaries(athlete_id, acts)
+    except sqlite3.Error as e:
+        print("⚠️ activity sync error:", e)
 
     # Aggregates
     total_dist = sum((a.get("distance") or 0) for a in acts)
@@ -524,6 +739,15 @@ def stats_2025_data():
         act = fastest_avg["act"]
         fast_html = f"<a class='a' target='_blank' href='{strava_activity_link(act.get('id'))}'>{act.get('name','(untitled)')}</a> — {v_kmh} km/h (≥5 km)"
 
+    # Training load (fitness/fatigue/form) from the persisted daily series
+    load_html = "<div class='l'>No load data yet.</div>"
+    athlete_id = (session.get("athlete") or {}).get("id")
+    if athlete_id:
+        try:
+            load_html = training_load_card(athlete_id)
+        except Exception as _e:
+            print("training load card warning:", _e)
+
     # Render
     # Render (return ONLY the inner content for injection)
     body_html = f"""
@@ -546,6 +770,11 @@ def stats_2025_data():
         <div class="card"><div class="k" style="font-size:18px">Best average speed</div><div class="l">{fast_html}</div></div>
       </div>
 
+      <div class="card" style="margin-top:12px">
+        <div class="k" style="font-size:18px;margin-bottom:8px">Training load (CTL / ATL / TSB)</div>
+        {load_html}
+      </div>
+
       <div class="grid">
         <div class="card">
           <div class="k" style="font-size:18px;margin-bottom:6px">Top distance (5)</div>
@@ -593,41 +822,46 @@ def stats_2025_shell():
 <div id="content" style="margin-top: 52px;">Preparing…</div>
 
 <script>
-  fetch('/stats-2025/data', { credentials: 'same-origin' })
-    .then(response => {
-      if (!response.ok) throw new Error(response.status);
-      return response.text();
-    })
-    .then(html => {
-      document.getElementById('content').innerHTML = html;
-      document.getElementById('loading-message').style.display = 'none';
-    })
-    .catch(error => {
-      document.getElementById('content').innerHTML = 'Error loading stats.';
-      console.error(error);
-    });
+  function loadStats(attempt) {
+    fetch('/stats-2025/data', { credentials: 'same-origin' })
+      .then(response => {
+        if (response.status === 503 && attempt < 5) {
+          // server busy: retry when it says so
+          const wait = parseInt(response.headers.get('Retry-After') || '3', 10);
+          document.getElementById('content').innerHTML = 'Server busy, retrying in ' + wait + ' s…';
+          setTimeout(() => loadStats(attempt + 1), wait * 1000);
+          return null;
+        }
+        if (!response.ok) throw new Error(response.status);
+        return response.text();
+      })
+      .then(html => {
+        if (html === null) return;
+        document.getElementById('content').innerHTML = html;
+        document.getElementById('loading-message').style.display = 'none';
+      })
+      .catch(error => {
+        document.getElementById('content').innerHTML = 'Error loading stats.';
+        console.error(error);
+      });
+  }
+  loadStats(0);
 </script>
 """ + html_foot()
 
 # OAuth user flow (Drive)
-try:
-    from google_auth_oauthlib.flow import Flow
-    from google.oauth2.credentials import Credentials as UserCredentials
-    from googleapiclient.discovery import build
-    from googleapiclient.http import MediaFileUpload
-except Exception as _e:
-    Flow = UserCredentials = build = MediaFileUpload = None
-
 GOOGLE_OAUTH_SCOPES = ["https://www.googleapis.com/auth/drive.file"]
 OAUTH_REDIRECT_URI = f"{BASE_URL}/oauth2callback"
 
 def get_drive_service_user():
     """Build a Drive client using the stored user refresh token (if present)."""
-    if not (UserCredentials and build):
-        return None
     token_json = meta_get("google_user_token_json")
     if not token_json:
         return None
+    UserCredentials = lazy_import("google.oauth2.credentials", "Credentials")
+    build = lazy_import("googleapiclient.discovery", "build")
+    if not (UserCredentials and build):
+        return None
     try:
         data = json.loads(token_json)
         creds = UserCredentials.from_authorized_user_info(data, GOOGLE_OAUTH_SCOPES)
@@ -643,6 +877,7 @@ def get_drive_service_user():
 @app.route("/google_auth")
 def google_auth():
     # Sanity check des envs + import
+    Flow = lazy_import("google_auth_oauthlib.flow", "Flow")
     if not (GOOGLE_OAUTH_CLIENT_ID and GOOGLE_OAUTH_CLIENT_SECRET and Flow):
         return "OAuth not configured", 400
 
@@ -673,6 +908,7 @@ def google_auth():
 
 @app.route("/oauth2callback")
 def oauth2callback():
+    Flow = lazy_import("google_auth_oauthlib.flow", "Flow")
     if not Flow:
         return "OAuth not configured", 400
     state = meta_get("google_oauth_state")
@@ -700,14 +936,6 @@ def oauth2callback():
     return "Google Drive connected ✅ You can close this tab."
 
 
-
-
-# ----------------- Run (optional for local dev) -----------------
-if __name__ == "__main__":
-    # For local runs (e.g., Replit). On Render, gunicorn (Procfile) is used instead.
-    app.run(host="0.0.0.0", port=5000)
-    # deployment
-
 # --- Added env for webhook patch ---
 STRAVA_VERIFY_TOKEN = os.environ.get("STRAVA_VERIFY_TOKEN", "dev-verify-token")
 DB_PATH = os.environ.get("DB_PATH", "strava.db")
@@ -716,12 +944,66 @@ if not os.path.isdir(DATA_DIR):
     os.makedirs(DATA_DIR, exist_ok=True)
 
 # === SQLite helpers for multi-user tokens ===
+# Schema setup is a one-time step, not an import side effect: the ensure_* functions
+# register with @schema_setup and init_schema() runs them once per database
+# (PRAGMA user_version). It runs in the gunicorn master (gunicorn.conf.py), via
+# `flask --app main init-db`, or lazily on a process's first get_db() call, which
+# then costs a single PRAGMA read. Bump SCHEMA_VERSION when adding tables/indexes.
+SCHEMA_VERSION = 8
+SCHEMA_SETUP = []
+_schema_state = "new"
+_schema_lock = threading.RLock()
+
+def schema_setup(fn):
+    SCHEMA_SETUP.append(fn)
+    return fn
+
 def get_db():
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
+    if _schema_state != "done":
+        ensure_schema()
     return conn
 
+def init_schema(force=False):
+    """Create/upgrade all tables. Returns True if DDL ran, False if already current."""
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        current = conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+    if current >= SCHEMA_VERSION and not force:
+        return False
+    for fn in SCHEMA_SETUP:
+        fn()
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        conn.commit()
+    finally:
+        conn.close()
+    return True
+
+def ensure_schema():
+    global _schema_state
+    with _schema_lock:
+        if _schema_state != "new":  # done, or running in this thread (nested get_db)
+            return
+        _schema_state = "running"
+        try:
+            init_schema()
+        except Exception as e:
+            print("DB init warning:", e)
+        finally:
+            _schema_state = "done"
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create/upgrade the SQLite schema (once per deploy)."""
+    ran = init_schema(force=True)
+    print(f"schema v{SCHEMA_VERSION} at {DB_PATH}: {'updated' if ran else 'already current'}")
 
+@schema_setup
 def init_db():
     with get_db() as conn:
         cur = conn.cursor()
@@ -739,12 +1021,6 @@ def init_db():
         )
         conn.commit()
 
-# Initialize DB table if not exists
-try:
-    init_db()
-except Exception as e:
-    print("DB init warning:", e)
-
 def save_user_token(athlete_dict, token_dict):
     with get_db() as conn:
         conn.execute(
@@ -770,6 +1046,7 @@ def save_user_token(athlete_dict, token_dict):
         conn.commit()
 
 #meta table
+@schema_setup
 def ensure_meta_table():
     with get_db() as conn:
         conn.execute("""CREATE TABLE IF NOT EXISTS meta (
@@ -777,10 +1054,6 @@ def ensure_meta_table():
             v TEXT
         );""")
         conn.commit()
-try:
-    ensure_meta_table()
-except Exception as _e:
-    print("meta table warn:", _e)
 
 def meta_get(key, default=None):
     with get_db() as conn:
@@ -800,13 +1073,13 @@ def get_user(athlete_id: int):
         cur = conn.execute("SELECT * FROM users WHERE athlete_id=?", (athlete_id,))
         return cur.fetchone()
 
-def refresh_if_needed(row):
-    """Return a valid access_token for this athlete row, refreshing if needed."""
+def refresh_if_needed(row, margin=120):
+    """Return a valid access_token for this athlete row, refreshing if it expires within margin s."""
     if not row:
         return None
     now = int(time.time())
     exp = int(row["expires_at"]) if row["expires_at"] else 0
-    if exp - 120 > now:
+    if exp - margin > now:
         return row["access_token"]
     # refresh
     payload = {
@@ -815,7 +1088,7 @@ def refresh_if_needed(row):
         "grant_type": "refresh_token",
         "refresh_token": row["refresh_token"],
     }
-    r = requests.post(STRAVA_TOKEN_URL, data=payload, timeout=20)
+    r = http_session.post(STRAVA_TOKEN_URL, data=payload, timeout=20)
     r.raise_for_status()
     data = r.json()
     save_user_token({"id": row["athlete_id"]}, data)
@@ -828,43 +1101,193 @@ def get_base_url():
     scheme = request.headers.get("X-Forwarded-Proto", request.scheme)
     return f"{scheme}://{request.host}"
 
+# fetch_streams() never holds the whole payload: the response is read in chunks and
+# each "data" array is split and converted straight into a typed array (array('q')
+# while every value is an integer, upgraded to array('d') on the first float; null
+# becomes NaN). Peak memory is one chunk plus 8 bytes per sample instead of body +
+# dict tree + boxed floats.
+STREAM_CHUNK = 64 * 1024
+_ARRAY_END = re.compile(r"\]\s*\]")
+_json_decoder = json.JSONDecoder()
+
+class _JsonChunks:
+    """Pull reader over an iterator of text chunks, for the few structural tokens we need."""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf, self.pos, self.eof = "", 0, False
+
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise ValueError("truncated streams payload")
+
+    def expect(self, ch):
+        if self.peek() != ch:
+            raise ValueError(f"expected {ch!r} at {self.buf[self.pos:self.pos + 20]!r}")
+        self.pos += 1
+
+    def value(self):
+        """Small JSON value (key, series_type, original_size...) via raw_decode, refilling if cut."""
+        self.peek()
+        while True:
+            try:
+                val, end = _json_decoder.raw_decode(self.buf, self.pos)
+                if end < len(self.buf) or self.eof or not isinstance(val, (int, float)):
+                    self.pos = end
+                    return val
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()  # a number may continue in the next chunk
+
+def _append_values(arr, tokens):
+    """Extend a typed array with JSON scalar tokens; returns the (possibly upgraded) array."""
+    if arr.typecode == "q":
+        try:
+            arr.extend([int(t) for t in tokens])
+            return arr
+        except ValueError:
+            arr = array("d", arr)
+    for t in tokens:
+        t = t.strip()
+        if t == "null":
+            arr.append(math.nan)
+        elif t in ("true", "false"):
+            arr.append(1.0 if t == "true" else 0.0)
+        else:
+            arr.append(float(t))
+    return arr
+
+def _read_data_array(rd, pairs):
+    """Body of a "data" array → typed array (pairs: flat lat, lng, lat, lng...)."""
+    rd.expect("[")
+    arr = array("q")
+    while True:
+        ch = rd.peek()
+        if ch == ",":
+            rd.pos += 1
+            continue
+        if ch == "]":
+            rd.pos += 1
+            return arr
+        buf, pos = rd.buf, rd.pos
+        if pairs:  # complete "[lat,lng]" pairs only; the array ends at "]]"
+            m = _ARRAY_END.search(buf, pos)
+            done = m is not None
+            cut = m.start() + 1 if done else buf.rfind("]", pos) + 1
+            after = m.end() if done else cut
+        else:  # scalars: up to the closing bracket or the last complete value
+            end = buf.find("]", pos)
+            done = end >= 0
+            cut = end if done else buf.rfind(",", pos)
+            after = end + 1 if done else cut
+        seg = buf[pos:cut] if cut > pos else ""
+        if seg:
+            if pairs:
+                seg = seg.replace("[", "").replace("]", "")
+            tokens = [t for t in seg.split(",") if t.strip()]
+            if tokens:
+                arr = _append_values(arr, tokens)
+        if cut > pos or done:
+            rd.pos = after
+        if done:
+            return arr
+        if not seg and not rd.fill():
+            raise ValueError("truncated streams payload")
+
+def parse_streams(chunks):
+    """Incrementally decode a key_by_type streams payload → {stream: typed array}; latlng → lat, lng."""
+    rd = _JsonChunks(chunks)
+    out = {}
+    rd.expect("{")
+    while rd.peek() != "}":
+        if rd.peek() == ",":
+            rd.pos += 1
+            continue
+        name = rd.value()
+        rd.expect(":")
+        if rd.peek() != "{":
+            rd.value()  # not a stream object
+            continue
+        rd.pos += 1
+        while rd.peek() != "}":
+            if rd.peek() == ",":
+                rd.pos += 1
+                continue
+            key = rd.value()
+            rd.expect(":")
+            if key == "data" and rd.peek() == "[":
+                data = _read_data_array(rd, pairs=(name == "latlng"))
+                if name == "latlng":
+                    out["lat"], out["lng"] = data[0::2], data[1::2]
+                else:
+                    out[name] = data
+            else:
+                rd.value()
+        rd.pos += 1
+    return out
+
 def fetch_streams(access_token, activity_id, types=None):
+    """Streams for one activity as {stream: typed array} (see parse_streams)."""
     if types is None:
         types = [
             "time", "distance", "altitude", "velocity_smooth",
-            "watts", "heartrate", "cadence", "grade_smooth", "temp"
+            "watts", "heartrate", "cadence", "grade_smooth", "temp", "latlng"
         ]
     url = f"{STRAVA_API_BASE}/activities/{activity_id}/streams"
     params = {"keys": ",".join(types), "key_by_type": "true"}
     headers = {"Authorization": f"Bearer {access_token}"}
-    r = requests.get(url, headers=headers, params=params, timeout=30)
-    r.raise_for_status()
-    return r.json()
-
-def save_streams_csv(athlete_id, activity_id, streams_json):
-    # Align streams by index
-    keys = [k for k, v in streams_json.items() if isinstance(v, dict) and "data" in v]
+    with http_session.get(url, headers=headers, params=params, timeout=30, stream=True) as r:
+        r.raise_for_status()
+        r.encoding = r.encoding or "utf-8"
+        return parse_streams(r.iter_content(chunk_size=STREAM_CHUNK, decode_unicode=True))
+
+def _csv_cell(v):
+    return "" if v is None or v != v else v  # None / NaN → empty cell
+
+def save_streams_csv(athlete_id, activity_id, streams):
+    # Align streams by index (latlng pairs are split into lat / lng columns); rows are
+    # generated one at a time straight from the column arrays, never materialized.
+    columns = streams_arrays(streams)
+    keys = list(columns)
     if not keys:
         raise RuntimeError("No stream data returned — check activity privacy/scopes.")
 
-    max_len = max(len(streams_json[k]["data"]) for k in keys)
-    rows = []
-    for i in range(max_len):
-        row = {"idx": i}
-        for k in keys:
-            data = streams_json[k]["data"]
-            row[k] = data[i] if i < len(data) else ""
-        rows.append(row)
+    max_len = max(len(columns[k]) for k in keys)
+    cols = [columns[k] for k in keys]
+
+    def rows():
+        for i in range(max_len):
+            yield [i] + [_csv_cell(c[i]) if i < len(c) else "" for c in cols]
 
     # Save locally
     os.makedirs(DATA_DIR, exist_ok=True)
-    out_path = os.path.join(DATA_DIR, f"{athlete_id}_{activity_id}.csv")
+    out_path = streams_csv_path(athlete_id, activity_id)
     with open(out_path, "w", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=rows[0].keys())
-        writer.writeheader()
-        writer.writerows(rows)
+        writer = csv.writer(f)
+        writer.writerow(["idx"] + keys)
+        writer.writerows(rows())
+    # A re-ingest replaces any older compressed copy
+    if os.path.exists(out_path + ".gz"):
+        os.remove(out_path + ".gz")
 
     # Upload to Google Drive if configured (still inside the function!)
+    drive_info = None
     try:
         if 'upload_to_drive' in globals() and callable(upload_to_drive) and DRIVE_FOLDER_ID:
             fname = os.path.basename(out_path)
@@ -874,6 +1297,11 @@ def save_streams_csv(athlete_id, activity_id, streams_json):
     except Exception as _e:
         print("Drive upload skipped/error:", _e)
 
+    try:
+        register_stored_file(out_path, "streams", athlete_id, activity_id, drive_info)
+    except Exception as _e:
+        print("register_stored_file warning:", _e)
+
     return out_path
 
 
@@ -904,14 +1332,40 @@ def webhook():
     owner_id = event.get("owner_id")
     activity_id = event.get("object_id")
 
+    if aspect == "delete" and owner_id and activity_id:
+        try:
+            remove_activity(owner_id, activity_id)
+            print(f"🗑️ Removed activity {activity_id}")
+        except Exception as e:
+            print("⚠️ delete error:", e)
+        return jsonify({"ok": True})
+
+    if aspect == "update" and owner_id and activity_id:
+        # title/type/description edits: refetch so the search index and weekly totals follow
+        token = refresh_if_needed(get_user(owner_id))
+        if token:
+            try:
+                old = get_activity(activity_id)
+                activity = fetch_activity(token, activity_id, owner_id, fresh=True)
+                save_activity(owner_id, activity)
+                for day in {(old["start_date_local"] or "")[:10] if old else "", (activity.get("start_date_local") or "")[:10]}:
+                    if day:
+                        activity_day_changed(owner_id, day)
+                rekey_best_efforts(owner_id, [activity_id])
+                rekey_climbs(owner_id, [activity_id])
+                refresh_sport_metrics(owner_id, [activity_id])
+            except Exception as e:
+                print("⚠️ update error:", e)
+        return jsonify({"ok": True})
+
     if aspect == "create" and owner_id and activity_id:
         row = get_user(owner_id)
         token = refresh_if_needed(row)
         if token:
             try:
-                streams = fetch_streams(token, activity_id)
-                out_path = save_streams_csv(owner_id, activity_id, streams)
+                out_path = ingest_activity(owner_id, activity_id, token)
                 print(f"✅ Saved streams → {out_path}")
+                maybe_run_retention_async()
             except Exception as e:
                 print("⚠️ fetch/save error:", e)
         else:
@@ -932,7 +1386,7 @@ def create_subscription():
         "verify_token": (verify_override or STRAVA_VERIFY_TOKEN),
     }
 
-    r = requests.post(f"{STRAVA_API_BASE}/push_subscriptions", data=payload, timeout=20)
+    r = http_session.post(f"{STRAVA_API_BASE}/push_subscriptions", data=payload, timeout=20)
     try:
         return {"status": r.status_code, "payload": {"callback_url": callback_url}, **r.json()}
     except Exception:
@@ -969,6 +1423,10 @@ def get_drive_service():
         sa_info = _parse_sa_json(GOOGLE_SERVICE_ACCOUNT_JSON)
         if not sa_info:
             return None
+        service_account = lazy_import("google.oauth2.service_account")
+        build = lazy_import("googleapiclient.discovery", "build")
+        if not (service_account and build):
+            return None
         creds = service_account.Credentials.from_service_account_info(
             sa_info,
             scopes=["https://www.googleapis.com/auth/drive.file"]
@@ -984,6 +1442,10 @@ def upload_to_drive(local_path, filename, mimetype="text/csv", folder_id=None):
     """
     Try user OAuth first (Drive perso), fallback to Service Account if available.
     """
+    MediaFileUpload = lazy_import("googleapiclient.http", "MediaFileUpload")
+    if MediaFileUpload is None:
+        return None
+
     # 1) User OAuth
     svc = get_drive_service_user()
     if svc:
@@ -1002,11 +1464,7 @@ def upload_to_drive(local_path, filename, mimetype="text/csv", folder_id=None):
             print("Drive user upload error:", e)
 
     # 2) Fallback Service Account si tu gardes ce mode
-    try:
-        from google.oauth2 import service_account
-        sa_ok = True
-    except Exception:
-        sa_ok = False
+    sa_ok = lazy_import("google.oauth2.service_account") is not None
 
     if sa_ok and 'get_drive_service' in globals():
         svc_sa = get_drive_service()
@@ -1045,13 +1503,10 @@ def status():
 
 
 # --- Optional FIT upload & summary (works with or without Drive) ---
-from flask import request, jsonify
-
-# Try to import fitparse for FIT decoding (optional)
-try:
-    from fitparse import FitFile
-except Exception:
-    FitFile = None
+from werkzeug.sansio.multipart import (
+    MultipartDecoder, NEED_DATA, Data as MultipartData,
+    Field as MultipartField, File as MultipartFile,
+)
 
 def parse_fit_summary(local_path):
     """
@@ -1060,6 +1515,7 @@ def parse_fit_summary(local_path):
     - laps count + basic lap times
     Returns dict. If fitparse not installed, returns {'parsed': False, 'reason': ...}
     """
+    FitFile = lazy_import("fitparse", "FitFile")  # optional
     if FitFile is None:
         return {"parsed": False, "reason": "fitparse not installed"}
 
@@ -1096,6 +1552,319 @@ def parse_fit_summary(local_path):
     except Exception as e:
         return {"parsed": False, "reason": str(e)}
 
+# --- Content-addressed FIT store ---
+# Uploaded FIT files are stored once per content hash (DATA_DIR/fit/ab/abcd….fit).
+# Watch sync apps often send the exact same export twice; a known hash skips the
+# disk write, the Drive upload and the fitparse pass.
+FIT_STORE_DIR = os.path.join(DATA_DIR, "fit")
+FIT_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+@schema_setup
+def ensure_fit_files_table():
+    with get_db() as conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS fit_files (
+            sha256 TEXT PRIMARY KEY,
+            filename TEXT,
+            local_path TEXT,
+            size INTEGER,
+            drive_file_json TEXT,
+            summary_json TEXT,
+            created_at INTEGER,
+            crc_status TEXT
+        );""")
+        cols = {r[1] for r in conn.execute("PRAGMA table_info(fit_files)")}
+        if "crc_status" not in cols:
+            conn.execute("ALTER TABLE fit_files ADD COLUMN crc_status TEXT")
+        conn.commit()
+
+def fit_store_path(digest, root=None):
+    return os.path.join(root or FIT_STORE_DIR, digest[:2], f"{digest}.fit")
+
+def fit_lookup(digest):
+    with get_db() as conn:
+        cur = conn.execute("SELECT * FROM fit_files WHERE sha256=?", (digest,))
+        return cur.fetchone()
+
+def fit_record(digest, filename, local_path, size, drive_file, summary, crc_status=None):
+    with get_db() as conn:
+        conn.execute(
+            """INSERT OR IGNORE INTO fit_files
+               (sha256, filename, local_path, size, drive_file_json, summary_json, created_at, crc_status)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (digest, filename, local_path, size,
+             json.dumps(drive_file) if isinstance(drive_file, dict) else None,
+             json.dumps(summary), int(time.time()), crc_status),
+        )
+        conn.commit()
+
+FIT_MAX_BYTES = int(os.environ.get("FIT_MAX_BYTES", 100 * 1024 * 1024))
+FIT_VERIFY_CRC = os.environ.get("FIT_VERIFY_CRC", "1") != "0"
+# The file CRC is checked inline at any size when crcmod's C extension is installed
+# (~0.3 s per 100 MB). Without it, files declaring more than this are answered 202:
+# the stored copy is checked in the background and only published (Drive, summary)
+# once it passes; GET /upload_fit/<sha256> reports the outcome.
+FIT_CRC_INLINE_BYTES = int(os.environ.get("FIT_CRC_INLINE_BYTES", 16 * 1024 * 1024))
+
+class FitFormatError(ValueError):
+    """Upload rejected while streaming (bad header, CRC mismatch, too large)."""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+# CRC-16 used by the FIT protocol (poly 0xA001, reflected, init 0), byte-wise table
+_FIT_CRC_TABLE = []
+for _i in range(256):
+    _c = _i
+    for _ in range(8):
+        _c = (_c >> 1) ^ 0xA001 if _c & 1 else _c >> 1
+    _FIT_CRC_TABLE.append(_c)
+
+@functools.lru_cache(maxsize=None)
+def _fit_crc_table16():
+    # Two bytes per step: the 16-bit register is fully replaced by (crc ^ word),
+    # so one 64K-entry lookup does the work of two byte steps.
+    t = _FIT_CRC_TABLE
+    out = array("H", bytes(2 * 65536))
+    for w in range(65536):
+        c = t[w & 0xFF]
+        out[w] = (c >> 8) ^ t[(c ^ (w >> 8)) & 0xFF]
+    return out
+
+@functools.lru_cache(maxsize=None)
+def _fit_crc_native():
+    """crcmod's C-backed CRC-16/ARC (FIT's CRC) if the extension is built, else None."""
+    if lazy_import("crcmod._crcfunext") is None:
+        return None
+    return lazy_import("crcmod").mkCrcFun(0x18005, initCrc=0, rev=True, xorOut=0)
+
+def fit_crc16(data, crc=0):
+    native = _fit_crc_native()
+    if native is not None:
+        return native(data, crc)
+    table = _FIT_CRC_TABLE
+    mv = memoryview(data)
+    if len(mv) >= 64 and sys.byteorder == "little":
+        table16 = _fit_crc_table16()
+        even = len(mv) & ~1
+        for w in mv[:even].cast("H"):
+            crc = table16[crc ^ w]
+        mv = mv[even:]
+    for b in mv:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xFF]
+    return crc
+
+class FitStreamValidator:
+    """
+    Incremental FIT check fed with the upload chunks:
+    - header (size, '.FIT' signature, header CRC) as soon as its bytes arrive
+    - declared length vs max size, so oversize files fail before the body is read
+    - file CRC over header + records (+ chained FIT segments); files declaring more
+      than inline_crc_bytes skip it and set crc_deferred (see verify_fit_crc_later)
+    """
+    def __init__(self, max_bytes=None, verify_crc=None, inline_crc_bytes=None):
+        self.max_bytes = FIT_MAX_BYTES if max_bytes is None else max_bytes
+        self.verify_crc = FIT_VERIFY_CRC if verify_crc is None else verify_crc
+        if inline_crc_bytes is None:
+            inline_crc_bytes = float("inf") if _fit_crc_native() else FIT_CRC_INLINE_BYTES
+        self.inline_crc_bytes = inline_crc_bytes
+        self.crc_deferred = False
+        self.seen = 0
+        self._pos = 0           # bytes consumed so far
+        self._header = b""
+        self._remaining = None  # bytes left in current segment (records + CRC)
+        self._crc = 0
+
+    def _parse_header(self):
+        hdr = self._header
+        size = len(hdr)
+        if hdr[8:12] != b".FIT":
+            raise FitFormatError("not a FIT file (missing .FIT signature)")
+        if size == 14 and self.verify_crc:
+            hcrc = int.from_bytes(hdr[12:14], "little")
+            if hcrc and fit_crc16(hdr[:12]) != hcrc:
+                raise FitFormatError("FIT header CRC mismatch")
+        data_size = int.from_bytes(hdr[4:8], "little")
+        if self._pos + data_size + 2 > self.max_bytes:
+            raise FitFormatError("FIT file larger than allowed", status=413)
+        if self.verify_crc and self._pos + data_size + 2 > self.inline_crc_bytes:
+            self.verify_crc = False
+            self.crc_deferred = True
+        self._remaining = data_size + 2
+        self._crc = fit_crc16(hdr) if self.verify_crc else 0
+        self._header = b""
+
+    def _consume(self, chunk):
+        while chunk:
+            if self._remaining is None:
+                if not self._header:
+                    if chunk[0] not in (12, 14):
+                        raise FitFormatError(f"not a FIT file (header size {chunk[0]})")
+                    need = chunk[0]
+                else:
+                    need = self._header[0] - len(self._header)
+                piece, chunk = chunk[:need], chunk[need:]
+                self._header += piece
+                self._pos += len(piece)
+                if len(self._header) == self._header[0]:
+                    self._parse_header()
+                continue
+            piece, chunk = chunk[:self._remaining], chunk[self._remaining:]
+            if self.verify_crc:
+                self._crc = fit_crc16(piece, self._crc)
+            self._remaining -= len(piece)
+            self._pos += len(piece)
+            if self._remaining == 0:
+                if self.verify_crc and self._crc != 0:
+                    raise FitFormatError("FIT file CRC mismatch (corrupt or truncated upload)")
+                self._remaining = None  # chained FIT: another header may follow
+
+    def feed(self, chunk):
+        self.seen += len(chunk)
+        if self.seen > self.max_bytes:
+            raise FitFormatError("FIT file larger than allowed", status=413)
+        self._consume(chunk)
+
+    def finish(self):
+        if self.seen == 0:
+            raise FitFormatError("empty upload")
+        if self._remaining is not None or self._header:
+            raise FitFormatError("truncated FIT file")
+
+def stream_to_disk(chunks, dest_dir, validator=None):
+    """
+    Write an iterable of byte chunks into a temp file under dest_dir, hashing and
+    validating in the same pass. Returns (tmp_path, sha256 hexdigest, size in bytes).
+    Raises FitFormatError (temp file removed) as soon as the validator rejects a chunk.
+    """
+    os.makedirs(dest_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, suffix=".part")
+    h = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in chunks:
+                if validator:
+                    validator.feed(chunk)
+                h.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        if validator:
+            validator.finish()
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, h.hexdigest(), size
+
+def verify_fit_crc(digest, path):
+    """
+    Full CRC pass over a stored FIT (uploads too large to check inline). A good file is
+    published (Drive + summary); a bad one is deleted. crc_status ends 'ok' or 'bad'.
+    """
+    validator = FitStreamValidator(max_bytes=float("inf"), verify_crc=True, inline_crc_bytes=float("inf"))
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(FIT_CHUNK_SIZE), b""):
+                validator.feed(chunk)
+        validator.finish()
+        status = "ok"
+    except FitFormatError as e:
+        print(f"FIT CRC check failed for {path}: {e}")
+        status = "bad"
+    if status == "ok":
+        row = fit_lookup(digest)
+        drive_file, summary = publish_fit(path, row["filename"] if row else os.path.basename(path))
+    else:
+        drive_file = summary = None
+        if os.path.exists(path):
+            os.remove(path)
+    with get_db() as conn:
+        conn.execute(
+            "UPDATE fit_files SET crc_status=?, drive_file_json=?, summary_json=? WHERE sha256=?",
+            (status, json.dumps(drive_file) if isinstance(drive_file, dict) else None,
+             json.dumps(summary) if summary is not None else None, digest),
+        )
+        if status == "bad":
+            conn.execute("DELETE FROM stored_files WHERE path=?", (path,))
+        conn.commit()
+    if status == "ok":
+        register_stored_file(path, "fit", drive_file=drive_file)
+    return status
+
+def publish_fit(local_path, fname):
+    """Drive upload (if configured) + quick summary of a stored, validated FIT."""
+    drive_file = None
+    try:
+        if 'upload_to_drive' in globals() and callable(upload_to_drive) and DRIVE_FOLDER_ID:
+            drive_file = upload_to_drive(local_path, fname, "application/octet-stream", DRIVE_FOLDER_ID)
+    except Exception as _e:
+        print("Drive upload error:", _e)
+    return drive_file, parse_fit_summary(local_path)
+
+def verify_fit_crc_later(digest, path):
+    threading.Thread(target=verify_fit_crc, args=(digest, path), daemon=True, name="fit-crc").start()
+
+def iter_request_body(stream, chunk_size=FIT_CHUNK_SIZE):
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+def iter_multipart_file(chunks, boundary, field, info):
+    """
+    Yield the bytes of one file part of a multipart body as they arrive, without
+    letting Werkzeug spool the whole form. info["filename"] is set when the part starts.
+    Stops reading the body once the file part is complete.
+    """
+    decoder = MultipartDecoder(boundary)
+    in_file = False
+    for chunk in itertools.chain(chunks, [None]):
+        decoder.receive_data(chunk)
+        while True:
+            try:
+                event = decoder.next_event()
+            except ValueError as e:
+                raise FitFormatError(f"malformed multipart body ({e})") from None
+            if event is NEED_DATA:
+                break
+            if isinstance(event, MultipartFile) and event.name == field:
+                fname = os.path.basename(event.filename or "")
+                if not fname.lower().endswith(".fit"):
+                    raise FitFormatError("Please provide a .fit file in 'file' field")
+                info["filename"] = fname
+                in_file = True
+            elif isinstance(event, (MultipartField, MultipartFile)):
+                in_file = False
+            elif isinstance(event, MultipartData) and in_file:
+                if event.data:
+                    yield event.data
+                if not event.more_data:
+                    return
+
+def fit_upload_chunks(info):
+    """Chunks of the uploaded FIT: multipart 'file' field, or a raw body (?filename=x.fit)."""
+    body = iter_request_body(request.stream)
+    if request.mimetype == "multipart/form-data":
+        boundary = request.mimetype_params.get("boundary")
+        if not boundary:
+            raise FitFormatError("missing multipart boundary")
+        return iter_multipart_file(body, boundary.encode("latin-1"), "file", info)
+    fname = os.path.basename(request.args.get("filename") or "upload.fit")
+    if not fname.lower().endswith(".fit"):
+        raise FitFormatError("Please provide a .fit file name")
+    info["filename"] = fname
+    return body
+
+def fit_store_root():
+    # fallback to /tmp if DATA_DIR not writable
+    try:
+        os.makedirs(FIT_STORE_DIR, exist_ok=True)
+        if os.access(FIT_STORE_DIR, os.W_OK):
+            return FIT_STORE_DIR
+    except Exception:
+        pass
+    return os.path.join("/tmp", "fit")
+
 @app.route("/upload_fit", methods=["GET", "POST"])
 def upload_fit():
     if request.method == "GET":
@@ -1108,36 +1877,3614 @@ def upload_fit():
             "</form>"
         )
 
-    # POST: receive file
-    f = request.files.get("file")
-    if not f or not f.filename.lower().endswith(".fit"):
-        return jsonify({"ok": False, "error": "Please provide a .fit file in 'file' field"}), 400
+    # POST: stream the body in chunks → disk + sha256 + FIT validator in one pass.
+    # request.files is never touched, so Werkzeug doesn't buffer/spool the upload.
+    if request.content_length and request.content_length > FIT_MAX_BYTES + 64 * 1024:
+        return jsonify({"ok": False, "error": "FIT file larger than allowed"}), 413
 
-    # Save locally (temporary ok even without Persistent Disk)
-    fname = f.filename
-    local_path = os.path.join(DATA_DIR, fname)
+    info = {}
+    store_root = fit_store_root()
     try:
-        f.save(local_path)
-    except Exception as e:
-        # fallback to /tmp if DATA_DIR not writable
-        local_path = os.path.join("/tmp", fname)
-        f.save(local_path)
+        chunks = fit_upload_chunks(info)
+        validator = FitStreamValidator()
+        tmp_path, digest, size = stream_to_disk(chunks, store_root, validator)
+    except FitFormatError as e:
+        return jsonify({"ok": False, "error": str(e)}), e.status
+    if not info.get("filename"):
+        os.remove(tmp_path)
+        return jsonify({"ok": False, "error": "Please provide a .fit file in 'file' field"}), 400
+    fname = info["filename"]
+
+    # Duplicate upload: same bytes already stored → reuse everything
+    known = fit_lookup(digest)
+    if known and known["crc_status"] in ("bad", "pending"):
+        os.remove(tmp_path)
+        if known["crc_status"] == "bad":
+            return jsonify({"ok": False, "error": "FIT file CRC mismatch (corrupt or truncated upload)"}), 400
+        return jsonify(fit_status(known)), 202
+    if known:
+        saved = known["local_path"]
+        if saved and (os.path.exists(saved) or os.path.exists(saved + ".gz")):
+            os.remove(tmp_path)
+        else:
+            # the stored copy is gone (pruned after Drive confirmed it, or /tmp wiped): keep these bytes
+            saved = fit_store_path(digest, store_root)
+            os.makedirs(os.path.dirname(saved), exist_ok=True)
+            os.replace(tmp_path, saved)
+            drive_known = json.loads(known["drive_file_json"]) if known["drive_file_json"] else None
+            try:
+                with get_db() as conn:
+                    conn.execute("UPDATE fit_files SET local_path=? WHERE sha256=?", (saved, digest))
+                    conn.commit()
+                register_stored_file(saved, "fit", drive_file=drive_known)
+            except Exception as _e:
+                print("fit_record warning:", _e)
+        return jsonify({
+            "ok": True,
+            "duplicate": True,
+            "sha256": digest,
+            "saved_local": saved,
+            "drive_file": json.loads(known["drive_file_json"]) if known["drive_file_json"] else None,
+            "fit_summary": json.loads(known["summary_json"]) if known["summary_json"] else None,
+            "crc_status": known["crc_status"],
+        })
+
+    local_path = fit_store_path(digest, store_root)
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    os.replace(tmp_path, local_path)
+
+    if validator.crc_deferred:
+        # not validated yet: nothing is published until the background check passes
+        try:
+            fit_record(digest, fname, local_path, size, None, None, "pending")
+            register_stored_file(local_path, "fit")
+        except Exception as _e:
+            print("fit_record warning:", _e)
+        verify_fit_crc_later(digest, local_path)
+        return jsonify(fit_status(fit_lookup(digest))), 202
 
-    # Upload to Google Drive if configured
-    drive_file = None
+    # Upload to Google Drive if configured + quick parse summary
+    drive_file, summary = publish_fit(local_path, fname)
+
+    crc_status = "ok" if validator.verify_crc else None
     try:
-        if 'upload_to_drive' in globals() and callable(upload_to_drive) and DRIVE_FOLDER_ID:
-            drive_file = upload_to_drive(local_path, fname, "application/octet-stream", DRIVE_FOLDER_ID)
+        fit_record(digest, fname, local_path, size, drive_file, summary, crc_status)
+        register_stored_file(local_path, "fit", drive_file=drive_file)
     except Exception as _e:
-        print("Drive upload error:", _e)
-
-    # Optional: quick parse summary
-    summary = parse_fit_summary(local_path)
+        print("fit_record warning:", _e)
 
     return jsonify({
         "ok": True,
+        "duplicate": False,
+        "sha256": digest,
         "saved_local": local_path,
         "drive_file": drive_file if isinstance(drive_file, dict) else None,
         "fit_summary": summary,
+        "crc_status": crc_status,
         "hint": "If you want deeper analysis, I can run an interval detection on this file."
     })
+
+def fit_status(row):
+    status = row["crc_status"]
+    return {
+        "ok": status not in ("bad", "pending"),  # pending: accepted, not validated yet
+        "pending": status == "pending",
+        "sha256": row["sha256"],
+        "crc_status": status,
+        "status_url": url_for("upload_fit_status", digest=row["sha256"]),
+        "saved_local": row["local_path"] if status != "bad" else None,
+        "drive_file": json.loads(row["drive_file_json"]) if row["drive_file_json"] else None,
+        "fit_summary": json.loads(row["summary_json"]) if row["summary_json"] else None,
+    }
+
+@app.route("/upload_fit/<digest>")
+def upload_fit_status(digest):
+    """Outcome of an upload answered 202 (crc_status pending → ok | bad)."""
+    row = fit_lookup(digest)
+    if row is None:
+        return jsonify({"ok": False, "error": "unknown upload"}), 404
+    return jsonify(fit_status(row)), 202 if row["crc_status"] == "pending" else 200
+
+
+# === Local storage tiering / retention ===
+# Recent files stay uncompressed for fast reads. Files older than RETENTION_HOT_DAYS
+# are gzip-compressed in place (x.csv → x.csv.gz). With RETENTION_PRUNE_DAYS > 0,
+# local copies older than that are deleted, but only once Drive holds an identical
+# copy (md5 match). open_stored() reads any tier transparently.
+RETENTION_HOT_DAYS = int(os.environ.get("RETENTION_HOT_DAYS", 30))
+RETENTION_PRUNE_DAYS = int(os.environ.get("RETENTION_PRUNE_DAYS", 0))  # 0 = never prune
+RETENTION_INTERVAL_S = int(os.environ.get("RETENTION_INTERVAL_S", 6 * 3600))
+
+@schema_setup
+def ensure_stored_files_table():
+    with get_db() as conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS stored_files (
+            path TEXT PRIMARY KEY,
+            kind TEXT,
+            athlete_id INTEGER,
+            activity_id INTEGER,
+            drive_file_id TEXT,
+            tier TEXT DEFAULT 'hot',
+            created_at INTEGER
+        );""")
+        conn.commit()
+
+def streams_csv_path(athlete_id, activity_id):
+    return os.path.join(DATA_DIR, f"{athlete_id}_{activity_id}.csv")
+
+_STREAMS_NAME = re.compile(r"^(\d+)_(\d+)\.csv(?:\.gz)?$")
+
+def stream_ids_from_path(path):
+    """(athlete_id, activity_id) from a DATA_DIR/<athlete>_<activity>.csv(.gz) name, else (None, None)."""
+    m = _STREAMS_NAME.match(os.path.basename(path))
+    return (int(m.group(1)), int(m.group(2))) if m else (None, None)
+
+def register_stored_file(path, kind, athlete_id=None, activity_id=None, drive_file=None):
+    drive_id = drive_file.get("id") if isinstance(drive_file, dict) else None
+    if kind == "streams" and activity_id is None:
+        athlete_id, activity_id = stream_ids_from_path(path)
+    with get_db() as conn:
+        conn.execute(
+            """INSERT INTO stored_files (path, kind, athlete_id, activity_id, drive_file_id, tier, created_at)
+               VALUES (?, ?, ?, ?, ?, 'hot', ?)
+               ON CONFLICT(path) DO UPDATE SET
+                   tier='hot',
+                   athlete_id=COALESCE(stored_files.athlete_id, excluded.athlete_id),
+                   activity_id=COALESCE(stored_files.activity_id, excluded.activity_id),
+                   drive_file_id=COALESCE(excluded.drive_file_id, stored_files.drive_file_id),
+                   created_at=excluded.created_at""",
+            (path, kind, athlete_id, activity_id, drive_id, int(time.time())),
+        )
+        conn.commit()
+
+def _set_tier(path, tier):
+    with get_db() as conn:
+        conn.execute("UPDATE stored_files SET tier=? WHERE path=?", (tier, path))
+        conn.commit()
+
+def download_from_drive(file_id, dest_path):
+    """Fetch a Drive file back to dest_path. Returns True on success."""
+    svc = get_drive_service_user() or get_drive_service()
+    if not svc:
+        return False
+    from googleapiclient.http import MediaIoBaseDownload
+    tmp_path = dest_path + ".part"
+    with open(tmp_path, "wb") as out:
+        dl = MediaIoBaseDownload(out, svc.files().get_media(fileId=file_id), chunksize=4 * 1024 * 1024)
+        done = False
+        while not done:
+            _status, done = dl.next_chunk()
+    os.replace(tmp_path, dest_path)
+    return True
+
+def open_stored(path, mode="rb"):
+    """
+    Open a stored file (streams CSV / FIT) whatever its tier:
+    plain file, gzip copy next to it, or pruned → re-downloaded from Drive.
+    """
+    kw = {"newline": ""} if "t" in mode else {}
+    try:
+        return open(path, mode, **kw)
+    except FileNotFoundError:
+        pass
+    try:
+        return gzip.open(path + ".gz", mode, **kw)
+    except FileNotFoundError:
+        pass
+    with get_db() as conn:
+        row = conn.execute("SELECT drive_file_id FROM stored_files WHERE path=?", (path,)).fetchone()
+    if row and row["drive_file_id"] and download_from_drive(row["drive_file_id"], path):
+        _set_tier(path, "hot")
+        return open(path, mode, **kw)
+    raise FileNotFoundError(path)
+
+def compress_file(path):
+    """path → path.gz (atomic), then drop the original. Returns bytes saved."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".gz.part")
+    try:
+        with open(path, "rb") as src, os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as gz:
+            shutil.copyfileobj(src, gz, 1024 * 1024)
+        shutil.copystat(path, tmp_path)  # keep the original mtime: retention ages files by it
+        os.replace(tmp_path, path + ".gz")
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    saved = os.path.getsize(path) - os.path.getsize(path + ".gz")
+    os.remove(path)
+    return saved
+
+def _stored_md5(path):
+    h = hashlib.md5()
+    with open_stored(path) as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def drive_confirms(file_id, path):
+    """True if Drive holds a file with the same md5 as our local copy."""
+    svc = get_drive_service_user() or get_drive_service()
+    if not svc or not file_id:
+        return False
+    try:
+        info = svc.files().get(fileId=file_id, fields="id, md5Checksum, trashed").execute()
+    except Exception as e:
+        print("Drive confirm error:", e)
+        return False
+    return bool(info.get("md5Checksum")) and not info.get("trashed") and info["md5Checksum"] == _stored_md5(path)
+
+def _local_candidates():
+    """(logical path, kind, physical path) for stream CSVs and stored FIT files under DATA_DIR."""
+    out = []
+    if os.path.isdir(DATA_DIR):
+        for name in os.listdir(DATA_DIR):
+            if name.endswith(".csv") or name.endswith(".csv.gz"):
+                phys = os.path.join(DATA_DIR, name)
+                out.append((phys[:-3] if name.endswith(".gz") else phys, "streams", phys))
+    if os.path.isdir(FIT_STORE_DIR):
+        for root, _dirs, files in os.walk(FIT_STORE_DIR):
+            for name in files:
+                if name.endswith(".fit") or name.endswith(".fit.gz"):
+                    phys = os.path.join(root, name)
+                    out.append((phys[:-3] if name.endswith(".gz") else phys, "fit", phys))
+    return out
+
+def run_retention(now=None, dry_run=False):
+    """Compress cold files, prune Drive-confirmed ones. Returns a report dict."""
+    now = now or time.time()
+    hot_cutoff = now - RETENTION_HOT_DAYS * 86400
+    prune_cutoff = now - RETENTION_PRUNE_DAYS * 86400 if RETENTION_PRUNE_DAYS > 0 else None
+    report = {"compressed": 0, "pruned": 0, "bytes_saved": 0, "errors": 0, "dry_run": dry_run}
+    with get_db() as conn:
+        drive_ids = {r["path"]: r["drive_file_id"] for r in conn.execute("SELECT path, drive_file_id FROM stored_files")}
+    for path, kind, phys in _local_candidates():
+        try:
+            mtime = os.path.getmtime(phys)
+            if path not in drive_ids and not dry_run:
+                register_stored_file(path, kind)
+            if prune_cutoff and mtime < prune_cutoff and drive_ids.get(path):
+                if drive_confirms(drive_ids[path], path):
+                    report["pruned"] += 1
+                    report["bytes_saved"] += os.path.getsize(phys)
+                    if not dry_run:
+                        os.remove(phys)
+                        _set_tier(path, "drive")
+                    continue
+            if phys == path and mtime < hot_cutoff:
+                report["compressed"] += 1
+                if not dry_run:
+                    report["bytes_saved"] += compress_file(path)
+                    _set_tier(path, "gz")
+        except Exception as e:
+            report["errors"] += 1
+            print("retention error:", path, e)
+    if not dry_run:
+        meta_set("retention_last_run", str(int(now)))
+        meta_set("retention_last_report", json.dumps(report))
+    return report
+
+def maybe_run_retention_async():
+    """Kick a background retention pass if the last one is older than RETENTION_INTERVAL_S."""
+    try:
+        last = int(meta_get("retention_last_run", "0") or 0)
+    except Exception:
+        last = 0
+    if time.time() - last < RETENTION_INTERVAL_S:
+        return False
+    meta_set("retention_last_run", str(int(time.time())))  # claim this slot for the other workers
+    threading.Thread(target=run_retention, name="retention", daemon=True).start()
+    return True
+
+def storage_usage():
+    usage = defaultdict(lambda: {"files": 0, "bytes": 0})
+    for _path, kind, phys in _local_candidates():
+        tier = "gz" if phys.endswith(".gz") else "hot"
+        usage[f"{kind}_{tier}"]["files"] += 1
+        usage[f"{kind}_{tier}"]["bytes"] += os.path.getsize(phys)
+    return dict(usage)
+
+@app.route("/admin/retention", methods=["GET", "POST"])
+@admin_required
+def admin_retention():
+    """GET: disk usage + policy (+ dry run). POST: run a retention pass now."""
+    if request.method == "POST":
+        return {"ok": True, "report": run_retention()}
+    return {
+        "ok": True,
+        "policy": {
+            "hot_days": RETENTION_HOT_DAYS,
+            "prune_days": RETENTION_PRUNE_DAYS,
+            "interval_s": RETENTION_INTERVAL_S,
+        },
+        "usage": storage_usage(),
+        "dry_run": run_retention(dry_run=True),
+        "last_report": json.loads(meta_get("retention_last_report", "null") or "null"),
+    }
+
+
+# === Activities & derived metrics (computed once on ingest) ===
+# ingest_activity() is the single per-activity pipeline run by /webhook:
+# streams → CSV, summary → activities table, derived metrics → activity_metrics.
+# Metrics are registered with @metric(name, version); bumping a version (or adding
+# a metric) makes get_metrics() recompute it lazily, and /admin/metrics/backfill
+# fills history in parallel worker processes.
+FTP_DEFAULT = float(os.environ.get("FTP_DEFAULT", 200))
+HR_MAX_DEFAULT = float(os.environ.get("HR_MAX_DEFAULT", 190))
+HR_REST_DEFAULT = float(os.environ.get("HR_REST_DEFAULT", 60))
+METRICS_WORKERS = int(os.environ.get("METRICS_WORKERS", 2))
+MAX_GAP_S = 10  # longer gaps between samples are pauses, not effort
+FOOT_SPORTS = {"Run", "TrailRun", "VirtualRun", "Walk", "Hike"}
+
+@schema_setup
+def ensure_activity_tables():
+    with get_db() as conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS activities (
+            id INTEGER PRIMARY KEY,
+            athlete_id INTEGER,
+            name TEXT,
+            description TEXT,
+            sport_type TEXT,
+            start_date TEXT,
+            start_date_local TEXT,
+            distance REAL,
+            moving_time INTEGER,
+            elapsed_time INTEGER,
+            total_elevation_gain REAL,
+            summary_json TEXT,
+            updated_at INTEGER
+        );""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_activities_athlete_date ON activities(athlete_id, start_date_local)")
+        conn.execute("""CREATE TABLE IF NOT EXISTS activity_metrics (
+            activity_id INTEGER,
+            athlete_id INTEGER,
+            name TEXT,
+            version INTEGER,
+            value_json TEXT,
+            computed_at INTEGER,
+            PRIMARY KEY (activity_id, name)
+        );""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_metrics_athlete ON activity_metrics(athlete_id, name)")
+        conn.commit()
+
+def fetch_activity(access_token, activity_id, athlete_id=None, fresh=False):
+    r = strava_get(f"{STRAVA_API_BASE}/activities/{activity_id}", access_token, athlete_id,
+                   timeout=20, fresh=fresh)
+    r.raise_for_status()
+    return r.json()
+
+def save_activity(athlete_id, a):
+    with get_db() as conn:
+        conn.execute(
+            """INSERT INTO activities (id, athlete_id, name, description, sport_type, start_date,
+                   start_date_local, distance, moving_time, elapsed_time, total_elevation_gain,
+                   summary_json, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(id) DO UPDATE SET
+                   name=excluded.name,
+                   description=COALESCE(excluded.description, activities.description),
+                   sport_type=excluded.sport_type,
+                   start_date=excluded.start_date,
+                   start_date_local=excluded.start_date_local,
+                   distance=excluded.distance,
+                   moving_time=excluded.moving_time,
+                   elapsed_time=excluded.elapsed_time,
+                   total_elevation_gain=excluded.total_elevation_gain,
+                   summary_json=excluded.summary_json,
+                   updated_at=excluded.updated_at""",
+            (
+                a.get("id"), athlete_id, a.get("name"), a.get("description"),
+                a.get("sport_type") or a.get("type") or "Other",
+                a.get("start_date"), a.get("start_date_local"),
+                a.get("distance") or 0, a.get("moving_time") or 0, a.get("elapsed_time") or 0,
+                a.get("total_elevation_gain") or 0,
+                json.dumps(a), int(time.time()),
+            ),
+        )
+        conn.commit()
+
+def get_activity(activity_id):
+    with get_db() as conn:
+        cur = conn.execute("SELECT * FROM activities WHERE id=?", (activity_id,))
+        return cur.fetchone()
+
+def streams_arrays(streams):
+    """
+    {stream: values}: accepts fetch_streams() output (typed arrays, passed through) or a
+    raw key_by_type payload (latlng → lat + lng). NaN gaps become None for the metrics.
+    """
+    out = {}
+    for k, v in streams.items():
+        if isinstance(v, array):
+            # v == v is a C-level scan that is False only if some sample is NaN
+            out[k] = v if v.typecode != "d" or v == v else [None if x != x else x for x in v]
+            continue
+        if not isinstance(v, dict) or "data" not in v:
+            continue
+        if k == "latlng":
+            out["lat"] = [p[0] if p else None for p in v["data"]]
+            out["lng"] = [p[1] if p else None for p in v["data"]]
+        else:
+            out[k] = v["data"]
+    return out
+
+def load_streams(athlete_id, activity_id):
+    """Read a stored streams CSV (any storage tier) back into {stream: list of float|None}."""
+    with open_stored(streams_csv_path(athlete_id, activity_id), "rt") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        cols = [[] for _ in header]
+        for row in reader:
+            for i, v in enumerate(row):
+                cols[i].append(safe_float(v, None) if v != "" else None)
+    return {k: c for k, c in zip(header, cols) if k != "idx"}
+
+def athlete_settings(athlete_id):
+    """Thresholds used by the metrics (per-athlete overrides in meta, else env defaults)."""
+    settings = {"ftp": FTP_DEFAULT, "hr_max": HR_MAX_DEFAULT, "hr_rest": HR_REST_DEFAULT}
+    try:
+        settings.update(json.loads(meta_get(f"athlete_settings:{athlete_id}", "{}") or "{}"))
+    except Exception:
+        pass
+    return settings
+
+# --- Stream math helpers ---
+def _deltas(t):
+    """Seconds covered by each sample (gap to the next one), pauses capped to 0."""
+    n = len(t)
+    return [(t[i + 1] - t[i]) if t[i + 1] - t[i] <= MAX_GAP_S else 0 for i in range(n - 1)] + [0] if n else []
+
+def _resample_1hz(t, v):
+    """Put samples on a 1 s grid (smart recording skips seconds); pauses become 0."""
+    out = []
+    if not t:
+        return out
+    j, n = 0, len(t)
+    for sec in range(int(t[0]), int(t[-1]) + 1):
+        while j + 1 < n and t[j + 1] <= sec:
+            j += 1
+        out.append((v[j] or 0.0) if sec - t[j] <= 2 else 0.0)
+    return out
+
+def _rolling_mean(values, window):
+    if len(values) < window:
+        return []
+    acc = [0.0]
+    for x in values:
+        acc.append(acc[-1] + x)
+    return [(acc[i] - acc[i - window]) / window for i in range(window, len(acc))]
+
+def _time_in_zones(t, values, bounds):
+    """Seconds spent in each zone; bounds are the zone lower edges after zone 1."""
+    secs = [0] * (len(bounds) + 1)
+    for dt, x in zip(_deltas(t), values):
+        if x is None or dt <= 0:
+            continue
+        z = 0
+        while z < len(bounds) and x >= bounds[z]:
+            z += 1
+        secs[z] += dt
+    return secs
+
+def _clean(values):
+    return [x for x in values if x is not None]
+
+# --- Metric registry ---
+METRICS = {}  # name -> (version, fn(streams, activity, settings, computed))
+
+def metric(name, version=1):
+    def deco(fn):
+        METRICS[name] = (version, fn)
+        return fn
+    return deco
+
+@metric("normalized_power")
+def m_normalized_power(streams, activity, settings, computed):
+    t, w = streams.get("time"), streams.get("watts")
+    if not t or not w or not _clean(w):
+        return None
+    rolled = _rolling_mean(_resample_1hz(t, w), 30)
+    if not rolled:
+        return None
+    return round((sum(x ** 4 for x in rolled) / len(rolled)) ** 0.25, 1)
+
+@metric("intensity_factor")
+def m_intensity_factor(streams, activity, settings, computed):
+    np_ = computed.get("normalized_power")
+    if not np_ or not settings.get("ftp"):
+        return None
+    return round(np_ / settings["ftp"], 3)
+
+@metric("tss")
+def m_tss(streams, activity, settings, computed):
+    np_, if_ = computed.get("normalized_power"), computed.get("intensity_factor")
+    t = streams.get("time")
+    if not np_ or not if_ or not t:
+        return None
+    moving_s = sum(_deltas(t))
+    return round(moving_s * np_ * if_ / (settings["ftp"] * 3600) * 100, 1)
+
+@metric("trimp")
+def m_trimp(streams, activity, settings, computed):
+    """Banister TRIMP: Σ dt(min) · HRr · 0.64 · e^(1.92 · HRr)."""
+    t, hr = streams.get("time"), streams.get("heartrate")
+    if not t or not hr or not _clean(hr):
+        return None
+    rest, mx = settings["hr_rest"], settings["hr_max"]
+    total = 0.0
+    for dt, h in zip(_deltas(t), hr):
+        if h is None or dt <= 0:
+            continue
+        hrr = min(max((h - rest) / (mx - rest), 0.0), 1.0)
+        total += dt / 60.0 * hrr * 0.64 * math.exp(1.92 * hrr)
+    return round(total, 1)
+
+@metric("power_zones")
+def m_power_zones(streams, activity, settings, computed):
+    """Seconds in Coggan zones Z1–Z7 (% FTP: 55/75/90/105/120/150)."""
+    t, w = streams.get("time"), streams.get("watts")
+    if not t or not w or not _clean(w):
+        return None
+    ftp = settings["ftp"]
+    return _time_in_zones(t, w, [ftp * p for p in (0.55, 0.75, 0.90, 1.05, 1.20, 1.50)])
+
+@metric("hr_zones")
+def m_hr_zones(streams, activity, settings, computed):
+    """Seconds in Z1–Z5 (% HRmax: 60/70/80/90)."""
+    t, hr = streams.get("time"), streams.get("heartrate")
+    if not t or not hr or not _clean(hr):
+        return None
+    mx = settings["hr_max"]
+    return _time_in_zones(t, hr, [mx * p for p in (0.60, 0.70, 0.80, 0.90)])
+
+@metric("aerobic_decoupling")
+def m_aerobic_decoupling(streams, activity, settings, computed):
+    """Pw:HR (or Pa:HR without power) drift between halves, in %."""
+    t, hr = streams.get("time"), streams.get("heartrate")
+    out = streams.get("watts") if streams.get("watts") and _clean(streams["watts"]) else streams.get("velocity_smooth")
+    if not t or not hr or not out or t[-1] - t[0] < 20 * 60:
+        return None
+    mid = t[0] + (t[-1] - t[0]) / 2
+    halves = [[0.0, 0.0], [0.0, 0.0]]
+    for dt, ti, o, h in zip(_deltas(t), t, out, hr):
+        if o is None or not h or dt <= 0:
+            continue
+        half = halves[0 if ti < mid else 1]
+        half[0] += o * dt
+        half[1] += h * dt
+    if not all(h[1] for h in halves) or not halves[0][0]:
+        return None
+    r1, r2 = halves[0][0] / halves[0][1], halves[1][0] / halves[1][1]
+    return round((r1 - r2) / r1 * 100, 2)
+
+def _minetti_cost(g):
+    """Energy cost of running (J/kg/m) at grade g (fraction), Minetti 2002."""
+    g = min(max(g, -0.45), 0.45)
+    return 155.4 * g ** 5 - 30.4 * g ** 4 - 43.3 * g ** 3 + 46.3 * g ** 2 + 19.5 * g + 3.6
+
+@metric("grade_adjusted_pace")
+def m_grade_adjusted_pace(streams, activity, settings, computed):
+    """Elevation-corrected pace in s/km (flat-equivalent distance via Minetti cost)."""
+    if not activity or (activity.get("sport_type") or activity.get("type")) not in FOOT_SPORTS:
+        return None  # unknown sport (summary fetch failed) counts as not on foot; see refresh_sport_metrics
+    t, d, g = streams.get("time"), streams.get("distance"), streams.get("grade_smooth")
+    if not t or not d or not g:
+        return None
+    dts = _deltas(t)
+    moving_s, flat_m = 0.0, 0.0
+    for i in range(len(t) - 1):
+        if dts[i] <= 0 or d[i] is None or d[i + 1] is None:
+            continue
+        step = d[i + 1] - d[i]
+        if step <= 0:
+            continue
+        moving_s += dts[i]
+        flat_m += step * _minetti_cost((g[i] or 0.0) / 100.0) / 3.6
+    if flat_m < 100:
+        return None
+    return round(moving_s / (flat_m / 1000.0), 1)
+
+def run_metrics(streams, activity, settings, names=None):
+    """Compute registered metrics (registration order, so derived ones see their inputs)."""
+    computed, out = {}, {}
+    for name, (version, fn) in METRICS.items():
+        try:
+            computed[name] = fn(streams, activity, settings, computed)
+        except Exception as e:
+            print(f"metric {name} error:", e)
+            computed[name] = None
+        if names is None or name in names:
+            out[name] = (version, computed[name])
+    return out
+
+def store_metrics(athlete_id, activity_id, results):
+    now = int(time.time())
+    with get_db() as conn:
+        conn.executemany(
+            """INSERT INTO activity_metrics (activity_id, athlete_id, name, version, value_json, computed_at)
+               VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT(activity_id, name) DO UPDATE SET
+                   version=excluded.version, value_json=excluded.value_json, computed_at=excluded.computed_at""",
+            [(activity_id, athlete_id, name, version, json.dumps(value), now)
+             for name, (version, value) in results.items()],
+        )
+        conn.commit()
+    if "best_efforts" in results:
+        record_best_efforts(athlete_id, activity_id, results["best_efforts"][1])
+    if "climbs" in results:
+        record_climbs(athlete_id, activity_id, results["climbs"][1])
+
+def _activity_dict(activity_id):
+    row = get_activity(activity_id)
+    return json.loads(row["summary_json"]) if row and row["summary_json"] else None
+
+SPORT_METRICS = {"grade_adjusted_pace"}  # depend on the activity's sport, not just its streams
+
+def refresh_sport_metrics(athlete_id, activity_ids):
+    """Recompute sport-dependent metrics whose stored value no longer fits the activity's sport."""
+    stale = []
+    foot = sorted(FOOT_SPORTS)
+    with get_db() as conn:
+        for i in range(0, len(activity_ids), 500):
+            chunk = list(activity_ids[i:i + 500])
+            stale += [(r[0], r[1]) for r in conn.execute(
+                f"""SELECT m.activity_id, a.sport_type FROM activity_metrics m JOIN activities a ON a.id = m.activity_id
+                    WHERE m.name='grade_adjusted_pace' AND m.activity_id IN ({','.join('?' * len(chunk))})
+                      AND (m.value_json = 'null') = (a.sport_type IN ({','.join('?' * len(foot))}))""",
+                [*chunk, *foot],
+            )]
+    for aid, sport in stale:
+        # the activities row is authoritative; summary_json may still hold the ingest-time payload
+        activity = {**(_activity_dict(aid) or {}), "sport_type": sport}
+        try:
+            compute_metrics(athlete_id, aid, activity=activity, names=SPORT_METRICS)
+        except FileNotFoundError:
+            pass
+    return [aid for aid, _sport in stale]
+
+def compute_metrics(athlete_id, activity_id, streams=None, activity=None, names=None):
+    if streams is None:
+        streams = load_streams(athlete_id, activity_id)
+    if activity is None:
+        activity = _activity_dict(activity_id)
+    results = run_metrics(streams, activity, athlete_settings(athlete_id), names)
+    store_metrics(athlete_id, activity_id, results)
+    return {name: value for name, (_version, value) in results.items()}
+
+def get_metrics(athlete_id, activity_id):
+    """Stored metrics for one activity; missing/outdated ones are computed lazily."""
+    with get_db() as conn:
+        rows = conn.execute(
+            "SELECT name, version, value_json FROM activity_metrics WHERE activity_id=?", (activity_id,)
+        ).fetchall()
+    have = {r["name"]: (r["version"], json.loads(r["value_json"])) for r in rows}
+    stale = [n for n, (v, _fn) in METRICS.items() if have.get(n, (None,))[0] != v]
+    if stale:
+        try:
+            have.update({n: (METRICS[n][0], v) for n, v in compute_metrics(athlete_id, activity_id).items()})
+        except FileNotFoundError:
+            pass
+    return {n: v for n, (_version, v) in have.items()}
+
+def ingest_activity(athlete_id, activity_id, token):
+    """Per-activity ingest pipeline (webhook create). Returns the streams CSV path."""
+    streams = fetch_streams(token, activity_id)
+    out_path = save_streams_csv(athlete_id, activity_id, streams)
+    activity = None
+    try:
+        activity = fetch_activity(token, activity_id, athlete_id, fresh=True)
+        save_activity(athlete_id, activity)
+    except Exception as e:
+        print("activity summary fetch error:", e)
+    arrays = streams_arrays(streams)
+    compute_metrics(athlete_id, activity_id, arrays, activity)
+    if arrays.get("lat"):
+        try:
+            index_route(athlete_id, activity_id, arrays["lat"], arrays["lng"])
+            store_heat_track(athlete_id, activity_id, arrays["lat"], arrays["lng"])
+        except Exception as e:
+            print("route index error:", e)
+    if activity and activity.get("start_date_local"):
+        activity_day_changed(athlete_id, activity["start_date_local"][:10])
+    return out_path
+
+def activity_day_changed(athlete_id, day):
+    """An activity of this athlete was added/changed/removed on day: refresh derived series."""
+    update_training_load(athlete_id, day)
+    refresh_weekly_totals(athlete_id, day)
+    update_progress_day(athlete_id, day)
+
+def remove_activity(athlete_id, activity_id):
+    """Strava 'delete' event: drop the activity, its metrics and local streams, fix derived series."""
+    row = get_activity(activity_id)
+    with get_db() as conn:
+        conn.execute("DELETE FROM activity_metrics WHERE activity_id=?", (activity_id,))
+        conn.execute("DELETE FROM activities WHERE id=?", (activity_id,))
+        conn.commit()
+    forget_best_efforts(athlete_id, activity_id)
+    with get_db() as conn:
+        conn.execute("DELETE FROM climbs WHERE activity_id=?", (activity_id,))
+        conn.commit()
+    drop_heat_track(athlete_id, activity_id)
+    unindex_route(activity_id)
+    path = streams_csv_path(athlete_id, activity_id)
+    for p in (path, path + ".gz"):
+        if os.path.exists(p):
+            os.remove(p)
+    with get_db() as conn:
+        conn.execute("DELETE FROM stored_files WHERE path=?", (path,))
+        conn.commit()
+    if row and row["start_date_local"]:
+        activity_day_changed(athlete_id, row["start_date_local"][:10])
+
+def _metrics_job(athlete_id, activity_id, activity, settings, names):
+    """Process-pool worker: load streams + compute, the parent process writes to SQLite."""
+    try:
+        streams = load_streams(athlete_id, activity_id)
+    except FileNotFoundError:
+        return athlete_id, activity_id, None
+    return athlete_id, activity_id, run_metrics(streams, activity, settings, names)
+
+def pending_metric_work():
+    """
+    [(athlete_id, activity_id, names to (re)compute)] for stored stream files: registered
+    ones plus CSVs on disk from before stored_files existed (ids parsed from the name).
+    """
+    with get_db() as conn:
+        files = conn.execute("SELECT path, athlete_id, activity_id FROM stored_files WHERE kind='streams'").fetchall()
+        rows = conn.execute("SELECT activity_id, name, version FROM activity_metrics").fetchall()
+    have = defaultdict(dict)
+    for r in rows:
+        have[r["activity_id"]][r["name"]] = r["version"]
+    ids = {}
+    for f in files:
+        athlete_id, activity_id = f["athlete_id"], f["activity_id"]
+        if activity_id is None:
+            athlete_id, activity_id = stream_ids_from_path(f["path"])
+        if activity_id is not None:
+            ids[activity_id] = athlete_id
+    for path, kind, _phys in _local_candidates():
+        if kind == "streams":
+            athlete_id, activity_id = stream_ids_from_path(path)
+            if activity_id is not None:
+                ids.setdefault(activity_id, athlete_id)
+    work = []
+    for activity_id, athlete_id in sorted(ids.items()):
+        names = [n for n, (v, _fn) in METRICS.items() if have[activity_id].get(n) != v]
+        if names:
+            work.append((athlete_id, activity_id, names))
+    return work
+
+def backfill_metrics(workers=None):
+    """Compute missing/outdated metrics over history in parallel processes."""
+    work = pending_metric_work()
+    done = 0
+    if not work:
+        return done
+    settings = {}
+    with process_pool(workers or METRICS_WORKERS) as pool:
+        futures = []
+        for athlete_id, activity_id, names in work:
+            if athlete_id not in settings:
+                settings[athlete_id] = athlete_settings(athlete_id)
+            futures.append(pool.submit(_metrics_job, athlete_id, activity_id,
+                                       _activity_dict(activity_id), settings[athlete_id], set(names)))
+        for fut in futures:
+            try:
+                athlete_id, activity_id, results = fut.result()
+            except Exception as e:
+                print("metrics backfill error:", e)
+                continue
+            if results:
+                store_metrics(athlete_id, activity_id, results)
+                done += 1
+    return done
+
+@app.route("/admin/metrics/backfill", methods=["GET", "POST"])
+@admin_required
+def admin_metrics_backfill():
+    """GET: how many activities need metrics. POST: backfill them in the background."""
+    if request.method == "POST":
+        threading.Thread(target=backfill_metrics, name="metrics-backfill", daemon=True).start()
+        return {"ok": True, "started": True}
+    return {"ok": True, "metrics": {n: v for n, (v, _fn) in METRICS.items()},
+            "pending_activities": len(pending_metric_work())}
+
+@app.route("/activity/<int:activity_id>/metrics")
+def activity_metrics(activity_id):
+    if "access_token" not in session:
+        return redirect(url_for("home"))
+    athlete_id = (session.get("athlete") or {}).get("id")
+    row = get_activity(activity_id)
+    if not row or row["athlete_id"] != athlete_id:
+        return jsonify({"ok": False, "error": "unknown activity"}), 404
+    return jsonify({"ok": True, "activity_id": activity_id, "metrics": get_metrics(athlete_id, activity_id)})
+
+
+# === Training load series (CTL / ATL / TSB) ===
+# Daily load = Σ TSS of the day's activities (TRIMP when there is no power).
+# CTL/ATL are exponentially weighted averages (42 / 7 days) persisted per day, so a
+# new, changed or deleted activity only recomputes from its day forward: the row of
+# the day before is the seed, nothing earlier is read.
+CTL_DAYS = 42
+ATL_DAYS = 7
+
+@schema_setup
+def ensure_training_load_table():
+    with get_db() as conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS training_load (
+            athlete_id INTEGER,
+            day TEXT,
+            load REAL,
+            ctl REAL,
+            atl REAL,
+            tsb REAL,
+            PRIMARY KEY (athlete_id, day)
+        );""")
+        conn.commit()
+
+def daily_loads(athlete_id, from_day):
+    """{YYYY-MM-DD: load} for days >= from_day, from stored per-activity metrics."""
+    with get_db() as conn:
+        rows = conn.execute(
+            """SELECT substr(a.start_date_local, 1, 10) AS day,
+                      SUM(COALESCE(
+                          CAST(NULLIF((SELECT value_json FROM activity_metrics WHERE activity_id=a.id AND name='tss'), 'null') AS REAL),
+                          CAST(NULLIF((SELECT value_json FROM activity_metrics WHERE activity_id=a.id AND name='trimp'), 'null') AS REAL),
+                          0)) AS load
+               FROM activities a
+               WHERE a.athlete_id=? AND substr(a.start_date_local, 1, 10) >= ?
+               GROUP BY day""",
+            (athlete_id, from_day),
+        ).fetchall()
+    return {r["day"]: r["load"] or 0.0 for r in rows}
+
+def update_training_load(athlete_id, from_day=None, to_day=None):
+    """Recompute the series from from_day (or the first missing day) to to_day (default today)."""
+    to_day = to_day or datetime.date.today().isoformat()
+    with get_db() as conn:
+        last = conn.execute(
+            "SELECT MAX(day) AS d FROM training_load WHERE athlete_id=?", (athlete_id,)
+        ).fetchone()["d"]
+        if last is None:
+            first = conn.execute(
+                "SELECT MIN(substr(start_date_local, 1, 10)) AS d FROM activities WHERE athlete_id=?", (athlete_id,)
+            ).fetchone()["d"]
+            if first is None:
+                return 0
+            start = first if from_day is None else min(first, from_day)
+        else:
+            next_missing = (datetime.date.fromisoformat(last) + datetime.timedelta(days=1)).isoformat()
+            start = next_missing if from_day is None else min(from_day, next_missing)
+        seed = conn.execute(
+            "SELECT ctl, atl FROM training_load WHERE athlete_id=? AND day<? ORDER BY day DESC LIMIT 1",
+            (athlete_id, start),
+        ).fetchone()
+    if start > to_day:
+        return 0
+    ctl, atl = (seed["ctl"], seed["atl"]) if seed else (0.0, 0.0)
+    loads = daily_loads(athlete_id, start)
+    rows = []
+    day = datetime.date.fromisoformat(start)
+    end = datetime.date.fromisoformat(to_day)
+    while day <= end:
+        key = day.isoformat()
+        load = loads.get(key, 0.0)
+        tsb = ctl - atl  # form = yesterday's fitness - fatigue
+        ctl += (load - ctl) / CTL_DAYS
+        atl += (load - atl) / ATL_DAYS
+        rows.append((athlete_id, key, load, round(ctl, 2), round(atl, 2), round(tsb, 2)))
+        day += datetime.timedelta(days=1)
+    with get_db() as conn:
+        conn.executemany(
+            """INSERT INTO training_load (athlete_id, day, load, ctl, atl, tsb) VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT(athlete_id, day) DO UPDATE SET
+                   load=excluded.load, ctl=excluded.ctl, atl=excluded.atl, tsb=excluded.tsb""",
+            rows,
+        )
+        conn.commit()
+    return len(rows)
+
+def training_load_series(athlete_id, days=180):
+    update_training_load(athlete_id)  # extend to today (no-op if already current)
+    since = (datetime.date.today() - datetime.timedelta(days=days - 1)).isoformat()
+    with get_db() as conn:
+        rows = conn.execute(
+            "SELECT day, load, ctl, atl, tsb FROM training_load WHERE athlete_id=? AND day>=? ORDER BY day",
+            (athlete_id, since),
+        ).fetchall()
+    return [dict(r) for r in rows]
+
+def _sparkline(values, color, width=600, height=60, vmax=None):
+    if len(values) < 2:
+        return ""
+    vmax = vmax or max(max(values), 1)
+    step = width / (len(values) - 1)
+    pts = " ".join(f"{i * step:.1f},{height - v / vmax * height:.1f}" for i, v in enumerate(values))
+    return f"<polyline fill='none' stroke='{color}' stroke-width='2' points='{pts}' />"
+
+def training_load_card(athlete_id, days=90):
+    series = training_load_series(athlete_id, days)
+    if not series:
+        return "<div class='l'>No load data yet.</div>"
+    cur = series[-1]
+    ctl = [r["ctl"] for r in series]
+    atl = [r["atl"] for r in series]
+    vmax = max(ctl + atl + [1])
+    return f"""
+        <div class="grid">
+          <div class="card"><div class="k">{round(cur['ctl'])}</div><div class="l">Fitness (CTL)</div></div>
+          <div class="card"><div class="k">{round(cur['atl'])}</div><div class="l">Fatigue (ATL)</div></div>
+          <div class="card"><div class="k">{round(cur['tsb'])}</div><div class="l">Form (TSB)</div></div>
+        </div>
+        <svg viewBox="0 0 600 60" style="width:100%;height:60px" preserveAspectRatio="none">
+          {_sparkline(ctl, "#60a5fa", vmax=vmax)}{_sparkline(atl, "#f97316", vmax=vmax)}
+        </svg>
+        <div class="small">Last {days} days — <span style="color:#60a5fa">CTL</span> / <span style="color:#f97316">ATL</span></div>
+    """
+
+@app.route("/training-load.json")
+def training_load_json():
+    if "access_token" not in session:
+        return redirect(url_for("home"))
+    athlete_id = (session.get("athlete") or {}).get("id")
+    days = min(max(request.args.get("days", 180, type=int), 1), 3660)
+    return jsonify({"ok": True, "athlete_id": athlete_id, "series": training_load_series(athlete_id, days)})
+
+
+# === Route index (repeated-course detection) ===
+# Each GPS track is simplified (Douglas-Peucker) and indexed twice:
+#   - routes_rtree: R*Tree over the track bounding box
+#   - route_cells: geohash cells (precision 6, ~1.2 × 0.6 km) the track passes through
+# same_route() asks the R-tree for overlapping boxes, keeps candidates sharing most
+# cells, and only runs the discrete Fréchet distance on those few simplified polylines.
+ROUTE_SIMPLIFY_M = float(os.environ.get("ROUTE_SIMPLIFY_M", 25))
+ROUTE_MATCH_M = float(os.environ.get("ROUTE_MATCH_M", 150))
+ROUTE_CELL_PRECISION = 6
+ROUTE_MIN_CELL_OVERLAP = 0.6
+_EARTH_R = 6371000.0
+_GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+@schema_setup
+def ensure_route_tables():
+    with get_db() as conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS routes (
+            activity_id INTEGER PRIMARY KEY,
+            athlete_id INTEGER,
+            length_m REAL,
+            n_cells INTEGER,
+            polyline_json TEXT
+        );""")
+        conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS routes_rtree USING rtree(
+            activity_id, min_lat, max_lat, min_lng, max_lng
+        );""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS route_cells (
+            cell TEXT,
+            activity_id INTEGER,
+            PRIMARY KEY (cell, activity_id)
+        ) WITHOUT ROWID;""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_route_cells_activity ON route_cells(activity_id)")
+        conn.commit()
+
+def geohash(lat, lng, precision=ROUTE_CELL_PRECISION):
+    lat_rng, lng_rng = [-90.0, 90.0], [-180.0, 180.0]
+    out, bits, ch, even = [], 0, 0, True
+    while len(out) < precision:
+        rng, val = (lng_rng, lng) if even else (lat_rng, lat)
+        mid = (rng[0] + rng[1]) / 2
+        ch <<= 1
+        if val >= mid:
+            ch |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            out.append(_GEOHASH_ALPHABET[ch])
+            bits, ch = 0, 0
+    return "".join(out)
+
+def _project(points, lat0):
+    """(lat, lng) → local equirectangular meters around lat0 (plenty for ride-sized tracks)."""
+    kx = math.cos(math.radians(lat0)) * _EARTH_R * math.pi / 180
+    ky = _EARTH_R * math.pi / 180
+    return [(lng * kx, lat * ky) for lat, lng in points]
+
+def _seg_dist(p, a, b):
+    (px, py), (ax, ay), (bx, by) = p, a, b
+    dx, dy = bx - ax, by - ay
+    if dx == dy == 0:
+        return math.hypot(px - ax, py - ay)
+    t = max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / (dx * dx + dy * dy)))
+    return math.hypot(px - ax - t * dx, py - ay - t * dy)
+
+def simplify(points, tolerance):
+    """Douglas-Peucker (iterative) over projected points; returns kept indices."""
+    n = len(points)
+    if n < 3:
+        return list(range(n))
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        i, j = stack.pop()
+        best, idx = 0.0, None
+        for k in range(i + 1, j):
+            d = _seg_dist(points[k], points[i], points[j])
+            if d > best:
+                best, idx = d, k
+        if idx is not None and best > tolerance:
+            keep[idx] = True
+            stack.append((i, idx))
+            stack.append((idx, j))
+    return [i for i in range(n) if keep[i]]
+
+def frechet(p, q, limit=None, band=None):
+    """
+    Discrete Fréchet distance between projected polylines (two DP rows).
+    band limits couplings to |i - j| <= band (both tracks resampled to similar lengths),
+    limit abandons early once every cell of a row exceeds it.
+    """
+    if not p or not q:
+        return float("inf")
+    inf = float("inf")
+    hypot = math.hypot
+    m = len(q)
+    prev = [inf] * m
+    for i, (ax, ay) in enumerate(p):
+        row = [inf] * m
+        lo, hi = (0, m) if band is None else (max(0, i - band), min(m, i + band + 1))
+        left = inf  # row[j - 1]
+        row_min = inf
+        for j in range(lo, hi):
+            bx, by = q[j]
+            d = hypot(ax - bx, ay - by)
+            if i == 0 and j == 0:
+                best = 0.0
+            else:
+                best = left
+                if j and prev[j - 1] < best:
+                    best = prev[j - 1]
+                if prev[j] < best:
+                    best = prev[j]
+            left = d if d > best else best
+            row[j] = left
+            if left < row_min:
+                row_min = left
+        if limit is not None and row_min > limit:
+            return inf
+        prev = row
+    return prev[-1]
+
+def resample(xy, n):
+    """n points evenly spaced along a projected polyline (so discrete Fréchet ≈ continuous)."""
+    if len(xy) < 2 or n < 2:
+        return list(xy)
+    cum = [0.0]
+    for i in range(1, len(xy)):
+        cum.append(cum[-1] + math.hypot(xy[i][0] - xy[i - 1][0], xy[i][1] - xy[i - 1][1]))
+    total = cum[-1] or 1.0
+    out, j = [], 0
+    for k in range(n):
+        target = total * k / (n - 1)
+        while j < len(xy) - 2 and cum[j + 1] < target:
+            j += 1
+        seg = (cum[j + 1] - cum[j]) or 1.0
+        t = min(max((target - cum[j]) / seg, 0.0), 1.0)
+        out.append((xy[j][0] + t * (xy[j + 1][0] - xy[j][0]), xy[j][1] + t * (xy[j + 1][1] - xy[j][1])))
+    return out
+
+def _track_points(lat, lng):
+    return [(a, b) for a, b in zip(lat, lng) if a is not None and b is not None]
+
+def index_route(athlete_id, activity_id, lat, lng):
+    pts = _track_points(lat, lng)
+    if len(pts) < 2:
+        return False
+    xy = _project(pts, pts[0][0])
+    kept = simplify(xy, ROUTE_SIMPLIFY_M)
+    poly = [[round(pts[i][0], 5), round(pts[i][1], 5)] for i in kept]
+    length = sum(math.hypot(xy[i][0] - xy[i - 1][0], xy[i][1] - xy[i - 1][1]) for i in range(1, len(xy)))
+    cells = {geohash(a, b) for a, b in pts}
+    lats, lngs = [p[0] for p in pts], [p[1] for p in pts]
+    with get_db() as conn:
+        conn.execute("DELETE FROM route_cells WHERE activity_id=?", (activity_id,))
+        conn.execute("DELETE FROM routes_rtree WHERE activity_id=?", (activity_id,))
+        conn.execute(
+            """INSERT INTO routes (activity_id, athlete_id, length_m, n_cells, polyline_json) VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT(activity_id) DO UPDATE SET athlete_id=excluded.athlete_id, length_m=excluded.length_m,
+                   n_cells=excluded.n_cells, polyline_json=excluded.polyline_json""",
+            (activity_id, athlete_id, length, len(cells), json.dumps(poly)),
+        )
+        conn.execute("INSERT INTO routes_rtree VALUES (?, ?, ?, ?, ?)",
+                     (activity_id, min(lats), max(lats), min(lngs), max(lngs)))
+        conn.executemany("INSERT OR IGNORE INTO route_cells (cell, activity_id) VALUES (?, ?)",
+                         [(c, activity_id) for c in cells])
+        conn.commit()
+    return True
+
+def unindex_route(activity_id):
+    with get_db() as conn:
+        conn.execute("DELETE FROM route_cells WHERE activity_id=?", (activity_id,))
+        conn.execute("DELETE FROM routes_rtree WHERE activity_id=?", (activity_id,))
+        conn.execute("DELETE FROM routes WHERE activity_id=?", (activity_id,))
+        conn.commit()
+
+def same_route(activity_id, athlete_id=None, max_dist_m=None):
+    """Activities on the same course as activity_id: [(activity_id, fréchet meters)], closest first."""
+    max_dist_m = max_dist_m or ROUTE_MATCH_M
+    with get_db() as conn:
+        me = conn.execute("SELECT * FROM routes WHERE activity_id=?", (activity_id,)).fetchone()
+        box = conn.execute("SELECT * FROM routes_rtree WHERE activity_id=?", (activity_id,)).fetchone()
+        if not me or not box:
+            return []
+        # degrees of slack so a slightly wider/narrower track still overlaps
+        pad = max_dist_m / 111000.0
+        cands = conn.execute(
+            """SELECT r.activity_id, r.length_m, r.n_cells, r.polyline_json, COUNT(c2.cell) AS shared
+               FROM routes_rtree t
+               JOIN routes r ON r.activity_id = t.activity_id
+               JOIN route_cells c2 ON c2.activity_id = r.activity_id
+               JOIN route_cells c1 ON c1.cell = c2.cell AND c1.activity_id = ?
+               WHERE t.min_lat <= ? AND t.max_lat >= ? AND t.min_lng <= ? AND t.max_lng >= ?
+                 AND t.min_lat >= ? AND t.max_lat <= ? AND t.min_lng >= ? AND t.max_lng <= ?
+                 AND r.activity_id != ? AND (? IS NULL OR r.athlete_id = ?)
+               GROUP BY r.activity_id""",
+            (activity_id,
+             box["min_lat"] + pad, box["max_lat"] - pad, box["min_lng"] + pad, box["max_lng"] - pad,
+             box["min_lat"] - pad, box["max_lat"] + pad, box["min_lng"] - pad, box["max_lng"] + pad,
+             activity_id, athlete_id, athlete_id),
+        ).fetchall()
+    mine = json.loads(me["polyline_json"])
+    lat0 = mine[0][0]
+    # Even spacing of ≤ 120 points; half the spacing is discretisation slack on the threshold.
+    # Same course + similar length → couplings stay near the diagonal (band of 20 %).
+    n = int(min(120, max(20, me["length_m"] / (max_dist_m / 2))))
+    slack = me["length_m"] / (n - 1) / 2
+    band = max(5, n // 5)
+    p = resample(_project(mine, lat0), n)
+    out = []
+    for c in cands:
+        overlap = c["shared"] / max(me["n_cells"], c["n_cells"], 1)
+        if overlap < ROUTE_MIN_CELL_OVERLAP:
+            continue
+        if abs(c["length_m"] - me["length_m"]) > 0.15 * max(me["length_m"], 1):
+            continue
+        q = resample(_project(json.loads(c["polyline_json"]), lat0), n)
+        # Fréchet >= distance between start points and between end points: cheap reject
+        if max(math.dist(p[0], q[0]), math.dist(p[-1], q[-1])) > max_dist_m + slack:
+            continue
+        d = frechet(p, q, limit=max_dist_m + slack, band=band)
+        if d <= max_dist_m + slack:
+            out.append((c["activity_id"], round(d, 1)))
+    return sorted(out, key=lambda x: x[1])
+
+@app.route("/activity/<int:activity_id>/same-route")
+def activity_same_route(activity_id):
+    if "access_token" not in session:
+        return redirect(url_for("home"))
+    athlete_id = (session.get("athlete") or {}).get("id")
+    row = get_activity(activity_id)
+    if not row or row["athlete_id"] != athlete_id:
+        return jsonify({"ok": False, "error": "unknown activity"}), 404
+    t0 = time.perf_counter()
+    matches = same_route(activity_id, athlete_id)
+    took_ms = round((time.perf_counter() - t0) * 1000, 1)
+    names = {}
+    if matches:
+        with get_db() as conn:
+            q = ",".join("?" * len(matches))
+            names = {r["id"]: r for r in conn.execute(
+                f"SELECT id, name, start_date_local FROM activities WHERE id IN ({q})", [m[0] for m in matches])}
+    return jsonify({
+        "ok": True,
+        "activity_id": activity_id,
+        "took_ms": took_ms,
+        "matches": [{
+            "activity_id": aid,
+            "frechet_m": d,
+            "name": names[aid]["name"] if aid in names else None,
+            "start_date_local": names[aid]["start_date_local"] if aid in names else None,
+            "link": strava_activity_link(aid),
+        } for aid, d in matches],
+    })
+
+
+# === Personal heatmap tiles ===
+# /heatmap/{z}/{x}/{y}.png is a file read once a tile is cached under
+# DATA_DIR/heatmap/<athlete>/z/x/y.png. Missing tiles are rasterized in a process
+# pool from heat_tracks (GPS tracks simplified to ~5 m), selected through the route
+# R-tree. Ingesting or deleting an activity only drops the cached tiles its track
+# crosses and re-renders those in the background. Each invalidation bumps a
+# per-athlete generation (meta 'heatmap_gen:<id>'); a render that started before
+# the bump never publishes its tile, so stale pixels can't land after the drop.
+# Each web worker owns its render pool, so HEATMAP_WORKERS defaults to that
+# worker's share of the host's cores rather than the whole machine.
+HEATMAP_DIR = os.path.join(DATA_DIR, "heatmap")
+HEATMAP_MIN_Z = 3
+HEATMAP_MAX_Z = 17
+HEATMAP_WORKERS = int(os.environ.get("HEATMAP_WORKERS", cores_per_web_worker()))
+HEATMAP_WAIT_S = float(os.environ.get("HEATMAP_WAIT_S", 5))  # then 503 + Retry-After
+HEAT_SIMPLIFY_M = 5.0
+TILE_SIZE = 256
+
+_heatmap_pool = None
+_heatmap_pool_lock = threading.Lock()
+_tile_renders = {}  # (athlete, z, x, y) → in-flight Future, so concurrent misses share one render
+_tile_renders_lock = threading.Lock()
+
+@schema_setup
+def ensure_heat_tracks_table():
+    with get_db() as conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS heat_tracks (
+            activity_id INTEGER PRIMARY KEY,
+            athlete_id INTEGER,
+            points_json TEXT
+        );""")
+        conn.commit()
+
+def heatmap_executor():
+    global _heatmap_pool
+    with _heatmap_pool_lock:
+        if _heatmap_pool is None:
+            _heatmap_pool = process_pool(HEATMAP_WORKERS)
+        return _heatmap_pool
+
+def tile_path(athlete_id, z, x, y):
+    return os.path.join(HEATMAP_DIR, str(athlete_id), str(z), str(x), f"{y}.png")
+
+def lnglat_to_pixel(lat, lng, z):
+    """Global Web Mercator pixel coordinates at zoom z."""
+    scale = TILE_SIZE * (1 << z)
+    lat = min(max(lat, -85.05112878), 85.05112878)
+    s = math.sin(math.radians(lat))
+    return (lng + 180.0) / 360.0 * scale, (0.5 - math.log((1 + s) / (1 - s)) / (4 * math.pi)) * scale
+
+def tile_bounds(z, x, y):
+    """(min_lat, max_lat, min_lng, max_lng) of a slippy-map tile."""
+    n = 1 << z
+    def lat(yy):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * yy / n))))
+    return lat(y + 1), lat(y), x / n * 360.0 - 180.0, (x + 1) / n * 360.0 - 180.0
+
+def tiles_for_track(points, z):
+    """Tiles at zoom z crossed by a track (segment walk, so long straight gaps are covered)."""
+    tiles = set()
+    prev = None
+    for lat, lng in points:
+        px, py = lnglat_to_pixel(lat, lng, z)
+        if prev:
+            steps = int(max(abs(px - prev[0]), abs(py - prev[1])) // TILE_SIZE) + 1
+            for k in range(1, steps + 1):
+                tx = prev[0] + (px - prev[0]) * k / steps
+                ty = prev[1] + (py - prev[1]) * k / steps
+                tiles.add((int(tx // TILE_SIZE), int(ty // TILE_SIZE)))
+        tiles.add((int(px // TILE_SIZE), int(py // TILE_SIZE)))
+        prev = (px, py)
+    return tiles
+
+def encode_png_rgba(width, height, pixels):
+    """pixels: bytes/bytearray of width*height*4 RGBA."""
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+    stride = width * 4
+    raw = b"".join(b"\x00" + bytes(pixels[r * stride:(r + 1) * stride]) for r in range(height))
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 6))
+            + chunk(b"IEND", b""))
+
+def rasterize_tile(tracks, z, x, y):
+    """Count how many tracks cross each pixel of the tile, colour on a log scale → PNG bytes."""
+    counts = [0] * (TILE_SIZE * TILE_SIZE)
+    ox, oy = x * TILE_SIZE, y * TILE_SIZE
+    for points in tracks:
+        hit = set()
+        prev = None
+        for lat, lng in points:
+            px, py = lnglat_to_pixel(lat, lng, z)
+            px, py = px - ox, py - oy
+            if prev is not None:
+                x0, y0 = prev
+                # skip segments entirely on one side of the tile
+                if not ((x0 < 0 and px < 0) or (y0 < 0 and py < 0)
+                        or (x0 >= TILE_SIZE and px >= TILE_SIZE) or (y0 >= TILE_SIZE and py >= TILE_SIZE)):
+                    steps = int(max(abs(px - x0), abs(py - y0))) + 1
+                    for k in range(steps + 1):
+                        ix = int(x0 + (px - x0) * k / steps)
+                        iy = int(y0 + (py - y0) * k / steps)
+                        if 0 <= ix < TILE_SIZE and 0 <= iy < TILE_SIZE:
+                            hit.add(iy * TILE_SIZE + ix)
+            prev = (px, py)
+        for i in hit:
+            counts[i] += 1
+    peak = max(counts) if counts else 0
+    pixels = bytearray(TILE_SIZE * TILE_SIZE * 4)
+    if peak:
+        norm = math.log1p(peak)
+        for i, c in enumerate(counts):
+            if c:
+                t = math.log1p(c) / norm
+                pixels[i * 4:i * 4 + 4] = bytes((255, int(90 + 165 * t), int(60 * t), int(140 + 115 * t)))
+    return encode_png_rgba(TILE_SIZE, TILE_SIZE, pixels)
+
+def store_heat_track(athlete_id, activity_id, lat, lng):
+    pts = _track_points(lat, lng)
+    if len(pts) < 2:
+        return
+    kept = simplify(_project(pts, pts[0][0]), HEAT_SIMPLIFY_M)
+    points = [[round(pts[i][0], 6), round(pts[i][1], 6)] for i in kept]
+    with get_db() as conn:
+        conn.execute(
+            """INSERT INTO heat_tracks (activity_id, athlete_id, points_json) VALUES (?, ?, ?)
+               ON CONFLICT(activity_id) DO UPDATE SET athlete_id=excluded.athlete_id, points_json=excluded.points_json""",
+            (activity_id, athlete_id, json.dumps(points)),
+        )
+        conn.commit()
+    invalidate_heatmap(athlete_id, points)
+
+def drop_heat_track(athlete_id, activity_id):
+    with get_db() as conn:
+        row = conn.execute("SELECT points_json FROM heat_tracks WHERE activity_id=?", (activity_id,)).fetchone()
+        conn.execute("DELETE FROM heat_tracks WHERE activity_id=?", (activity_id,))
+        conn.commit()
+    if row:
+        invalidate_heatmap(athlete_id, json.loads(row["points_json"]))
+
+def heatmap_generation(athlete_id):
+    return int(meta_get(f"heatmap_gen:{athlete_id}", 0))
+
+def invalidate_heatmap(athlete_id, points, rerender=True):
+    """Delete the cached tiles this track crosses; re-render them in the background."""
+    with get_db() as conn:
+        conn.execute(
+            """INSERT INTO meta(k, v) VALUES(?, 1)
+               ON CONFLICT(k) DO UPDATE SET v=CAST(v AS INTEGER) + 1""",
+            (f"heatmap_gen:{athlete_id}",),
+        )
+        conn.commit()
+    dropped = []
+    for z in range(HEATMAP_MIN_Z, HEATMAP_MAX_Z + 1):
+        for tx, ty in tiles_for_track(points, z):
+            path = tile_path(athlete_id, z, tx, ty)
+            try:
+                os.remove(path)
+                dropped.append((z, tx, ty))
+            except FileNotFoundError:
+                pass
+    if rerender and dropped:
+        for z, tx, ty in dropped:
+            submit_tile_render(athlete_id, z, tx, ty)
+    return dropped
+
+def tile_tracks(athlete_id, z, x, y):
+    min_lat, max_lat, min_lng, max_lng = tile_bounds(z, x, y)
+    with get_db() as conn:
+        rows = conn.execute(
+            """SELECT h.points_json FROM routes_rtree t
+               JOIN heat_tracks h ON h.activity_id = t.activity_id
+               WHERE h.athlete_id=? AND t.max_lat >= ? AND t.min_lat <= ? AND t.max_lng >= ? AND t.min_lng <= ?""",
+            (athlete_id, min_lat, max_lat, min_lng, max_lng),
+        ).fetchall()
+    return [json.loads(r["points_json"]) for r in rows]
+
+def render_tile_to_disk(athlete_id, z, x, y):
+    """
+    Process-pool worker: rasterize one tile and write it atomically. Returns its path,
+    or None when the athlete's heatmap was invalidated while rendering (tile discarded).
+    """
+    gen = heatmap_generation(athlete_id)
+    png = rasterize_tile(tile_tracks(athlete_id, z, x, y), z, x, y)
+    path = tile_path(athlete_id, z, x, y)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+    with os.fdopen(fd, "wb") as out:
+        out.write(png)
+    if heatmap_generation(athlete_id) != gen:
+        os.remove(tmp_path)
+        return None
+    os.replace(tmp_path, path)
+    if heatmap_generation(athlete_id) != gen:
+        # invalidated between the check and the rename: take it back, next request re-renders
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return None
+    return path
+
+def submit_tile_render(athlete_id, z, x, y):
+    key = (athlete_id, z, x, y)
+    pool = heatmap_executor()  # takes _heatmap_pool_lock; don't nest it under ours
+    with _tile_renders_lock:
+        fut = _tile_renders.get(key)
+        if fut is None:
+            fut = _tile_renders[key] = pool.submit(render_tile_to_disk, athlete_id, z, x, y)
+        else:
+            return fut
+
+    def forget(f):
+        with _tile_renders_lock:
+            if _tile_renders.get(key) is f:  # a newer render may own the key by now
+                del _tile_renders[key]
+    fut.add_done_callback(forget)
+    return fut
+
+@app.route("/heatmap/<int:z>/<int:x>/<int:y>.png")
+def heatmap_tile(z, x, y):
+    if "access_token" not in session:
+        return redirect(url_for("home"))
+    athlete_id = (session.get("athlete") or {}).get("id")
+    if not athlete_id or not (HEATMAP_MIN_Z <= z <= HEATMAP_MAX_Z) or not (0 <= x < (1 << z) and 0 <= y < (1 << z)):
+        return "", 404
+    path = tile_path(athlete_id, z, x, y)
+    if not os.path.exists(path):
+        from concurrent.futures import TimeoutError as FutureTimeout
+        try:
+            path = submit_tile_render(athlete_id, z, x, y).result(timeout=HEATMAP_WAIT_S)
+        except FutureTimeout:
+            path = None  # keeps rendering in the pool; the retry finds it on disk
+        if not path or not os.path.exists(path):
+            return "", 503, {"Retry-After": "2"}
+    resp = send_file(path, mimetype="image/png", max_age=3600)
+    resp.headers["Cache-Control"] = "private, max-age=3600"
+    return resp
+
+
+# === Club leaderboard (weekly totals across all connected athletes) ===
+# weekly_totals is a materialized per-athlete/week/sport aggregate of the local
+# activities table. A full rebuild aggregates each athlete in parallel (one SQLite
+# connection per thread) and merges the results; after that, every webhook event
+# only re-aggregates the one (athlete, week) it touched. The leaderboard is a
+# single indexed read, never a fan-out of live Strava calls.
+LEADERBOARD_WORKERS = int(os.environ.get("LEADERBOARD_WORKERS", 4))
+LEADERBOARD_METRICS = {
+    "distance": ("Distance", lambda v: f"{km(v)} km"),
+    "elevation": ("Elevation gain", lambda v: f"{int(v)} m"),
+    "moving_time": ("Moving time", fmt_hms),
+}
+
+@schema_setup
+def ensure_weekly_totals_table():
+    with get_db() as conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS weekly_totals (
+            athlete_id INTEGER,
+            week TEXT,
+            sport TEXT,
+            distance REAL,
+            elevation REAL,
+            moving_time INTEGER,
+            count INTEGER,
+            PRIMARY KEY (athlete_id, week, sport)
+        );""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_weekly_totals_week ON weekly_totals(week, sport)")
+        conn.commit()
+
+def week_start(day):
+    """Monday (YYYY-MM-DD) of the week containing day (YYYY-MM-DD)."""
+    d = datetime.date.fromisoformat(day[:10])
+    return (d - datetime.timedelta(days=d.weekday())).isoformat()
+
+def aggregate_weeks(athlete_id, week=None):
+    """[(athlete_id, week, sport, distance, elevation, moving_time, count)] from local activities."""
+    where, params = "athlete_id=? AND start_date_local IS NOT NULL", [athlete_id]
+    if week:
+        end = (datetime.date.fromisoformat(week) + datetime.timedelta(days=7)).isoformat()
+        where += " AND start_date_local >= ? AND start_date_local < ?"
+        params += [week, end]
+    with get_db() as conn:
+        rows = conn.execute(
+            f"SELECT start_date_local, sport_type, distance, total_elevation_gain, moving_time FROM activities WHERE {where}",
+            params,
+        ).fetchall()
+    agg = defaultdict(lambda: [0.0, 0.0, 0, 0])
+    for r in rows:
+        acc = agg[(week_start(r["start_date_local"]), r["sport_type"] or "Other")]
+        acc[0] += r["distance"] or 0
+        acc[1] += r["total_elevation_gain"] or 0
+        acc[2] += r["moving_time"] or 0
+        acc[3] += 1
+    return [(athlete_id, w, sport, *vals) for (w, sport), vals in agg.items()]
+
+def _write_weekly_totals(rows, athlete_id=None, week=None):
+    with get_db() as conn:
+        if athlete_id is not None and week is not None:
+            conn.execute("DELETE FROM weekly_totals WHERE athlete_id=? AND week=?", (athlete_id, week))
+        elif athlete_id is None:
+            conn.execute("DELETE FROM weekly_totals")
+        conn.executemany(
+            """INSERT OR REPLACE INTO weekly_totals
+               (athlete_id, week, sport, distance, elevation, moving_time, count) VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            rows,
+        )
+        conn.commit()
+
+def rebuild_weekly_totals():
+    """Full rebuild: per-athlete aggregation in parallel, merged into one write."""
+    from concurrent.futures import ThreadPoolExecutor
+    with get_db() as conn:
+        athletes = [r["athlete_id"] for r in conn.execute("SELECT DISTINCT athlete_id FROM activities")]
+    with ThreadPoolExecutor(max_workers=LEADERBOARD_WORKERS) as pool:
+        merged = [row for rows in pool.map(aggregate_weeks, athletes) for row in rows]
+    _write_weekly_totals(merged)
+    meta_set("weekly_totals_built", str(int(time.time())))
+    return len(merged)
+
+def refresh_weekly_totals(athlete_id, day):
+    """Incremental: re-aggregate only this athlete's week containing day."""
+    week = week_start(day)
+    _write_weekly_totals(aggregate_weeks(athlete_id, week), athlete_id, week)
+
+def club_leaderboard(week, sport=None, limit=20):
+    """{metric: [(athlete_id, name, value)]} for one week, optionally one sport."""
+    if not meta_get("weekly_totals_built"):
+        rebuild_weekly_totals()
+    where, params = "w.week=?", [week]
+    if sport:
+        where += " AND w.sport=?"
+        params.append(sport)
+    with get_db() as conn:
+        rows = conn.execute(
+            f"""SELECT w.athlete_id, u.firstname, u.lastname,
+                       SUM(w.distance) AS distance, SUM(w.elevation) AS elevation,
+                       SUM(w.moving_time) AS moving_time, SUM(w.count) AS count
+                FROM weekly_totals w LEFT JOIN users u ON u.athlete_id = w.athlete_id
+                WHERE {where} GROUP BY w.athlete_id""",
+            params,
+        ).fetchall()
+        sports = [r["sport"] for r in conn.execute(
+            "SELECT DISTINCT sport FROM weekly_totals WHERE week=? ORDER BY sport", (week,))]
+    board = {}
+    for metric in LEADERBOARD_METRICS:
+        ranked = sorted(rows, key=lambda r: -(r[metric] or 0))[:limit]
+        board[metric] = [{
+            "athlete_id": r["athlete_id"],
+            "name": f"{r['firstname'] or ''} {r['lastname'] or ''}".strip() or f"Athlete {r['athlete_id']}",
+            "value": r[metric] or 0,
+            "count": r["count"],
+        } for r in ranked]
+    return {"week": week, "sport": sport, "sports": sports, "board": board}
+
+def _leaderboard_args():
+    week = request.args.get("week") or datetime.date.today().isoformat()
+    try:
+        week = week_start(week)
+    except ValueError:
+        week = week_start(datetime.date.today().isoformat())
+    return week, request.args.get("sport") or None
+
+@app.route("/club/data.json")
+def club_data():
+    if "access_token" not in session:
+        return redirect(url_for("home"))
+    week, sport = _leaderboard_args()
+    return jsonify({"ok": True, **club_leaderboard(week, sport)})
+
+@app.route("/club")
+def club():
+    if "access_token" not in session:
+        return redirect(url_for("home"))
+    week, sport = _leaderboard_args()
+    data = club_leaderboard(week, sport)
+    prev_w = (datetime.date.fromisoformat(week) - datetime.timedelta(days=7)).isoformat()
+    next_w = (datetime.date.fromisoformat(week) + datetime.timedelta(days=7)).isoformat()
+
+    def club_url(w, s=None):
+        return escape("/club?" + urlencode({"week": w, **({"sport": s} if s else {})}))
+
+    def table(metric):
+        label, fmt = LEADERBOARD_METRICS[metric]
+        rows = "".join(
+            f"<tr><td>{i}</td><td>{escape(e['name'])}</td><td>{fmt(e['value'])}</td><td>{e['count']}</td></tr>"
+            for i, e in enumerate(data["board"][metric], 1)
+        )
+        return f"""
+        <div class="card">
+          <div class="k" style="font-size:18px;margin-bottom:6px">{label}</div>
+          <table><thead><tr><th>#</th><th>Athlete</th><th>{label}</th><th>Acts</th></tr></thead>
+          <tbody>{rows or "<tr><td colspan='4'>No activity this week.</td></tr>"}</tbody></table>
+        </div>"""
+
+    sport_links = " ".join(
+        f"<a class='a' href='{club_url(week, s)}'>{escape(s)}</a>" for s in data["sports"]
+    )
+    return html_head("Club leaderboard") + f"""
+    <div class="card">
+      <h1 class="title">🏆 Club leaderboard</h1>
+      <p class="subtitle">Week of {week} — {escape(sport) if sport else "all sports"}</p>
+      <div class="links">
+        <a class="a" href="{club_url(prev_w, sport)}">← Previous week</a>
+        <a class="a" href="{club_url(week)}">All sports</a> {sport_links}
+        <a class="a" href="{club_url(next_w, sport)}">Next week →</a>
+      </div>
+      <div class="grid">{table("distance")}{table("elevation")}{table("moving_time")}</div>
+      <div class="links"><a class="a" href="/">← Back</a></div>
+    </div>
+    """ + html_foot()
+
+@app.route("/admin/leaderboard/rebuild", methods=["POST"])
+@admin_required
+def admin_leaderboard_rebuild():
+    t0 = time.perf_counter()
+    n = rebuild_weekly_totals()
+    return {"ok": True, "rows": n, "took_ms": round((time.perf_counter() - t0) * 1000, 1)}
+
+
+# === Strava GET response cache ===
+# strava_get() puts a disk cache (its own SQLite file in WAL mode, shared by all
+# gunicorn workers) in front of Strava GETs, keyed by athlete + URL:
+#   - fresh entry (per-endpoint TTL)  → served locally, no API call
+#   - stale entry with ETag / Last-Modified → conditional request, 304 reuses the body
+#   - total size over HTTP_CACHE_MAX_BYTES → least recently used entries evicted
+# Per-endpoint hit / revalidation / miss counters show the rate-limit budget saved.
+HTTP_CACHE_PATH = os.environ.get("HTTP_CACHE_PATH", os.path.join(DATA_DIR, "http_cache.db"))
+HTTP_CACHE_MAX_BYTES = int(os.environ.get("HTTP_CACHE_MAX_BYTES", 64 * 1024 * 1024))  # 0 disables
+HTTP_CACHE_MAX_ITEM = 4 * 1024 * 1024
+# (endpoint name, path regex, TTL seconds); unmatched paths are not cached
+HTTP_CACHE_TTLS = [
+    ("athlete", re.compile(r"^/athlete$"), 600),
+    ("athlete_activities", re.compile(r"^/athlete/activities$"), 120),
+    ("activity_streams", re.compile(r"^/activities/\d+/streams$"), 0),
+    ("activity", re.compile(r"^/activities/\d+$"), 900),
+]
+_http_cache_ready = False
+
+def _cache_db():
+    global _http_cache_ready
+    conn = sqlite3.connect(HTTP_CACHE_PATH, timeout=10)
+    conn.row_factory = sqlite3.Row
+    if not _http_cache_ready:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS http_cache (
+            key TEXT PRIMARY KEY,
+            endpoint TEXT,
+            status INTEGER,
+            body BLOB,
+            content_type TEXT,
+            etag TEXT,
+            last_modified TEXT,
+            expires_at REAL,
+            last_access REAL,
+            size INTEGER
+        );""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_http_cache_access ON http_cache(last_access)")
+        conn.execute("""CREATE TABLE IF NOT EXISTS http_cache_stats (
+            endpoint TEXT PRIMARY KEY,
+            hits INTEGER DEFAULT 0,
+            revalidated INTEGER DEFAULT 0,
+            misses INTEGER DEFAULT 0
+        );""")
+        conn.commit()
+        _http_cache_ready = True
+    return conn
+
+class CachedResponse:
+    """The bits of requests.Response the callers use, rebuilt from a cache row."""
+    def __init__(self, status_code, content, content_type=None, from_cache=True):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {"Content-Type": content_type} if content_type else {}
+        self.from_cache = from_cache
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", "replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} (cached)")
+
+def _cache_endpoint(url):
+    path = urlsplit(url).path
+    if path.startswith(urlsplit(STRAVA_API_BASE).path):
+        path = path[len(urlsplit(STRAVA_API_BASE).path):]
+    for name, rx, ttl in HTTP_CACHE_TTLS:
+        if rx.match(path):
+            return name, ttl
+    return None, 0
+
+def _count(conn, endpoint, field):
+    conn.execute(
+        f"""INSERT INTO http_cache_stats (endpoint, {field}) VALUES (?, 1)
+            ON CONFLICT(endpoint) DO UPDATE SET {field}={field}+1""",
+        (endpoint,),
+    )
+
+def _evict(conn):
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM http_cache").fetchone()[0]
+    if total <= HTTP_CACHE_MAX_BYTES:
+        return 0
+    target = int(HTTP_CACHE_MAX_BYTES * 0.9)
+    evicted = 0
+    for row in conn.execute("SELECT key, size FROM http_cache ORDER BY last_access").fetchall():
+        if total <= target:
+            break
+        conn.execute("DELETE FROM http_cache WHERE key=?", (row["key"],))
+        total -= row["size"]
+        evicted += 1
+    return evicted
+
+def strava_get(url, token, athlete_id=None, params=None, timeout=20, fresh=False):
+    """
+    GET a Strava API URL through the response cache. fresh=True skips the TTL
+    (still revalidates with ETag/Last-Modified). Returns a requests.Response or CachedResponse.
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    if params:
+        url = f"{url}{'&' if '?' in url else '?'}{urlencode(params)}"
+    endpoint, ttl = _cache_endpoint(url)
+    if not endpoint or ttl <= 0 or HTTP_CACHE_MAX_BYTES <= 0:
+        return http_session.get(url, headers=headers, timeout=timeout)
+    owner = athlete_id or hashlib.sha256(token.encode()).hexdigest()[:16]
+    key = f"{owner}|{url}"
+    now = time.time()
+    try:
+        with _cache_db() as conn:
+            row = conn.execute("SELECT * FROM http_cache WHERE key=?", (key,)).fetchone()
+            if row and not fresh and row["expires_at"] > now:
+                conn.execute("UPDATE http_cache SET last_access=? WHERE key=?", (now, key))
+                _count(conn, endpoint, "hits")
+                conn.commit()
+                return CachedResponse(row["status"], row["body"], row["content_type"])
+    except sqlite3.Error as e:
+        print("http cache read error:", e)
+        row = None
+
+    if row and row["etag"]:
+        headers["If-None-Match"] = row["etag"]
+    if row and row["last_modified"]:
+        headers["If-Modified-Since"] = row["last_modified"]
+    r = http_session.get(url, headers=headers, timeout=timeout)
+
+    try:
+        with _cache_db() as conn:
+            if r.status_code == 304 and row:
+                conn.execute("UPDATE http_cache SET expires_at=?, last_access=? WHERE key=?", (now + ttl, now, key))
+                _count(conn, endpoint, "revalidated")
+                conn.commit()
+                return CachedResponse(row["status"], row["body"], row["content_type"])
+            _count(conn, endpoint, "misses")
+            if r.status_code == 200 and len(r.content) <= HTTP_CACHE_MAX_ITEM:
+                conn.execute(
+                    """INSERT OR REPLACE INTO http_cache
+                       (key, endpoint, status, body, content_type, etag, last_modified, expires_at, last_access, size)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (key, endpoint, r.status_code, r.content, r.headers.get("Content-Type"),
+                     r.headers.get("ETag"), r.headers.get("Last-Modified"), now + ttl, now, len(r.content)),
+                )
+                _evict(conn)
+            conn.commit()
+    except sqlite3.Error as e:
+        print("http cache write error:", e)
+    return r
+
+def http_cache_report():
+    with _cache_db() as conn:
+        stats = [dict(r) for r in conn.execute("SELECT * FROM http_cache_stats ORDER BY endpoint")]
+        size = conn.execute("SELECT COUNT(*) AS n, COALESCE(SUM(size), 0) AS bytes FROM http_cache").fetchone()
+    for st in stats:
+        total = st["hits"] + st["revalidated"] + st["misses"]
+        st["hit_rate"] = round((st["hits"] + st["revalidated"]) / total, 3) if total else None
+        st["api_calls_saved"] = st["hits"]
+    return {
+        "entries": size["n"],
+        "bytes": size["bytes"],
+        "max_bytes": HTTP_CACHE_MAX_BYTES,
+        "api_calls_saved": sum(st["hits"] for st in stats),
+        "api_calls_made": sum(st["revalidated"] + st["misses"] for st in stats),
+        "endpoints": stats,
+    }
+
+@app.route("/admin/http_cache", methods=["GET", "POST"])
+@admin_required
+def admin_http_cache():
+    """GET: hit rates and saved API calls. POST ?clear=1: drop all cached responses."""
+    if request.method == "POST" and request.args.get("clear"):
+        with _cache_db() as conn:
+            conn.execute("DELETE FROM http_cache")
+            conn.commit()
+    return {"ok": True, **http_cache_report()}
+
+
+# === Activity search (FTS5) ===
+# activities_fts is an external-content FTS5 index over activities(name, description,
+# sport_type). Triggers keep it in step with every write to activities, so webhook
+# ingest, edits and deletes, and the summary sync from the stats page all reindex
+# for free. /search ranks with bm25 (name > description > sport) and pushes the
+# athlete/sport/date filters into the same SQL statement.
+SEARCH_PAGE_SIZE = 25
+
+@schema_setup
+def ensure_search_index():
+    with get_db() as conn:
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='activities_fts'"
+        ).fetchone()
+        conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS activities_fts USING fts5(
+            name, description, sport_type,
+            content='activities', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        );""")
+        conn.execute("""CREATE TRIGGER IF NOT EXISTS activities_fts_ai AFTER INSERT ON activities BEGIN
+            INSERT INTO activities_fts(rowid, name, description, sport_type)
+            VALUES (new.id, new.name, new.description, new.sport_type);
+        END;""")
+        conn.execute("""CREATE TRIGGER IF NOT EXISTS activities_fts_ad AFTER DELETE ON activities BEGIN
+            INSERT INTO activities_fts(activities_fts, rowid, name, description, sport_type)
+            VALUES ('delete', old.id, old.name, old.description, old.sport_type);
+        END;""")
+        conn.execute("""CREATE TRIGGER IF NOT EXISTS activities_fts_au
+            AFTER UPDATE OF name, description, sport_type ON activities BEGIN
+            INSERT INTO activities_fts(activities_fts, rowid, name, description, sport_type)
+            VALUES ('delete', old.id, old.name, old.description, old.sport_type);
+            INSERT INTO activities_fts(rowid, name, description, sport_type)
+            VALUES (new.id, new.name, new.description, new.sport_type);
+        END;""")
+        if not exists:
+            conn.execute("INSERT INTO activities_fts(activities_fts) VALUES ('rebuild')")
+        conn.commit()
+
+def sync_activity_summaries(athlete_id, acts):
+    """
+    Upsert activity list entries (summary payloads) so they are searchable and counted.
+    Only new or changed rows are written; detailed payloads/descriptions already stored
+    from webhook ingest are kept. Refreshes derived series for the touched days.
+    """
+    if not athlete_id or not acts:
+        return 0
+    fields = ("name", "sport_type", "start_date_local", "distance", "moving_time", "total_elevation_gain")
+    with get_db() as conn:
+        known = {}
+        ids = [a.get("id") for a in acts if a.get("id")]
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            for r in conn.execute(
+                f"SELECT id, {', '.join(fields)} FROM activities WHERE id IN ({','.join('?' * len(chunk))})", chunk
+            ):
+                known[r["id"]] = tuple(r[f] for f in fields)
+        changed = []
+        for a in acts:
+            row = (a.get("name"), a.get("sport_type") or a.get("type") or "Other", a.get("start_date_local"),
+                   a.get("distance") or 0, a.get("moving_time") or 0, a.get("total_elevation_gain") or 0)
+            if a.get("id") and known.get(a["id"]) != row:
+                changed.append((a, row))
+        conn.executemany(
+            """INSERT INTO activities (id, athlete_id, name, sport_type, start_date, start_date_local,
+                   distance, moving_time, elapsed_time, total_elevation_gain, summary_json, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(id) DO UPDATE SET
+                   name=excluded.name,
+                   sport_type=excluded.sport_type,
+                   start_date=excluded.start_date,
+                   start_date_local=excluded.start_date_local,
+                   distance=excluded.distance,
+                   moving_time=excluded.moving_time,
+                   elapsed_time=excluded.elapsed_time,
+                   total_elevation_gain=excluded.total_elevation_gain,
+                   updated_at=excluded.updated_at""",
+            [
+                (a["id"], athlete_id, row[0], row[1], a.get("start_date"), row[2], row[3], row[4],
+                 a.get("elapsed_time") or 0, row[5], json.dumps(a), int(time.time()))
+                for a, row in changed
+            ],
+        )
+        conn.commit()
+    # new days plus, for moved activities, the day they left
+    days = sorted({row[2][:10] for _a, row in changed if row[2]}
+                  | {known[a["id"]][2][:10] for a, _row in changed if a["id"] in known and known[a["id"]][2]})
+    if days:
+        update_training_load(athlete_id, days[0])
+        for week in sorted({week_start(d) for d in days}):
+            refresh_weekly_totals(athlete_id, week)
+        refresh_progress_days(athlete_id, days)
+    if changed:
+        rekey_best_efforts(athlete_id, [a["id"] for a, _row in changed])
+        rekey_climbs(athlete_id, [a["id"] for a, _row in changed])
+        refresh_sport_metrics(athlete_id, [a["id"] for a, _row in changed])
+    return len(changed)
+
+_SEARCH_FILTER = re.compile(r"\b(sport|after|before|year):(\S+)", re.I)
+_SEARCH_TERM = re.compile(r'"([^"]+)"|([\w]+)(\*?)', re.U)
+
+def parse_search(q):
+    """
+    'col de "la croix" sport:ride year:2023' → (FTS5 MATCH expression or None, filters).
+    Terms are quoted (no FTS syntax injection); a trailing * or the last word makes a prefix term.
+    """
+    filters = {}
+    for key, val in _SEARCH_FILTER.findall(q or ""):
+        filters[key.lower()] = val
+    text = _SEARCH_FILTER.sub(" ", q or "")
+    terms = []
+    for phrase, word, star in _SEARCH_TERM.findall(text):
+        if phrase:
+            terms.append('"' + phrase.replace('"', " ") + '"')
+        else:
+            terms.append([word, bool(star)])
+    if terms and isinstance(terms[-1], list) and not text.rstrip().endswith('"'):
+        terms[-1][1] = True
+    expr = " ".join(t if isinstance(t, str) else f'"{t[0]}"' + ("*" if t[1] else "") for t in terms)
+    return expr or None, filters
+
+def search_activities(athlete_id, q, sport=None, after=None, before=None, page=1, per_page=SEARCH_PAGE_SIZE):
+    """Ranked results for one athlete; query-string filters win over keyword filters."""
+    expr, filters = parse_search(q)
+    sport = sport or filters.get("sport")
+    after = after or filters.get("after")
+    before = before or filters.get("before")
+    if filters.get("year", "").isdigit():
+        after = after or f"{filters['year']}-01-01"
+        before = before or f"{int(filters['year']) + 1}-01-01"
+    where, params = ["a.athlete_id=?"], [athlete_id]
+    if sport:
+        where.append("a.sport_type=? COLLATE NOCASE")
+        params.append(sport)
+    if after:
+        where.append("a.start_date_local>=?")
+        params.append(after)
+    if before:
+        where.append("a.start_date_local<?")
+        params.append(before)
+    cols = ("a.id, a.name, a.sport_type, a.start_date_local, a.distance, a.moving_time, "
+            "a.total_elevation_gain")
+    if expr:
+        sql = f"""SELECT {cols},
+                      highlight(activities_fts, 0, char(2), char(3)) AS name_hl,
+                      snippet(activities_fts, 1, char(2), char(3), '…', 12) AS snippet
+                  FROM activities_fts JOIN activities a ON a.id = activities_fts.rowid
+                  WHERE activities_fts MATCH ? AND {' AND '.join(where)}
+                  ORDER BY bm25(activities_fts, 10.0, 2.0, 1.0), a.start_date_local DESC
+                  LIMIT ? OFFSET ?"""
+        params = [expr] + params
+    else:
+        sql = f"""SELECT {cols}, a.name AS name_hl, NULL AS snippet FROM activities a
+                  WHERE {' AND '.join(where)} ORDER BY a.start_date_local DESC LIMIT ? OFFSET ?"""
+    page = max(1, page)
+    t0 = time.perf_counter()
+    with get_db() as conn:
+        try:
+            rows = conn.execute(sql, params + [per_page + 1, (page - 1) * per_page]).fetchall()
+        except sqlite3.OperationalError as e:
+            print("search error:", e, repr(expr))
+            rows = []
+    return {
+        "query": q, "match": expr, "sport": sport, "after": after, "before": before,
+        "page": page, "per_page": per_page, "has_more": len(rows) > per_page,
+        "took_ms": round((time.perf_counter() - t0) * 1000, 2),
+        "results": [dict(r) for r in rows[:per_page]],
+    }
+
+def _search_args():
+    try:
+        page = int(request.args.get("page", 1))
+    except ValueError:
+        page = 1
+    return dict(
+        q=request.args.get("q", ""),
+        sport=request.args.get("sport") or None,
+        after=request.args.get("after") or None,
+        before=request.args.get("before") or None,
+        page=page,
+    )
+
+@app.route("/search.json")
+def search_data():
+    if "access_token" not in session:
+        return redirect(url_for("home"))
+    athlete_id = (session.get("athlete") or {}).get("id")
+    data = search_activities(athlete_id, **_search_args())
+    for r in data["results"]:
+        for k in ("name_hl", "snippet"):
+            if r[k]:
+                r[k] = r[k].replace("\x02", "[").replace("\x03", "]")
+    return jsonify({"ok": True, **data})
+
+@app.route("/search")
+def search():
+    if "access_token" not in session:
+        return redirect(url_for("home"))
+    athlete_id = (session.get("athlete") or {}).get("id")
+    args = _search_args()
+    data = search_activities(athlete_id, **args) if any(v for k, v in args.items() if k != "page") else None
+
+    def marked(s):
+        return str(escape(s or "")).replace("\x02", "<mark>").replace("\x03", "</mark>")
+
+    rows, pager = "", ""
+    if data:
+        for r in data["results"]:
+            link = strava_activity_link(r["id"])
+            snippet = f"<div style='opacity:.7;font-size:13px'>{marked(r['snippet'])}</div>" if r["snippet"] else ""
+            rows += (f"<tr><td><a class='a' href='{link}' target='_blank'>{marked(r['name_hl']) or '(untitled)'}</a>{snippet}</td>"
+                     f"<td class='badge'>{escape(r['sport_type'] or '')}</td><td>{(r['start_date_local'] or '')[:10]}</td>"
+                     f"<td>{km(r['distance'])} km</td><td>{fmt_hms(r['moving_time'])}</td></tr>")
+        base = {k: v for k, v in args.items() if v and k != "page"}
+        if data["page"] > 1:
+            pager += f"<a class='a' href='/search?{urlencode({**base, 'page': data['page'] - 1})}'>← Previous</a>"
+        if data["has_more"]:
+            pager += f"<a class='a' href='/search?{urlencode({**base, 'page': data['page'] + 1})}'>Next →</a>"
+    status = (f"Page {data['page']} · {len(data['results'])} results · {data['took_ms']} ms" if data else
+              "Try a name or word from a description. Filters: sport:Ride year:2024 after:2024-05-01 before:2024-06-01")
+    return html_head("Search activities") + f"""
+    <div class="card">
+      <h1 class="title">🔎 Search activities</h1>
+      <form method="get" action="/search">
+        <input name="q" value="{escape(args['q'])}" placeholder="col du…" autofocus style="width:70%" />
+        <button class="btn" type="submit">Search</button>
+      </form>
+      <p class="subtitle">{status}</p>
+      <table>
+        <thead><tr><th>Name</th><th>Sport</th><th>Date</th><th>Distance</th><th>Moving time</th></tr></thead>
+        <tbody>{rows or ("<tr><td colspan='5'>No matching activities.</td></tr>" if data else "")}</tbody>
+      </table>
+      <div class="links">{pager}<a class="a" href="/">← Back</a></div>
+    </div>
+    """ + html_foot()
+
+
+# === Best efforts & personal records ===
+# best_efforts is a regular metric (so ingest, lazy recompute and the backfill pool all
+# produce it): fastest elapsed time over each standard distance, found with a two-pointer
+# scan of the time/distance streams and interpolated to the exact distance.
+# store_metrics() mirrors the result into the best_efforts table and updates
+# personal_records (all-time + per-year, per sport) in place; only when the current
+# holder is deleted or got slower is that one record re-derived, from the indexed table.
+BEST_EFFORT_DISTANCES = [("1k", 1000.0), ("5k", 5000.0), ("10k", 10000.0),
+                         ("half", 21097.5), ("marathon", 42195.0)]
+
+@schema_setup
+def ensure_records_tables():
+    with get_db() as conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS best_efforts (
+            activity_id INTEGER,
+            athlete_id INTEGER,
+            sport TEXT,
+            effort TEXT,
+            seconds REAL,
+            start_offset REAL,
+            day TEXT,
+            PRIMARY KEY (activity_id, effort)
+        );""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_best_efforts_rank ON best_efforts(athlete_id, sport, effort, seconds)")
+        conn.execute("""CREATE TABLE IF NOT EXISTS personal_records (
+            athlete_id INTEGER,
+            sport TEXT,
+            effort TEXT,
+            scope TEXT,           -- 'all' or a year 'YYYY'
+            seconds REAL,
+            activity_id INTEGER,
+            day TEXT,
+            PRIMARY KEY (athlete_id, sport, effort, scope)
+        );""")
+        conn.commit()
+
+def fastest_segments(t, d, distances=BEST_EFFORT_DISTANCES):
+    """
+    {name: (seconds, start_s, end_s)} fastest elapsed time covering each distance.
+    One O(n) two-pointer pass per distance: i trails j so d[i] <= d[j] - D < d[i+1].
+    """
+    pts = [(ti, di) for ti, di in zip(t or [], d or []) if ti is not None and di is not None]
+    if len(pts) < 2:
+        return {}
+    ts = [p[0] for p in pts]
+    ds, run = [], 0.0
+    for _t, di in pts:  # GPS glitches can make distance step back; keep it monotonic
+        run = max(run, di)
+        ds.append(run)
+    out = {}
+    n = len(ds)
+    for name, dist in distances:
+        if ds[-1] - ds[0] < dist:
+            continue
+        best, i = None, 0
+        for j in range(1, n):
+            target = ds[j] - dist
+            if target < ds[0]:
+                continue
+            while ds[i + 1] <= target:
+                i += 1
+            d0, d1 = ds[i], ds[i + 1]
+            start = ts[i] + (ts[i + 1] - ts[i]) * ((target - d0) / (d1 - d0) if d1 > d0 else 0.0)
+            el = ts[j] - start
+            if best is None or el < best[0]:
+                best = (el, start, ts[j])
+        if best:
+            out[name] = tuple(round(x, 1) for x in best)
+    return out
+
+@metric("best_efforts")
+def m_best_efforts(streams, activity, settings, computed):
+    found = fastest_segments(streams.get("time"), streams.get("distance"))
+    return {name: {"seconds": s, "start_s": a, "end_s": b} for name, (s, a, b) in found.items()} or None
+
+def _best_record(conn, athlete_id, sport, effort, scope):
+    sql = "SELECT activity_id, seconds, day FROM best_efforts WHERE athlete_id=? AND sport=? AND effort=?"
+    params = [athlete_id, sport, effort]
+    if scope != "all":
+        sql += " AND day>=? AND day<?"
+        params += [f"{scope}-01-01", f"{int(scope) + 1}-01-01"]
+    return conn.execute(sql + " ORDER BY seconds LIMIT 1", params).fetchone()
+
+def _rederive_records(conn, athlete_id, activity_id):
+    """Records held by activity_id are re-derived from best_efforts (or dropped)."""
+    held = conn.execute(
+        "SELECT sport, effort, scope FROM personal_records WHERE athlete_id=? AND activity_id=?",
+        (athlete_id, activity_id),
+    ).fetchall()
+    for r in held:
+        best = _best_record(conn, athlete_id, r["sport"], r["effort"], r["scope"])
+        if best:
+            conn.execute(
+                "UPDATE personal_records SET seconds=?, activity_id=?, day=? WHERE athlete_id=? AND sport=? AND effort=? AND scope=?",
+                (best["seconds"], best["activity_id"], best["day"], athlete_id, r["sport"], r["effort"], r["scope"]),
+            )
+        else:
+            conn.execute(
+                "DELETE FROM personal_records WHERE athlete_id=? AND sport=? AND effort=? AND scope=?",
+                (athlete_id, r["sport"], r["effort"], r["scope"]),
+            )
+
+def record_best_efforts(athlete_id, activity_id, efforts):
+    """Store one activity's best efforts and update the athlete's records incrementally."""
+    row = get_activity(activity_id)
+    sport = (row["sport_type"] if row else None) or "Other"
+    day = (row["start_date_local"] or "")[:10] if row else ""
+    with get_db() as conn:
+        conn.execute("DELETE FROM best_efforts WHERE activity_id=?", (activity_id,))
+        conn.executemany(
+            """INSERT INTO best_efforts (activity_id, athlete_id, sport, effort, seconds, start_offset, day)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            [(activity_id, athlete_id, sport, name, e["seconds"], e["start_s"], day or None)
+             for name, e in (efforts or {}).items()],
+        )
+        _rederive_records(conn, athlete_id, activity_id)  # in case this activity got slower / lost an effort
+        for name, e in (efforts or {}).items():
+            for scope in ("all", day[:4]) if day else ("all",):
+                conn.execute(
+                    """INSERT INTO personal_records (athlete_id, sport, effort, scope, seconds, activity_id, day)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)
+                       ON CONFLICT(athlete_id, sport, effort, scope) DO UPDATE SET
+                           seconds=excluded.seconds, activity_id=excluded.activity_id, day=excluded.day
+                       WHERE excluded.seconds < personal_records.seconds""",
+                    (athlete_id, sport, name, scope, e["seconds"], activity_id, day or None),
+                )
+        conn.commit()
+
+def rekey_best_efforts(athlete_id, activity_ids):
+    """
+    Efforts are keyed by the activity's sport/day at ingest time ('Other' / no day when
+    the summary wasn't available yet). When the activity row now says otherwise, move
+    them and re-derive the records of both the old and the new sport.
+    """
+    moved = []
+    with get_db() as conn:
+        for i in range(0, len(activity_ids), 500):
+            chunk = list(activity_ids[i:i + 500])
+            moved += [r[0] for r in conn.execute(
+                f"""SELECT DISTINCT b.activity_id FROM best_efforts b JOIN activities a ON a.id = b.activity_id
+                    WHERE b.activity_id IN ({','.join('?' * len(chunk))})
+                      AND (b.sport IS NOT COALESCE(a.sport_type, 'Other')
+                           OR b.day IS NOT NULLIF(substr(a.start_date_local, 1, 10), ''))""",
+                chunk,
+            )]
+        efforts = {
+            aid: {r["effort"]: {"seconds": r["seconds"], "start_s": r["start_offset"]}
+                  for r in conn.execute("SELECT effort, seconds, start_offset FROM best_efforts WHERE activity_id=?", (aid,))}
+            for aid in moved
+        }
+    for aid in moved:
+        record_best_efforts(athlete_id, aid, efforts[aid])  # _rederive_records covers the old sport
+    return moved
+
+def forget_best_efforts(athlete_id, activity_id):
+    with get_db() as conn:
+        conn.execute("DELETE FROM best_efforts WHERE activity_id=?", (activity_id,))
+        _rederive_records(conn, athlete_id, activity_id)
+        conn.commit()
+
+def personal_records(athlete_id, sport=None):
+    """{sport: {effort: {scope: record}}} straight from the records table."""
+    sql, params = "SELECT * FROM personal_records WHERE athlete_id=?", [athlete_id]
+    if sport:
+        sql += " AND sport=?"
+        params.append(sport)
+    out = defaultdict(lambda: defaultdict(dict))
+    with get_db() as conn:
+        for r in conn.execute(sql, params):
+            out[r["sport"]][r["effort"]][r["scope"]] = {
+                "seconds": r["seconds"], "activity_id": r["activity_id"], "day": r["day"]}
+    return {s: dict(e) for s, e in out.items()}
+
+def fmt_effort(seconds):
+    seconds = int(round(seconds or 0))
+    h, m, s = seconds // 3600, (seconds % 3600) // 60, seconds % 60
+    return f"{h}:{m:02d}:{s:02d}" if h else f"{m}:{s:02d}"
+
+@app.route("/records.json")
+def records_data():
+    if "access_token" not in session:
+        return redirect(url_for("home"))
+    athlete_id = (session.get("athlete") or {}).get("id")
+    return jsonify({"ok": True, "records": personal_records(athlete_id, request.args.get("sport") or None)})
+
+@app.route("/records")
+def records():
+    if "access_token" not in session:
+        return redirect(url_for("home"))
+    athlete_id = (session.get("athlete") or {}).get("id")
+    recs = personal_records(athlete_id)
+    cards = ""
+    for sport in sorted(recs):
+        years = sorted({sc for e in recs[sport].values() for sc in e if sc != "all"}, reverse=True)[:5]
+
+        def cell(rec, pace_km=None):
+            if not rec:
+                return "<td>—</td>"
+            pace = f"<div class='small'>{fmt_effort(rec['seconds'] / pace_km)}/km</div>" if pace_km else ""
+            return (f"<td><a class='a' href='{strava_activity_link(rec['activity_id'])}' target='_blank'>"
+                    f"{fmt_effort(rec['seconds'])}</a>{pace}</td>")
+
+        rows = ""
+        for name, dist in BEST_EFFORT_DISTANCES:
+            by_scope = recs[sport].get(name)
+            if by_scope:
+                rows += (f"<tr><td>{name}</td>{cell(by_scope.get('all'), dist / 1000)}"
+                         + "".join(cell(by_scope.get(y)) for y in years) + "</tr>")
+        cards += f"""
+        <div class="card">
+          <div class="k" style="font-size:18px;margin-bottom:6px">{escape(sport)}</div>
+          <table><thead><tr><th>Distance</th><th>All time</th>{''.join(f'<th>{y}</th>' for y in years)}</tr></thead>
+          <tbody>{rows}</tbody></table>
+        </div>"""
+    return html_head("Personal records") + f"""
+    <div class="card">
+      <h1 class="title">🏅 Personal records</h1>
+      <p class="subtitle">Fastest 1k / 5k / 10k / half / marathon inside any activity, all-time and per year.</p>
+      {cards or "<p>No best efforts yet — they are computed as activities are ingested.</p>"}
+      <div class="links"><a class="a" href="/">← Back</a></div>
+    </div>
+    """ + html_foot()
+
+
+# === Climb detection ===
+# Like best efforts, "climbs" is a registered metric mirrored into its own table by
+# store_metrics(). Detection works on a fixed 20 m distance grid:
+#   1. altitude (and grade_smooth when present) resampled onto the grid, then smoothed
+#      with an O(n) running-sum moving average (~200 m window)
+#   2. hysteresis: a climb starts once the road has risen CLIMB_START_GAIN above the
+#      low point and ends when it drops CLIMB_END_DROP below its high point (or stays
+#      flat for CLIMB_MAX_FLAT), so short dips and false flats don't split it
+#   3. flat lead-in/run-out trimmed, then small bumps filtered out
+# Each climb keeps its start/end coordinates; "same climb" = both ends within
+# CLIMB_MATCH_M and length within 15%, answered from idx_climbs_start.
+CLIMB_STEP_M = 20.0
+CLIMB_SMOOTH_M = 200.0
+CLIMB_START_GAIN = 10.0
+CLIMB_END_DROP = 15.0
+CLIMB_MAX_FLAT = 1000.0
+CLIMB_MIN_GAIN = 30.0
+CLIMB_MIN_GRADE = 3.0
+CLIMB_MATCH_M = 150.0
+# (category, min score = length m × avg grade %), Strava-style
+CLIMB_CATEGORIES = [("HC", 80000), ("1", 64000), ("2", 32000), ("3", 16000), ("4", 8000)]
+
+@schema_setup
+def ensure_climbs_table():
+    with get_db() as conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS climbs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            activity_id INTEGER,
+            athlete_id INTEGER,
+            sport TEXT,
+            day TEXT,
+            start_dist REAL,
+            length_m REAL,
+            gain_m REAL,
+            avg_grade REAL,
+            max_grade REAL,
+            duration_s REAL,
+            vam REAL,
+            score REAL,
+            category TEXT,
+            start_lat REAL, start_lng REAL,
+            end_lat REAL, end_lng REAL
+        );""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_climbs_activity ON climbs(activity_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_climbs_athlete_day ON climbs(athlete_id, day, score)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_climbs_start ON climbs(athlete_id, start_lat, start_lng)")
+        conn.commit()
+
+def resample_by_distance(d, v, step, start=None, count=None):
+    """
+    Linear interpolation of v onto the grid start, start + step… over distance d
+    (None/NaN-safe). Defaults to v's own span; with start/count, several streams land
+    on the same grid, values outside a stream's span clamped to its first/last sample.
+    """
+    pts = [(di, vi) for di, vi in zip(d or [], v or []) if di is not None and vi is not None and di == di and vi == vi]
+    if len(pts) < 2:
+        return None
+    out, k, x = [], 0, pts[0][0] if start is None else start
+    while len(out) < count if count is not None else x <= pts[-1][0]:
+        if x <= pts[0][0]:
+            out.append(pts[0][1])
+        elif x >= pts[-1][0]:
+            out.append(pts[-1][1])
+        else:
+            while pts[k + 1][0] < x:
+                k += 1
+            (d0, v0), (d1, v1) = pts[k], pts[k + 1]
+            out.append(v0 + (v1 - v0) * ((x - d0) / (d1 - d0)) if d1 > d0 else v0)
+        x += step
+    return out
+
+def _moving_average(values, window):
+    """Centered running-sum mean, O(n); the window shrinks at the edges."""
+    n, half = len(values), window // 2
+    prefix = [0.0]
+    for v in values:
+        prefix.append(prefix[-1] + v)
+    return [(prefix[min(n, i + half + 1)] - prefix[max(0, i - half)]) / (min(n, i + half + 1) - max(0, i - half))
+            for i in range(n)]
+
+def detect_climbs(streams):
+    """[{start_dist, length_m, gain_m, avg_grade, max_grade, duration_s, vam, category, start/end lat/lng}]."""
+    d = streams.get("distance")
+    alt = resample_by_distance(d, streams.get("altitude"), CLIMB_STEP_M)
+    if not alt or len(alt) < 10:
+        return []
+    win = max(1, int(CLIMB_SMOOTH_M / CLIMB_STEP_M))
+    h = _moving_average(alt, win)
+    n = len(h)
+    # every other stream goes on the altitude grid, so index i means the same spot everywhere
+    d0 = next(di for di, a in zip(d, streams.get("altitude"))
+              if di is not None and a is not None and di == di and a == a)
+    grade = resample_by_distance(d, streams.get("grade_smooth"), CLIMB_STEP_M, d0, n)
+    grade = _moving_average(grade, max(1, win // 2)) if grade else None
+    if grade:  # grid indices the grade stream really covers (outside it the values are clamped)
+        gd = [di for di, gv in zip(d, streams.get("grade_smooth"))
+              if di is not None and gv is not None and di == di and gv == gv]
+        g_lo, g_hi = math.ceil((gd[0] - d0) / CLIMB_STEP_M), math.floor((gd[-1] - d0) / CLIMB_STEP_M)
+    grid = {k: resample_by_distance(d, streams.get(k), CLIMB_STEP_M, d0, n) for k in ("time", "lat", "lng")}
+
+    # hysteresis segmentation → (low index, high index) pairs
+    segments, lo, hi = [], 0, None
+    for i in range(1, n):
+        if hi is None:
+            if h[i] < h[lo]:
+                lo = i
+            elif h[i] - h[lo] >= CLIMB_START_GAIN:
+                hi = i
+        elif h[i] > h[hi]:
+            hi = i
+        elif h[hi] - h[i] >= CLIMB_END_DROP or (i - hi) * CLIMB_STEP_M > CLIMB_MAX_FLAT:
+            segments.append((lo, hi))
+            lo, hi = i, None
+    if hi is not None:
+        segments.append((lo, hi))
+
+    span = max(1, int(100 / CLIMB_STEP_M))  # 100 m for trimming and max gradient
+    def g(a, b):
+        return (h[b] - h[a]) / ((b - a) * CLIMB_STEP_M) * 100
+
+    climbs = []
+    for s, e in segments:
+        while e - s > span and g(s, s + span) < 2.0:
+            s += 1
+        while e - s > span and g(e - span, e) < 2.0:
+            e -= 1
+        length, gain = (e - s) * CLIMB_STEP_M, h[e] - h[s]
+        if gain < CLIMB_MIN_GAIN or length <= 0 or gain / length * 100 < CLIMB_MIN_GRADE:
+            continue
+        if grade and g_lo <= s and e <= g_hi:
+            max_grade = max(grade[s:e + 1])
+        else:
+            max_grade = max(g(i, i + span) for i in range(s, max(s + 1, e - span + 1)))
+
+        def at(name, i):
+            vals = grid[name]
+            return vals[i] if vals else None
+
+        t0, t1 = at("time", s), at("time", e)
+        duration = (t1 - t0) if t0 is not None and t1 is not None else None
+        avg = gain / length * 100
+        score = length * avg
+        climbs.append({
+            "start_dist": round(d0 + s * CLIMB_STEP_M, 1), "length_m": round(length, 1), "gain_m": round(gain, 1),
+            "avg_grade": round(avg, 1), "max_grade": round(max_grade, 1),
+            "duration_s": round(duration, 1) if duration else None,
+            "vam": round(gain / duration * 3600) if duration else None,
+            "score": round(score), "category": next((c for c, m in CLIMB_CATEGORIES if score >= m), None),
+            "start_lat": at("lat", s), "start_lng": at("lng", s),
+            "end_lat": at("lat", e), "end_lng": at("lng", e),
+        })
+    return climbs
+
+@metric("climbs")
+def m_climbs(streams, activity, settings, computed):
+    return detect_climbs(streams) or None
+
+def record_climbs(athlete_id, activity_id, climbs):
+    row = get_activity(activity_id)
+    sport = (row["sport_type"] if row else None) or "Other"
+    day = ((row["start_date_local"] or "")[:10] if row else "") or None
+    cols = ("start_dist", "length_m", "gain_m", "avg_grade", "max_grade", "duration_s", "vam",
+            "score", "category", "start_lat", "start_lng", "end_lat", "end_lng")
+    with get_db() as conn:
+        conn.execute("DELETE FROM climbs WHERE activity_id=?", (activity_id,))
+        conn.executemany(
+            f"""INSERT INTO climbs (activity_id, athlete_id, sport, day, {', '.join(cols)})
+                VALUES (?, ?, ?, ?, {', '.join('?' * len(cols))})""",
+            [(activity_id, athlete_id, sport, day, *(c.get(k) for k in cols)) for c in climbs or []],
+        )
+        conn.commit()
+
+def rekey_climbs(athlete_id, activity_ids):
+    """Climbs follow their activity's current sport/day (see rekey_best_efforts)."""
+    with get_db() as conn:
+        for i in range(0, len(activity_ids), 500):
+            chunk = list(activity_ids[i:i + 500])
+            conn.execute(
+                f"""UPDATE climbs SET
+                        sport=(SELECT COALESCE(a.sport_type, 'Other') FROM activities a WHERE a.id = climbs.activity_id),
+                        day=(SELECT NULLIF(substr(a.start_date_local, 1, 10), '') FROM activities a WHERE a.id = climbs.activity_id)
+                    WHERE athlete_id=? AND activity_id IN ({','.join('?' * len(chunk))})
+                      AND EXISTS (SELECT 1 FROM activities a WHERE a.id = climbs.activity_id)""",
+                [athlete_id, *chunk],
+            )
+        conn.commit()
+
+def top_climbs(athlete_id, year, limit=20):
+    with get_db() as conn:
+        return [dict(r) for r in conn.execute(
+            """SELECT c.*, a.name AS activity_name FROM climbs c LEFT JOIN activities a ON a.id = c.activity_id
+               WHERE c.athlete_id=? AND c.day>=? AND c.day<? ORDER BY c.score DESC LIMIT ?""",
+            (athlete_id, f"{year}-01-01", f"{year + 1}-01-01", limit),
+        )]
+
+def climb_efforts(athlete_id, climb_id):
+    """Every ascent of the same climb by this athlete (both ends within CLIMB_MATCH_M), fastest first."""
+    with get_db() as conn:
+        ref = conn.execute("SELECT * FROM climbs WHERE id=? AND athlete_id=?", (climb_id, athlete_id)).fetchone()
+        if not ref:
+            return None, []
+        if ref["start_lat"] is None or ref["end_lat"] is None:  # indoor / no GPS: only itself
+            return dict(ref), [dict(ref)]
+        dlat = CLIMB_MATCH_M / 111320.0
+        dlng = dlat / max(0.01, math.cos(math.radians(ref["start_lat"])))
+        elat = CLIMB_MATCH_M / 111320.0
+        elng = elat / max(0.01, math.cos(math.radians(ref["end_lat"])))
+        rows = conn.execute(
+            """SELECT c.*, a.name AS activity_name FROM climbs c LEFT JOIN activities a ON a.id = c.activity_id
+               WHERE c.athlete_id=? AND c.start_lat BETWEEN ? AND ? AND c.start_lng BETWEEN ? AND ?
+                 AND c.end_lat BETWEEN ? AND ? AND c.end_lng BETWEEN ? AND ?
+                 AND c.length_m BETWEEN ? AND ?
+               ORDER BY c.duration_s IS NULL, c.duration_s, c.day""",
+            (athlete_id,
+             ref["start_lat"] - dlat, ref["start_lat"] + dlat, ref["start_lng"] - dlng, ref["start_lng"] + dlng,
+             ref["end_lat"] - elat, ref["end_lat"] + elat, ref["end_lng"] - elng, ref["end_lng"] + elng,
+             ref["length_m"] * 0.85, ref["length_m"] * 1.15),
+        ).fetchall()
+    return dict(ref), [dict(r) for r in rows]
+
+def _climb_row(c, link_climb=True):
+    name = escape(c.get("activity_name") or f"Activity {c['activity_id']}")
+    cat = c["category"]
+    label = "HC" if cat == "HC" else f"Cat {cat}" if cat else "—"
+    if link_climb:
+        label = f"<a class='a' href='/climbs/{c['id']}'>{label}</a>"
+    return (f"<tr><td>{label}</td><td>{(c['day'] or '')}</td>"
+            f"<td><a class='a' href='{strava_activity_link(c['activity_id'])}' target='_blank'>{name}</a></td>"
+            f"<td>{km(c['length_m'])} km</td><td>{int(c['gain_m'])} m</td><td>{c['avg_grade']}% / {c['max_grade']}%</td>"
+            f"<td>{fmt_effort(c['duration_s']) if c['duration_s'] else '—'}</td><td>{c['vam'] or '—'}</td></tr>")
+
+_CLIMB_HEAD = ("<thead><tr><th>Cat.</th><th>Date</th><th>Activity</th><th>Length</th><th>Gain</th>"
+               "<th>Avg / max</th><th>Time</th><th>VAM</th></tr></thead>")
+
+@app.route("/climbs.json")
+def climbs_data():
+    if "access_token" not in session:
+        return redirect(url_for("home"))
+    athlete_id = (session.get("athlete") or {}).get("id")
+    year = request.args.get("year", datetime.date.today().year, type=int)
+    return jsonify({"ok": True, "year": year, "climbs": top_climbs(athlete_id, year)})
+
+@app.route("/climbs")
+def climbs_page():
+    if "access_token" not in session:
+        return redirect(url_for("home"))
+    athlete_id = (session.get("athlete") or {}).get("id")
+    year = request.args.get("year", datetime.date.today().year, type=int)
+    rows = "".join(_climb_row(c) for c in top_climbs(athlete_id, year))
+    return html_head("Top climbs") + f"""
+    <div class="card">
+      <h1 class="title">⛰️ Top climbs {year}</h1>
+      <p class="subtitle">Ranked by length × average gradient. Click a category to see every ascent of that climb.</p>
+      <div class="links"><a class="a" href="/climbs?year={year - 1}">← {year - 1}</a>
+        <a class="a" href="/climbs?year={year + 1}">{year + 1} →</a></div>
+      <table>{_CLIMB_HEAD}<tbody>{rows or "<tr><td colspan='8'>No climbs detected this year.</td></tr>"}</tbody></table>
+      <div class="links"><a class="a" href="/">← Back</a></div>
+    </div>
+    """ + html_foot()
+
+@app.route("/climbs/<int:climb_id>.json")
+def climb_efforts_data(climb_id):
+    if "access_token" not in session:
+        return redirect(url_for("home"))
+    ref, efforts = climb_efforts((session.get("athlete") or {}).get("id"), climb_id)
+    if not ref:
+        return jsonify({"ok": False, "error": "unknown climb"}), 404
+    return jsonify({"ok": True, "climb": ref, "efforts": efforts})
+
+@app.route("/climbs/<int:climb_id>")
+def climb_efforts_page(climb_id):
+    if "access_token" not in session:
+        return redirect(url_for("home"))
+    ref, efforts = climb_efforts((session.get("athlete") or {}).get("id"), climb_id)
+    if not ref:
+        return "Unknown climb", 404
+    rows = "".join(_climb_row(c, link_climb=False) for c in efforts)
+    return html_head("Climb history") + f"""
+    <div class="card">
+      <h1 class="title">⛰️ {km(ref['length_m'])} km at {ref['avg_grade']}%</h1>
+      <p class="subtitle">{len(efforts)} ascents, fastest first.</p>
+      <table>{_CLIMB_HEAD}<tbody>{rows}</tbody></table>
+      <div class="links"><a class="a" href="/climbs">← Top climbs</a></div>
+    </div>
+    """ + html_foot()
+
+
+# === Background scheduler (one leader across workers) ===
+# Every worker runs a small loop thread (started from gunicorn's post_worker_init,
+# or the local-dev __main__), but only the holder of the "scheduler_lease" row in
+# meta runs jobs. The lease is taken/renewed with one conditional UPSERT (expired
+# or already ours), so it's atomic across processes; a leader that dies simply stops
+# renewing and another worker takes over after SCHEDULER_LEASE_S. Job schedules
+# (next_run) live in scheduler_jobs, so a new leader continues where the old one stopped.
+# Jobs are cron-like ("m h dom mon dow", UTC) with a random jitter added to each slot;
+# every run lands in scheduler_runs with its duration and outcome.
+SCHEDULER_ENABLED = os.environ.get("SCHEDULER_ENABLED", "1") == "1"
+SCHEDULER_LEASE_S = int(os.environ.get("SCHEDULER_LEASE_S", 60))
+SCHEDULER_TICK_S = int(os.environ.get("SCHEDULER_TICK_S", 15))
+SCHEDULER_HISTORY = 2000
+_OWNER_NONCE = os.urandom(3).hex()
+JOBS = {}  # name -> {"cron", "jitter", "fn", "fields"}
+_scheduler_stop = threading.Event()
+_scheduler_thread = None
+
+@schema_setup
+def ensure_scheduler_tables():
+    with get_db() as conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS scheduler_jobs (
+            name TEXT PRIMARY KEY,
+            next_run REAL,
+            last_run REAL,
+            last_ok INTEGER,
+            runs INTEGER DEFAULT 0,
+            failures INTEGER DEFAULT 0,
+            total_ms REAL DEFAULT 0
+        );""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS scheduler_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job TEXT,
+            owner TEXT,
+            started_at REAL,
+            duration_ms REAL,
+            ok INTEGER,
+            result TEXT
+        );""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_scheduler_runs_job ON scheduler_runs(job, id)")
+        conn.commit()
+
+def scheduler_owner():
+    # computed per call: with preload_app the module is imported before the fork
+    return f"{socket.gethostname()}:{os.getpid()}:{_OWNER_NONCE}"
+
+def _cron_field(spec, lo, hi):
+    """'*', '*/n', 'a-b', 'a-b/n', 'a,b,c' → set of allowed values."""
+    out = set()
+    for part in spec.split(","):
+        rng, _, step = part.partition("/")
+        a, b = (lo, hi) if rng == "*" else map(int, rng.split("-")) if "-" in rng else (int(rng), int(rng))
+        out.update(range(a, b + 1, int(step or 1)))
+    return out
+
+def parse_cron(expr):
+    m, h, dom, mon, dow = expr.split()
+    return (_cron_field(m, 0, 59), _cron_field(h, 0, 23), _cron_field(dom, 1, 31),
+            _cron_field(mon, 1, 12), {d % 7 for d in _cron_field(dow, 0, 7)})
+
+def next_cron(fields, after):
+    """First matching minute (UTC epoch) strictly after `after`; skips whole days/hours."""
+    minutes, hours, doms, mons, dows = fields
+    t = datetime.datetime.fromtimestamp(after, datetime.timezone.utc).replace(second=0, microsecond=0)
+    t += datetime.timedelta(minutes=1)
+    for _ in range(366 * 24 * 60):
+        if t.month not in mons or t.day not in doms or (t.weekday() + 1) % 7 not in dows:
+            t = (t + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+        elif t.hour not in hours:
+            t = (t + datetime.timedelta(hours=1)).replace(minute=0)
+        elif t.minute not in minutes:
+            t += datetime.timedelta(minutes=1)
+        else:
+            return t.timestamp()
+    raise ValueError("cron expression never matches")
+
+def job(name, cron, jitter=60):
+    def deco(fn):
+        JOBS[name] = {"cron": cron, "jitter": jitter, "fn": fn, "fields": parse_cron(cron)}
+        return fn
+    return deco
+
+def acquire_lease(owner=None, ttl=None):
+    """Take or renew the scheduler lease. True if `owner` holds it afterwards."""
+    owner, now = owner or scheduler_owner(), time.time()
+    with get_db() as conn:
+        cur = conn.execute(
+            """INSERT INTO meta(k, v) VALUES ('scheduler_lease', ?)
+               ON CONFLICT(k) DO UPDATE SET v=excluded.v
+               WHERE json_extract(meta.v, '$.expires') < ? OR json_extract(meta.v, '$.owner') = ?""",
+            (json.dumps({"owner": owner, "expires": now + (ttl or SCHEDULER_LEASE_S), "since": now}), now, owner),
+        )
+        conn.commit()
+        return cur.rowcount == 1
+
+def release_lease(owner=None):
+    with get_db() as conn:
+        conn.execute("DELETE FROM meta WHERE k='scheduler_lease' AND json_extract(v, '$.owner') = ?",
+                     (owner or scheduler_owner(),))
+        conn.commit()
+
+def _due_jobs(now):
+    with get_db() as conn:
+        known = {r["name"]: r["next_run"] for r in conn.execute("SELECT name, next_run FROM scheduler_jobs")}
+        for name, spec in JOBS.items():
+            if name not in known:  # first sight: schedule the next slot, don't run immediately
+                known[name] = next_cron(spec["fields"], now) + random.uniform(0, spec["jitter"])
+                conn.execute("INSERT OR IGNORE INTO scheduler_jobs (name, next_run) VALUES (?, ?)", (name, known[name]))
+        conn.commit()
+    return [n for n in JOBS if known[n] is not None and known[n] <= now]
+
+def run_job(name):
+    """Run one job now and record it. Returns (ok, result)."""
+    spec, t0 = JOBS[name], time.time()
+    try:
+        result, ok = spec["fn"](), True
+    except Exception as e:
+        result, ok = f"{type(e).__name__}: {e}", False
+        print(f"⚠️ job {name} failed:", result)
+    ms = (time.time() - t0) * 1000
+    nxt = next_cron(spec["fields"], time.time()) + random.uniform(0, spec["jitter"])
+    with get_db() as conn:
+        conn.execute(
+            "INSERT INTO scheduler_runs (job, owner, started_at, duration_ms, ok, result) VALUES (?, ?, ?, ?, ?, ?)",
+            (name, scheduler_owner(), t0, round(ms, 1), int(ok), json.dumps(result, default=str)[:2000]),
+        )
+        conn.execute(
+            """UPDATE scheduler_jobs SET next_run=?, last_run=?, last_ok=?, runs=runs+1,
+                   failures=failures+?, total_ms=total_ms+? WHERE name=?""",
+            (nxt, t0, int(ok), int(not ok), ms, name),
+        )
+        conn.execute("DELETE FROM scheduler_runs WHERE id <= (SELECT MAX(id) FROM scheduler_runs) - ?", (SCHEDULER_HISTORY,))
+        conn.commit()
+    return ok, result
+
+def scheduler_tick():
+    """One pass: renew/take the lease; if leader, run due jobs (renewing while they run)."""
+    if not acquire_lease():
+        return False
+    for name in _due_jobs(time.time()):
+        t = threading.Thread(target=run_job, args=(name,), name=f"job-{name}", daemon=True)
+        t.start()
+        while t.is_alive():
+            t.join(SCHEDULER_TICK_S)
+            if not acquire_lease():  # lost it (e.g. DB locked too long): finish this job, start no more
+                t.join()
+                return False
+        if _scheduler_stop.is_set():
+            break
+    return True
+
+def _scheduler_loop():
+    while not _scheduler_stop.wait(SCHEDULER_TICK_S * random.uniform(0.8, 1.2)):
+        try:
+            scheduler_tick()
+        except Exception as e:
+            print("scheduler tick error:", e)
+    release_lease()
+
+def start_scheduler():
+    """Start this process's scheduler loop (once). Call after fork, never in the gunicorn master."""
+    global _scheduler_thread
+    if not SCHEDULER_ENABLED or (_scheduler_thread and _scheduler_thread.is_alive()):
+        return False
+    _scheduler_stop.clear()
+    _scheduler_thread = threading.Thread(target=_scheduler_loop, name="scheduler", daemon=True)
+    _scheduler_thread.start()
+    return True
+
+def stop_scheduler():
+    _scheduler_stop.set()
+    release_lease()
+
+# --- jobs ---
+@job("token_refresh", "*/20 * * * *", jitter=120)
+def job_token_refresh():
+    """Refresh tokens expiring within the hour, so webhook ingests never wait on OAuth."""
+    with get_db() as conn:
+        rows = conn.execute(
+            "SELECT * FROM users WHERE refresh_token IS NOT NULL AND COALESCE(expires_at, 0) < ?",
+            (int(time.time()) + 3600,),
+        ).fetchall()
+    done = 0
+    for row in rows:
+        try:
+            if refresh_if_needed(row, margin=3600):
+                done += 1
+        except Exception as e:
+            print("token pre-refresh error:", row["athlete_id"], e)
+    return {"due": len(rows), "refreshed": done}
+
+@job("stats_recompute", "30 3 * * *", jitter=600)
+def job_stats_recompute():
+    """Nightly: extend training load to today (CTL/ATL decay on rest days) and rebuild weekly totals."""
+    with get_db() as conn:
+        athletes = [r["athlete_id"] for r in conn.execute("SELECT DISTINCT athlete_id FROM activities")]
+    for a in athletes:
+        update_training_load(a)
+    return {"athletes": len(athletes), "weekly_rows": rebuild_weekly_totals()}
+
+@job("data_cleanup", "10 */6 * * *", jitter=900)
+def job_data_cleanup():
+    """Retention pass + stale partial files (*.part) and export spools left by interrupted writes."""
+    removed = 0
+    for root, _dirs, files in os.walk(DATA_DIR):
+        for name in files:
+            p = os.path.join(root, name)
+            if name.endswith(".part") and time.time() - os.path.getmtime(p) > 86400:
+                os.remove(p)
+                removed += 1
+    if os.path.isdir(EXPORT_DIR):
+        for name in os.listdir(EXPORT_DIR):
+            p = os.path.join(EXPORT_DIR, name)
+            if os.path.isdir(p) and time.time() - os.path.getmtime(p) > 86400:
+                shutil.rmtree(p, ignore_errors=True)
+                removed += 1
+    return {"partials_removed": removed, "retention": run_retention()}
+
+@job("drive_retry", "5 * * * *", jitter=300)
+def job_drive_retry(limit=50):
+    """Re-upload stream CSVs whose Drive upload failed at ingest time."""
+    if not DRIVE_FOLDER_ID:
+        return {"skipped": "DRIVE_FOLDER_ID not set"}
+    with get_db() as conn:
+        rows = conn.execute(
+            "SELECT path FROM stored_files WHERE kind='streams' AND drive_file_id IS NULL AND tier='hot' LIMIT ?",
+            (limit,),
+        ).fetchall()
+    uploaded = 0
+    for r in rows:
+        if not os.path.exists(r["path"]):
+            continue
+        info = upload_to_drive(r["path"], os.path.basename(r["path"]), "text/csv", DRIVE_FOLDER_ID)
+        if isinstance(info, dict) and info.get("id"):
+            with get_db() as conn:
+                conn.execute("UPDATE stored_files SET drive_file_id=? WHERE path=?", (info["id"], r["path"]))
+                conn.commit()
+            uploaded += 1
+    return {"pending": len(rows), "uploaded": uploaded}
+
+def scheduler_status(runs=20):
+    lease = json.loads(meta_get("scheduler_lease") or "null")
+    with get_db() as conn:
+        jobs = {r["name"]: dict(r) for r in conn.execute("SELECT * FROM scheduler_jobs")}
+        recent = [dict(r) for r in conn.execute("SELECT * FROM scheduler_runs ORDER BY id DESC LIMIT ?", (runs,))]
+    for name, spec in JOBS.items():
+        j = jobs.setdefault(name, {"name": name})
+        j["cron"], j["jitter"] = spec["cron"], spec["jitter"]
+        j["avg_ms"] = round(j["total_ms"] / j["runs"], 1) if j.get("runs") else None
+    return {
+        "enabled": SCHEDULER_ENABLED,
+        "lease": lease,
+        "lease_valid": bool(lease and lease["expires"] > time.time()),
+        "this_worker": scheduler_owner(),
+        "jobs": list(jobs.values()),
+        "recent_runs": recent,
+    }
+
+@app.route("/admin/scheduler", methods=["GET", "POST"])
+@admin_required
+def admin_scheduler():
+    """GET: lease, job schedule/timings and run history. POST ?run=<job>: make a job due now."""
+    if request.method == "POST":
+        name = request.args.get("run")
+        if name not in JOBS:
+            return {"ok": False, "error": f"unknown job {name!r}", "jobs": list(JOBS)}, 400
+        with get_db() as conn:
+            conn.execute(
+                """INSERT INTO scheduler_jobs (name, next_run) VALUES (?, 0)
+                   ON CONFLICT(name) DO UPDATE SET next_run=0""", (name,))
+            conn.commit()
+    return {"ok": True, **scheduler_status()}
+
+
+# === On-demand profiling ===
+# Off unless armed. Two ways in:
+#   - one request: send X-Profile: cprofile|sample together with the admin token
+#   - a share of a route: POST /admin/profile?route=/stats-2025/data&fraction=0.1&count=20
+#     (stored in meta, so every worker picks it up within PROFILE_POLL_S)
+# A profiled request writes <stem>.pstats (cProfile; `python -m pstats` / snakeviz) and/or
+# <stem>.folded (collapsed stacks for flamegraph.pl / speedscope) plus <stem>.json under
+# DATA_DIR/profiles. When nothing is armed the per-request cost is one clock comparison.
+PROFILE_DIR = os.path.join(DATA_DIR, "profiles")
+PROFILE_POLL_S = 5
+PROFILE_KEEP = 200
+PROFILE_SAMPLE_S = 0.005
+PROFILE_FOLD_MAX_STACKS = 20000  # cap on call paths walked when folding a cProfile graph
+PROFILE_FOLD_MIN_US = 1.0        # paths carrying less time than this are not expanded
+_profile_cfg = {"checked": 0.0, "config": None}
+
+def _profile_config():
+    now = time.time()
+    if now - _profile_cfg["checked"] > PROFILE_POLL_S:
+        _profile_cfg["checked"] = now
+        try:
+            cfg = json.loads(meta_get("profile_config") or "null")
+        except Exception:
+            cfg = None
+        _profile_cfg["config"] = cfg if cfg and cfg.get("until", 0) > now and cfg.get("left", 0) > 0 else None
+    return _profile_cfg["config"]
+
+class _StackSampler:
+    """Samples one thread's Python stack every PROFILE_SAMPLE_S into collapsed-stack counts."""
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.counts = defaultdict(int)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def _run(self):
+        while not self.stop.wait(PROFILE_SAMPLE_S):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def finish(self):
+        self.stop.set()
+        self.thread.join()
+        return self.counts
+
+def _func_label(func):
+    filename, line, name = func
+    return f"{name} ({os.path.basename(filename)}:{line})" if line else name
+
+def pstats_to_folded(stats, max_depth=64, max_stacks=PROFILE_FOLD_MAX_STACKS, min_us=PROFILE_FOLD_MIN_US):
+    """
+    Collapsed stacks from a cProfile call graph (µs of self time per stack). cProfile only
+    keeps caller→callee edges, so a callee's time is split across paths by edge share.
+    The number of simple paths grows exponentially with the graph (a cold import has
+    thousands of functions), so the walk is bounded: heaviest paths first, paths under
+    min_us are not expanded, and it stops after max_stacks paths. Self time the walk
+    didn't reach (cut paths, cycles with no entry point) goes under "[unattributed]".
+    """
+    callees = defaultdict(dict)
+    for func, (_cc, _nc, _tt, _ct, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge[3]
+    out = defaultdict(int)
+    # roots: time entered from outside the profile (no callers, or callers that were
+    # already running when profiling started and so have no entry of their own)
+    heap = []
+    for func, (_cc, _nc, _tt, ct, callers) in stats.items():
+        outside = ct if not callers else sum(e[3] for c, e in callers.items() if c not in stats)
+        if outside > 0:
+            heap.append((-outside, len(heap), func, ()))
+    heapq.heapify(heap)
+    counter = itertools.count(len(heap))
+    walked = 0
+    attributed = defaultdict(float)
+    while heap and walked < max_stacks:
+        neg_budget, _n, func, path = heapq.heappop(heap)
+        walked += 1
+        budget = -neg_budget
+        cc, nc, tt, ct, _callers = stats[func]
+        share = budget / ct if ct else 0.0
+        label = path + (_func_label(func),)
+        if tt * share > 0:
+            out[";".join(label)] += int(tt * share * 1e6)
+            attributed[func] += tt * share
+        if len(label) >= max_depth:
+            continue
+        for callee, edge_ct in callees.get(func, {}).items():
+            if callee in stats and edge_ct * share * 1e6 >= min_us and _func_label(callee) not in label:
+                heapq.heappush(heap, (-edge_ct * share, next(counter), callee, label))
+    for func, (_cc, _nc, tt, _ct, _callers) in stats.items():
+        rest = int((tt - attributed[func]) * 1e6)
+        if rest >= max(min_us, 1):
+            out[f"[unattributed];{_func_label(func)}"] += rest
+    return out
+
+def _write_profile(kind, info, prof=None, folded=None):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", info["route"]).strip("_") or "root"
+    stem = os.path.join(PROFILE_DIR, f"{int(time.time() * 1000)}-{os.getpid()}-{slug}-{kind}")
+    files = []
+    if prof is not None:
+        pstats = importlib.import_module("pstats")
+        prof.dump_stats(stem + ".pstats")
+        files.append(stem + ".pstats")
+        if folded is None:
+            folded = pstats_to_folded(pstats.Stats(prof).stats)
+    if folded:
+        with open(stem + ".folded", "w") as f:
+            for stack, n in sorted(folded.items()):
+                f.write(f"{stack} {n}\n")
+        files.append(stem + ".folded")
+    info["files"] = [os.path.basename(p) for p in files]
+    with open(stem + ".json", "w") as f:
+        json.dump(info, f)
+    old = sorted(n for n in os.listdir(PROFILE_DIR) if n.endswith(".json"))[:-PROFILE_KEEP]
+    for name in old:
+        for ext in (".json", ".pstats", ".folded"):
+            p = os.path.join(PROFILE_DIR, name[:-5] + ext)
+            if os.path.exists(p):
+                os.remove(p)
+
+@app.before_request
+def _profile_start():
+    mode = request.headers.get("X-Profile")
+    if mode:
+        sent = request.headers.get("X-Admin-Token") or request.args.get("token")
+        if not ADMIN_TOKEN or sent != ADMIN_TOKEN:
+            return
+    else:
+        cfg = _profile_config()
+        if cfg is None or not request.url_rule or request.url_rule.rule != cfg["route"]:
+            return
+        if random.random() >= cfg.get("fraction", 1.0):
+            return
+        mode = cfg.get("mode", "cprofile")
+    if mode == "sample" and os.environ.get("SERVE_MODE") != "async":  # gevent: no real threads to sample
+        g.profiler = ("sample", _StackSampler(threading.get_ident()))
+        g.profiler[1].start()
+    else:
+        prof = importlib.import_module("cProfile").Profile()
+        g.profiler = ("cprofile", prof)
+        prof.enable()
+    g.profile_t0 = time.perf_counter()
+
+@app.after_request
+def _profile_finish(response):
+    prof = g.pop("profiler", None)
+    if prof is None:
+        return response
+    kind, p = prof
+    if kind == "cprofile":
+        p.disable()
+    info = {
+        "route": request.url_rule.rule if request.url_rule else request.path,
+        "path": request.full_path.rstrip("?"),
+        "method": request.method,
+        "status": response.status_code,
+        "mode": kind,
+        "duration_ms": round((time.perf_counter() - g.profile_t0) * 1000, 1),
+        "pid": os.getpid(),
+        "at": int(time.time()),
+    }
+    def write():
+        try:
+            if kind == "cprofile":
+                _write_profile(kind, info, prof=p)
+            else:
+                _write_profile(kind, info, folded=p.finish())
+        except Exception as e:
+            print("profile write error:", e)
+
+    # dump + folding happen after the response, not on the request thread
+    threading.Thread(target=write, name="profile-writer", daemon=True).start()
+    try:
+        if not request.headers.get("X-Profile"):
+            cfg = _profile_cfg["config"]
+            if cfg:  # local copy first, so this worker stops at once; then the shared budget
+                cfg["left"] -= 1
+                if cfg["left"] <= 0:
+                    _profile_cfg["config"] = None
+            with get_db() as conn:
+                conn.execute("""UPDATE meta SET v=json_set(v, '$.left', json_extract(v, '$.left') - 1)
+                                WHERE k='profile_config'""")
+                conn.commit()
+    except Exception as e:
+        print("profile write error:", e)
+    response.headers["X-Profile-Ms"] = str(info["duration_ms"])
+    return response
+
+def list_profiles(limit=50, route=None):
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    out = []
+    for name in sorted((n for n in os.listdir(PROFILE_DIR) if n.endswith(".json")), reverse=True):
+        try:
+            with open(os.path.join(PROFILE_DIR, name)) as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if route and info.get("route") != route:
+            continue
+        info["id"] = name[:-5]
+        out.append(info)
+        if len(out) >= limit:
+            break
+    return out
+
+@app.route("/admin/profile", methods=["GET", "POST", "DELETE"])
+@admin_required
+def admin_profile():
+    """
+    POST ?route=<rule>&fraction=0.1&count=20&minutes=30&mode=cprofile|sample: arm route profiling.
+    DELETE: disarm. GET: current config + recent profiles (?route= filter).
+    """
+    if request.method == "POST":
+        route = request.args.get("route")
+        if not route or route not in {r.rule for r in app.url_map.iter_rules()}:
+            return {"ok": False, "error": "route must be a URL rule, e.g. /stats-2025/data"}, 400
+        cfg = {
+            "route": route,
+            "fraction": min(max(request.args.get("fraction", 1.0, type=float), 0.0), 1.0),
+            "left": max(request.args.get("count", 10, type=int), 1),
+            "mode": "sample" if request.args.get("mode") == "sample" else "cprofile",
+            "until": time.time() + 60 * request.args.get("minutes", 30, type=float),
+        }
+        meta_set("profile_config", json.dumps(cfg))
+    elif request.method == "DELETE":
+        meta_set("profile_config", "null")
+    _profile_cfg["checked"] = 0.0
+    return {"ok": True, "config": _profile_config(),
+            "profiles": list_profiles(request.args.get("limit", 50, type=int), request.args.get("route"))}
+
+@app.route("/admin/profiles/<name>")
+@admin_required
+def admin_profile_file(name):
+    """Download one profile file (.pstats / .folded / .json); ?top=N summarizes a .pstats."""
+    path = os.path.join(PROFILE_DIR, os.path.basename(name))
+    if not os.path.isfile(path):
+        return {"ok": False, "error": "not found"}, 404
+    if name.endswith(".pstats") and request.args.get("top"):
+        pstats = importlib.import_module("pstats")
+        buf = io.StringIO()
+        pstats.Stats(path, stream=buf).sort_stats("cumulative").print_stats(request.args.get("top", 30, type=int))
+        return buf.getvalue(), 200, {"Content-Type": "text/plain; charset=utf-8"}
+    return send_file(path, as_attachment=True)
+
+
+# === Bulk export (streaming zip) ===
+# /export streams one zip with everything we hold for the signed-in athlete: summaries,
+# metrics, best efforts, climbs, training load, weekly totals (small files dumped from
+# SQLite into a spool dir first, so their sizes are known) and every stream CSV as stored
+# on disk (.csv or .csv.gz tier; Drive-only ones are listed in manifest.json).
+# Entries are STORED (the CSVs are mostly already compressed or cheap to store, and the
+# archive length stays computable), so the whole layout — and Content-Length — is known
+# before the first byte. That gives single-range requests (resume) for free: bytes
+# before the range are skipped arithmetically, file data is read in EXPORT_CHUNK
+# blocks, and only zlib.crc32 touches it. Offsets over 4 GiB switch to zip64 records.
+# The spool is reused (HEAD, Range resumes, repeat downloads) while the athlete's data
+# fingerprint is unchanged and it is younger than EXPORT_SPOOL_TTL; at most
+# EXPORT_SPOOLS_MAX athletes keep one, and a replaced spool is deleted once no
+# response is still reading it.
+EXPORT_DIR = os.path.join(DATA_DIR, "exports")
+EXPORT_CHUNK = 1024 * 1024
+EXPORT_SPOOL_TTL = int(os.environ.get("EXPORT_SPOOL_TTL", 900))
+EXPORT_SPOOLS_MAX = int(os.environ.get("EXPORT_SPOOLS_MAX", 8))
+_export_spools = {}  # athlete_id -> {"spool", "entries", "fingerprint", "at", "users"}
+_export_lock = threading.Lock()
+
+def _dos_datetime(ts):
+    t = time.gmtime(max(ts, 315532800))  # zip dates start in 1980
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+@functools.lru_cache(maxsize=4096)
+def _file_crc(path, size, mtime_ns):
+    """crc32 of a file, cached per (path, size, mtime) for resumed downloads."""
+    crc = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(EXPORT_CHUNK), b""):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+def _spool_query(spool, name, sql, params, fmt="jsonl", json_cols=()):
+    """Dump a query to spool/name row by row (jsonl or csv). Returns the path."""
+    path = os.path.join(spool, name)
+    with get_db() as conn, open(path, "w", newline="") as f:
+        cur = conn.execute(sql, params)
+        cols = [d[0] for d in cur.description]
+        writer = csv.writer(f) if fmt == "csv" else None
+        if writer:
+            writer.writerow(cols)
+        for row in cur:
+            if writer:
+                writer.writerow(row)
+            else:
+                rec = dict(zip(cols, row))
+                for c in json_cols:
+                    if rec.get(c):
+                        rec[c] = json.loads(rec[c])
+                f.write(json.dumps(rec, separators=(",", ":")) + "\n")
+    return path
+
+def export_entries(athlete_id, spool):
+    """[(arcname, path, content digest or None)] for one athlete; Drive-only streams are listed in the manifest."""
+    q = [
+        ("activities.jsonl", "SELECT * FROM activities WHERE athlete_id=? ORDER BY start_date", ("summary_json",)),
+        ("metrics.jsonl", "SELECT activity_id, name, version, value_json, computed_at FROM activity_metrics "
+                          "WHERE athlete_id=? ORDER BY activity_id, name", ("value_json",)),
+        ("best_efforts.jsonl", "SELECT * FROM best_efforts WHERE athlete_id=? ORDER BY day", ()),
+        ("personal_records.jsonl", "SELECT * FROM personal_records WHERE athlete_id=?", ()),
+        ("climbs.jsonl", "SELECT * FROM climbs WHERE athlete_id=? ORDER BY day", ()),
+    ]
+    entries = [(name, _spool_query(spool, name, sql, (athlete_id,), json_cols=jc)) for name, sql, jc in q]
+    for name, sql in [("training_load.csv", "SELECT * FROM training_load WHERE athlete_id=? ORDER BY day"),
+                      ("weekly_totals.csv", "SELECT * FROM weekly_totals WHERE athlete_id=? ORDER BY week, sport")]:
+        entries.append((name, _spool_query(spool, name, sql, (athlete_id,), fmt="csv")))
+    with get_db() as conn:
+        ids = sorted({r[0] for r in conn.execute(
+            """SELECT id FROM activities WHERE athlete_id=?
+               UNION SELECT activity_id FROM stored_files WHERE athlete_id=? AND kind='streams'""",
+            (athlete_id, athlete_id))} - {None})
+    missing = []
+    for aid in ids:
+        path = streams_csv_path(athlete_id, aid)
+        if os.path.exists(path):
+            entries.append((f"streams/{aid}.csv", path))
+        elif os.path.exists(path + ".gz"):
+            entries.append((f"streams/{aid}.csv.gz", path + ".gz"))
+        else:
+            missing.append(f"streams/{aid}.csv")
+    manifest = os.path.join(spool, "manifest.json")
+    with open(manifest, "w") as f:
+        json.dump({"athlete_id": athlete_id, "files": [n for n, _p in entries],
+                   "not_included_drive_only": missing}, f, indent=1)
+    entries.insert(0, ("manifest.json", manifest))
+    # Spooled dumps get a stable mtime (last activity update) and a content digest, so an
+    # unchanged dataset produces byte-identical archives (and the same ETag) for resumes.
+    with get_db() as conn:
+        stamp = conn.execute("SELECT MAX(updated_at) FROM activities WHERE athlete_id=?", (athlete_id,)).fetchone()[0]
+    stamp = stamp or 315532800
+    out = []
+    for name, path in entries:
+        digest = None
+        if path.startswith(spool):
+            os.utime(path, (stamp, stamp))
+            with open(path, "rb") as f:
+                digest = hashlib.file_digest(f, "sha256").hexdigest()
+        out.append((name, path, digest))
+    return out
+
+def _export_fingerprint(athlete_id):
+    """Cheap summary of everything export_entries dumps; a change means re-spool."""
+    with get_db() as conn:
+        return tuple(conn.execute(
+            """SELECT
+                 (SELECT COUNT(*) || ':' || COALESCE(MAX(updated_at), 0) FROM activities WHERE athlete_id=?),
+                 (SELECT COUNT(*) || ':' || COALESCE(MAX(computed_at), 0) FROM activity_metrics WHERE athlete_id=?),
+                 (SELECT COUNT(*) FROM best_efforts WHERE athlete_id=?),
+                 (SELECT COUNT(*) FROM climbs WHERE athlete_id=?),
+                 (SELECT COUNT(*) FROM stored_files WHERE athlete_id=? AND kind='streams')""",
+            (athlete_id,) * 5,
+        ).fetchone())
+
+def _drop_spools(entries):
+    for e in entries:
+        shutil.rmtree(e["spool"], ignore_errors=True)
+
+def acquire_export_spool(athlete_id, fresh=False):
+    """Spooled export entries for this athlete, reused when still current. Pair with release_export_spool."""
+    fp = _export_fingerprint(athlete_id)
+    now = time.time()
+    with _export_lock:
+        cur = _export_spools.get(athlete_id)
+        if (cur and not fresh and cur["fingerprint"] == fp and now - cur["at"] < EXPORT_SPOOL_TTL
+                and os.path.isdir(cur["spool"])):
+            cur["users"] += 1
+            return cur
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    spool = tempfile.mkdtemp(prefix=f"{athlete_id}-", dir=EXPORT_DIR)
+    try:
+        entries = export_entries(athlete_id, spool)
+    except Exception:
+        shutil.rmtree(spool, ignore_errors=True)
+        raise
+    entry = {"athlete_id": athlete_id, "spool": spool, "entries": entries, "fingerprint": fp, "at": now, "users": 1}
+    with _export_lock:
+        old = _export_spools.get(athlete_id)
+        _export_spools[athlete_id] = entry
+        drop = [old] if old and old["users"] == 0 else []
+        # expired or over the limit: forget the oldest idle spools
+        idle = sorted((e for e in _export_spools.values() if e["users"] == 0), key=lambda e: e["at"])
+        for e in idle:
+            if len(_export_spools) > EXPORT_SPOOLS_MAX or now - e["at"] >= EXPORT_SPOOL_TTL:
+                del _export_spools[e["athlete_id"]]
+                drop.append(e)
+    _drop_spools(drop)
+    return entry
+
+def release_export_spool(entry):
+    with _export_lock:
+        entry["users"] -= 1
+        orphan = entry["users"] == 0 and _export_spools.get(entry["athlete_id"]) is not entry
+    if orphan:
+        _drop_spools([entry])
+
+class ZipLayout:
+    """Byte-exact layout of a STORED zip over existing files; serves any byte range."""
+    def __init__(self, entries):
+        self.items, offset = [], 0
+        for arcname, path, digest in entries:
+            st = os.stat(path)
+            name = arcname.encode("utf-8")
+            tm, dt = _dos_datetime(st.st_mtime)
+            item = {"name": name, "path": path, "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                    "digest": digest, "time": tm, "date": dt, "offset": offset, "crc": None}
+            if st.st_size >= 0xFFFFFFFF:
+                raise ValueError(f"{arcname}: single files over 4 GiB are not supported")
+            item["data_at"] = offset + 30 + len(name)
+            offset = item["data_at"] + st.st_size + 16
+            self.items.append(item)
+        self.cd_offset = offset
+        self.zip64 = offset >= 0xFFFFFFFF or len(self.items) >= 0xFFFF
+        cd_size = sum(46 + len(i["name"]) + (12 if i["offset"] >= 0xFFFFFFFF else 0) for i in self.items)
+        self.cd_size = cd_size
+        self.length = offset + cd_size + (56 + 20 if self.zip64 else 0) + 22
+
+    def etag(self):
+        h = hashlib.sha256()
+        for i in self.items:
+            h.update(b"%s\0%d\0%d\0%s\0" % (i["name"], i["size"], i["mtime_ns"], (i["digest"] or "").encode()))
+        return h.hexdigest()[:32]
+
+    def _local_header(self, i):
+        return struct.pack("<IHHHHHIIIHH", 0x04034B50, 20, 0x0808, 0, i["time"], i["date"],
+                           0, 0, 0, len(i["name"]), 0) + i["name"]  # bit 3: crc/sizes follow the data
+
+    def _central(self):
+        out = []
+        for i in self.items:
+            big = i["offset"] >= 0xFFFFFFFF
+            extra = struct.pack("<HHQ", 1, 8, i["offset"]) if big else b""
+            out.append(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014B50, 45 if big else 20, 45 if big else 20,
+                                   0x0808, 0, i["time"], i["date"], i["crc"], i["size"], i["size"],
+                                   len(i["name"]), len(extra), 0, 0, 0, 0o100644 << 16,
+                                   0xFFFFFFFF if big else i["offset"]) + i["name"] + extra)
+        n = len(self.items)
+        if self.zip64:
+            eocd64_at = self.cd_offset + self.cd_size
+            out.append(struct.pack("<IQHHIIQQQQ", 0x06064B50, 44, 45, 45, 0, 0, n, n, self.cd_size, self.cd_offset))
+            out.append(struct.pack("<IIQI", 0x07064B50, 0, eocd64_at, 1))
+        out.append(struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, min(n, 0xFFFF), min(n, 0xFFFF),
+                               min(self.cd_size, 0xFFFFFFFF), min(self.cd_offset, 0xFFFFFFFF), 0))
+        return b"".join(out)
+
+    def iter_range(self, start=0, end=None):
+        """Yield bytes [start, end] of the archive (inclusive end, like HTTP ranges)."""
+        end = self.length - 1 if end is None else end
+        pos = 0
+
+        def cut(piece, at):
+            lo, hi = max(start - at, 0), min(end + 1 - at, len(piece))
+            return piece[lo:hi] if lo < hi else b""
+
+        for i in self.items:
+            if pos > end:
+                return
+            header = self._local_header(i)
+            if pos + len(header) > start:
+                yield cut(header, pos)
+            pos = i["data_at"]
+            data_end = pos + i["size"]
+            if data_end > start and pos <= end:
+                skip = max(start - pos, 0)
+                crc = 0 if skip == 0 else None
+                with open(i["path"], "rb") as f:
+                    f.seek(skip)
+                    left = min(end + 1, data_end) - (pos + skip)
+                    while left > 0:
+                        chunk = f.read(min(EXPORT_CHUNK, left))
+                        if not chunk:
+                            raise IOError(f"{i['path']} shrank during export")
+                        if crc is not None:
+                            crc = zlib.crc32(chunk, crc)
+                        left -= len(chunk)
+                        yield chunk
+                if crc is not None and end + 1 >= data_end:
+                    i["crc"] = crc
+            pos = data_end
+            if pos + 16 > start and pos <= end:
+                if i["crc"] is None:
+                    i["crc"] = _file_crc(i["path"], i["size"], i["mtime_ns"])
+                yield cut(struct.pack("<IIII", 0x08074B50, i["crc"], i["size"], i["size"]), pos)
+            pos += 16
+        if end >= self.cd_offset:
+            for i in self.items:
+                if i["crc"] is None:
+                    i["crc"] = _file_crc(i["path"], i["size"], i["mtime_ns"])
+            yield cut(self._central(), self.cd_offset)
+
+def _parse_range(header, length):
+    """'bytes=a-b' / 'bytes=a-' / 'bytes=-n' → (start, end) or None (multi/invalid → full body)."""
+    m = re.fullmatch(r"bytes=(\d*)-(\d*)", (header or "").strip())
+    if not m or (not m.group(1) and not m.group(2)):
+        return None
+    if not m.group(1):
+        n = int(m.group(2))
+        return (max(length - n, 0), length - 1) if n else None
+    start = int(m.group(1))
+    end = min(int(m.group(2)), length - 1) if m.group(2) else length - 1
+    return (start, end) if start <= end else "unsatisfiable"
+
+@app.route("/export")
+def export_zip():
+    if "access_token" not in session:
+        return redirect(url_for("home"))
+    athlete_id = (session.get("athlete") or {}).get("id")
+    spool = acquire_export_spool(athlete_id)
+    try:
+        try:
+            layout = ZipLayout(spool["entries"])
+        except FileNotFoundError:  # a stream CSV moved tier (.csv → .csv.gz) since the spool was made
+            release_export_spool(spool)
+            spool = None
+            spool = acquire_export_spool(athlete_id, fresh=True)
+            layout = ZipLayout(spool["entries"])
+    except Exception:
+        if spool:
+            release_export_spool(spool)
+        raise
+    etag = layout.etag()
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{etag}"',
+        "Content-Disposition": f"attachment; filename=strava-export-{athlete_id}.zip",
+    }
+    rng = None
+    if_range = request.headers.get("If-Range")
+    if request.headers.get("Range") and (not if_range or if_range.strip('"') == etag):
+        rng = _parse_range(request.headers["Range"], layout.length)
+    if rng == "unsatisfiable":
+        release_export_spool(spool)
+        return "", 416, {"Content-Range": f"bytes */{layout.length}"}
+    start, end = rng or (0, layout.length - 1)
+    headers["Content-Length"] = str(end - start + 1)
+    status = 200
+    if rng:
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{layout.length}"
+    resp = app.response_class(layout.iter_range(start, end), status=status, headers=headers,
+                              mimetype="application/zip")
+    resp.call_on_close(lambda: release_export_spool(spool))
+    return resp
+
+
+# === Year-over-year progress (per-day prefix sums) ===
+# progress_curves holds, per athlete and year, three 366-slot cumulative arrays
+# (distance m, elevation m, moving time s) as packed doubles: slot i = total from Jan 1
+# through day-of-year i+1. "Where was I on this date (last year)" is one 8-byte
+# substr() of the BLOB, and a changed day only shifts slots day..365 by the delta of
+# that day's total, so ingest/edit/delete never rescan the year.
+PROGRESS_FIELDS = ("distance", "elevation", "moving_time")
+PROGRESS_SLOTS = 366
+
+@schema_setup
+def ensure_progress_table():
+    with get_db() as conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS progress_curves (
+            athlete_id INTEGER,
+            year INTEGER,
+            distance BLOB,
+            elevation BLOB,
+            moving_time BLOB,
+            PRIMARY KEY (athlete_id, year)
+        );""")
+        conn.commit()
+
+def _doy(day):
+    return datetime.date.fromisoformat(day[:10]).timetuple().tm_yday - 1
+
+def _day_totals(conn, athlete_id, day):
+    nxt = (datetime.date.fromisoformat(day) + datetime.timedelta(days=1)).isoformat()
+    r = conn.execute(
+        """SELECT COALESCE(SUM(distance), 0), COALESCE(SUM(total_elevation_gain), 0), COALESCE(SUM(moving_time), 0)
+           FROM activities WHERE athlete_id=? AND start_date_local>=? AND start_date_local<?""",
+        (athlete_id, day, nxt),
+    ).fetchone()
+    return [float(x) for x in r]
+
+def rebuild_progress(athlete_id, years=None):
+    """Full build of the yearly prefix sums (first use, or many changed days)."""
+    daily = defaultdict(lambda: [[0.0] * PROGRESS_SLOTS for _ in PROGRESS_FIELDS])
+    with get_db() as conn:
+        for r in conn.execute(
+            """SELECT substr(start_date_local, 1, 10) AS day, SUM(distance), SUM(total_elevation_gain), SUM(moving_time)
+               FROM activities WHERE athlete_id=? AND start_date_local IS NOT NULL GROUP BY day""",
+            (athlete_id,),
+        ):
+            year = int(r[0][:4])
+            if years is None or year in years:
+                for k in range(3):
+                    daily[year][k][_doy(r[0])] = float(r[k + 1] or 0)
+        if years is not None:
+            for y in years:
+                daily[y]  # years that lost all their activities get zeroed curves
+            conn.executemany("DELETE FROM progress_curves WHERE athlete_id=? AND year=?", [(athlete_id, y) for y in years])
+        else:
+            conn.execute("DELETE FROM progress_curves WHERE athlete_id=?", (athlete_id,))
+        rows = []
+        for year, series in daily.items():
+            blobs = []
+            for values in series:
+                acc = array("d", itertools.accumulate(values))
+                blobs.append(acc.tobytes())
+            rows.append((athlete_id, year, *blobs))
+        conn.executemany(
+            "INSERT INTO progress_curves (athlete_id, year, distance, elevation, moving_time) VALUES (?, ?, ?, ?, ?)", rows)
+        conn.commit()
+    return len(rows)
+
+def update_progress_day(athlete_id, day):
+    """In-place update: add the change of this day's total to slots day..365 of its year."""
+    year, i = int(day[:4]), _doy(day)
+    with get_db() as conn:
+        conn.execute("BEGIN IMMEDIATE")  # read-modify-write of the BLOBs, safe across workers
+        row = conn.execute(
+            "SELECT distance, elevation, moving_time FROM progress_curves WHERE athlete_id=? AND year=?",
+            (athlete_id, year),
+        ).fetchone()
+        if row is None:
+            started = conn.execute("SELECT 1 FROM progress_curves WHERE athlete_id=? LIMIT 1", (athlete_id,)).fetchone()
+            conn.rollback()
+            # not built yet: _ensure_progress does the full build (all years) on first read
+            return rebuild_progress(athlete_id, {year}) if started else None
+        new = _day_totals(conn, athlete_id, day[:10])
+        blobs = []
+        for k, field in enumerate(PROGRESS_FIELDS):
+            cum = array("d")
+            cum.frombytes(row[field])
+            delta = new[k] - (cum[i] - (cum[i - 1] if i else 0.0))
+            if delta:
+                for j in range(i, PROGRESS_SLOTS):
+                    cum[j] += delta
+            blobs.append(cum.tobytes())
+        conn.execute(
+            "UPDATE progress_curves SET distance=?, elevation=?, moving_time=? WHERE athlete_id=? AND year=?",
+            (*blobs, athlete_id, year),
+        )
+        conn.commit()
+
+def refresh_progress_days(athlete_id, days):
+    if not _has_progress(athlete_id):
+        return  # built in full on first read
+    by_year = defaultdict(list)
+    for d in days:
+        by_year[int(d[:4])].append(d)
+    bulk = {y for y, ds in by_year.items() if len(ds) > 20}
+    if bulk:
+        rebuild_progress(athlete_id, bulk)
+    for y, ds in by_year.items():
+        if y not in bulk:
+            for d in ds:
+                update_progress_day(athlete_id, d)
+
+def _has_progress(athlete_id):
+    with get_db() as conn:
+        return conn.execute("SELECT 1 FROM progress_curves WHERE athlete_id=? LIMIT 1", (athlete_id,)).fetchone() is not None
+
+def _ensure_progress(athlete_id):
+    if not _has_progress(athlete_id):
+        rebuild_progress(athlete_id)
+
+def progress_at(athlete_id, date):
+    """{year: {field: cumulative value}} on this calendar date in every year (Feb 29 → Feb 28)."""
+    _ensure_progress(athlete_id)
+    d = datetime.date.fromisoformat(date) if isinstance(date, str) else date
+    out = {}
+    with get_db() as conn:
+        years = [r[0] for r in conn.execute("SELECT year FROM progress_curves WHERE athlete_id=? ORDER BY year", (athlete_id,))]
+        for y in years:
+            try:
+                same = d.replace(year=y)
+            except ValueError:
+                same = datetime.date(y, 2, 28)
+            off = (same.timetuple().tm_yday - 1) * 8 + 1
+            r = conn.execute(
+                "SELECT substr(distance, ?, 8), substr(elevation, ?, 8), substr(moving_time, ?, 8) "
+                "FROM progress_curves WHERE athlete_id=? AND year=?",
+                (off, off, off, athlete_id, y),
+            ).fetchone()
+            out[y] = {f: array("d", r[k])[0] for k, f in enumerate(PROGRESS_FIELDS)}
+    return out
+
+def progress_curves(athlete_id, field="distance"):
+    """{year: [cumulative per day-of-year]} (current year cut at today)."""
+    _ensure_progress(athlete_id)
+    if field not in PROGRESS_FIELDS:
+        field = "distance"
+    today = datetime.date.today()
+    out = {}
+    with get_db() as conn:
+        for r in conn.execute(f"SELECT year, {field} FROM progress_curves WHERE athlete_id=? ORDER BY year", (athlete_id,)):
+            cum = array("d")
+            cum.frombytes(r[field])
+            n = today.timetuple().tm_yday if r["year"] == today.year else (366 if calendar.isleap(r["year"]) else 365)
+            out[r["year"]] = cum[:n].tolist()
+    return out
+
+_PROGRESS_UNITS = {"distance": ("km", 1000.0), "elevation": ("m", 1.0), "moving_time": ("h", 3600.0)}
+_PROGRESS_COLORS = ["#64748b", "#94a3b8", "#a78bfa", "#60a5fa", "#34d399", "#fbbf24", "#f97316"]
+
+@app.route("/progress.json")
+def progress_data():
+    if "access_token" not in session:
+        return redirect(url_for("home"))
+    athlete_id = (session.get("athlete") or {}).get("id")
+    date = request.args.get("date") or datetime.date.today().isoformat()
+    try:
+        at = progress_at(athlete_id, date)
+    except ValueError:
+        return jsonify({"ok": False, "error": "date must be YYYY-MM-DD"}), 400
+    out = {"ok": True, "date": date, "at_date": at}
+    if request.args.get("curves", "1") != "0":
+        out["curves"] = progress_curves(athlete_id, request.args.get("field", "distance"))
+    return jsonify(out)
+
+@app.route("/progress")
+def progress_page():
+    if "access_token" not in session:
+        return redirect(url_for("home"))
+    athlete_id = (session.get("athlete") or {}).get("id")
+    field = request.args.get("field", "distance")
+    field = field if field in PROGRESS_FIELDS else "distance"
+    unit, div = _PROGRESS_UNITS[field]
+    curves = progress_curves(athlete_id, field)
+    today = datetime.date.today()
+    at = progress_at(athlete_id, today)
+    vmax = max([c[-1] for c in curves.values() if c] + [1])
+    years = sorted(curves)[-len(_PROGRESS_COLORS):]
+    lines, legend = "", ""
+    for k, y in enumerate(years):
+        color = "#f97316" if y == today.year else _PROGRESS_COLORS[k % (len(_PROGRESS_COLORS) - 1)]
+        pts = " ".join(f"{i * 600 / 365:.1f},{200 - v / vmax * 200:.1f}" for i, v in enumerate(curves[y]))
+        width = 3 if y == today.year else 1.5
+        lines += f"<polyline fill='none' stroke='{color}' stroke-width='{width}' points='{pts}' />"
+        legend += f"<span style='color:{color};margin-right:10px'>■ {y}</span>"
+    cur = at.get(today.year, {}).get(field, 0.0)
+    prev = at.get(today.year - 1, {}).get(field)
+    diff = f"{(cur - prev) / div:+.1f} {unit} vs {today.year - 1}" if prev is not None else "no data last year"
+    tabs = " ".join(f"<a class='a' href='/progress?field={f}'>{f.replace('_', ' ')}</a>" for f in PROGRESS_FIELDS)
+    return html_head("Year over year") + f"""
+    <div class="card">
+      <h1 class="title">📈 Year over year</h1>
+      <div class="links">{tabs}</div>
+      <div class="grid">
+        <div class="card"><div class="k">{cur / div:.1f} {unit}</div><div class="l">{field.replace('_', ' ')} so far in {today.year}</div></div>
+        <div class="card"><div class="k">{diff}</div><div class="l">on {today.strftime('%b %d')}</div></div>
+      </div>
+      <svg viewBox="0 0 600 200" style="width:100%;height:240px" preserveAspectRatio="none">{lines}</svg>
+      <div class="small">{legend} — cumulative {field.replace('_', ' ')} by day of year (max {vmax / div:.0f} {unit})</div>
+      <div class="links"><a class="a" href="/">← Back</a></div>
+    </div>
+    """ + html_foot()
+
+# ----------------- Run (optional for local dev) -----------------
+if __name__ == "__main__":
+    # For local runs (e.g., Replit). On Render, gunicorn (Procfile) is used instead.
+    start_scheduler()
+    app.run(host="0.0.0.0", port=5000)
+    # deployment
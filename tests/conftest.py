@@ -0,0 +1,31 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# main.py reads its config at import time
+_tmp = tempfile.mkdtemp(prefix="strava-tests-")
+os.environ.setdefault("STRAVA_CLIENT_ID", "1")
+os.environ.setdefault("STRAVA_CLIENT_SECRET", "test")
+os.environ.setdefault("STRAVA_REDIRECT_URI", "http://localhost/callback")
+os.environ.setdefault("APP_SECRET_KEY", "test")
+os.environ["DB_PATH"] = os.path.join(_tmp, "strava.db")
+os.environ["DATA_DIR"] = os.path.join(_tmp, "data")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh, fully migrated database per test."""
+    monkeypatch.setattr(main, "DB_PATH", str(tmp_path / "strava.db"))
+    main.init_schema()
+    return main
+
+
+def activity(aid, day, sport="Run", distance=10000.0, moving_time=3000, elevation=50.0, **extra):
+    return {"id": aid, "name": f"Activity {aid}", "sport_type": sport, "start_date": f"{day}T08:00:00Z",
+            "start_date_local": f"{day}T10:00:00Z", "distance": distance, "moving_time": moving_time,
+            "elapsed_time": moving_time, "total_elevation_gain": elevation, **extra}
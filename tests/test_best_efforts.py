@@ -0,0 +1,83 @@
+import random
+
+import pytest
+
+from conftest import activity
+
+
+def brute_force(t, d, dist):
+    """Fastest elapsed time over `dist`, trying every end sample and interpolating the start."""
+    best = None
+    for j in range(len(d)):
+        target = d[j] - dist
+        if target < d[0]:
+            continue
+        for i in range(j):
+            if d[i] <= target <= d[i + 1]:
+                frac = (target - d[i]) / (d[i + 1] - d[i]) if d[i + 1] > d[i] else 0.0
+                el = t[j] - (t[i] + (t[i + 1] - t[i]) * frac)
+                best = el if best is None else min(best, el)
+    return best
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_fastest_segments_matches_brute_force(db, seed):
+    rng = random.Random(seed)
+    t, d = [0.0], [0.0]
+    for _ in range(1500):
+        t.append(t[-1] + 1)
+        d.append(d[-1] + rng.choice([0.0, 1.5, 2.5, 3.0, 4.5, 6.0]))  # stops and surges
+    distances = [("1k", 1000.0), ("2k", 2000.0), ("far", d[-1] + 1)]
+    found = db.fastest_segments(t, d, distances)
+    assert "far" not in found
+    for name, dist in distances[:2]:
+        seconds, start, end = found[name]
+        assert seconds == pytest.approx(brute_force(t, d, dist), abs=0.1)
+        assert end - start == pytest.approx(seconds, abs=0.2)
+
+
+def test_fastest_segments_keeps_distance_monotonic(db):
+    t = list(range(8))
+    d = [0.0, 400.0, 800.0, 700.0, 1200.0, 1600.0, 2000.0, 2400.0]  # GPS step back at t=3
+    assert db.fastest_segments(t, d, [("1k", 1000.0)])["1k"][0] == pytest.approx(2.5)
+    assert db.fastest_segments([0], [0.0]) == {}
+
+
+def records(db, athlete_id):
+    with db.get_db() as conn:
+        return {(r["sport"], r["effort"], r["scope"]): (r["seconds"], r["activity_id"])
+                for r in conn.execute("SELECT * FROM personal_records WHERE athlete_id=?", (athlete_id,))}
+
+
+def test_record_best_efforts_updates_and_rederives_records(db):
+    db.save_activity(1, activity(10, "2023-05-01"))
+    db.save_activity(1, activity(11, "2024-05-01"))
+    db.record_best_efforts(1, 10, {"5k": {"seconds": 1300.0, "start_s": 0}})
+    db.record_best_efforts(1, 11, {"5k": {"seconds": 1250.0, "start_s": 0}})
+    recs = records(db, 1)
+    assert recs[("Run", "5k", "all")] == (1250.0, 11)
+    assert recs[("Run", "5k", "2023")] == (1300.0, 10)
+    assert recs[("Run", "5k", "2024")] == (1250.0, 11)
+
+    db.record_best_efforts(1, 11, {"5k": {"seconds": 1400.0, "start_s": 0}})  # recomputed slower
+    recs = records(db, 1)
+    assert recs[("Run", "5k", "all")] == (1300.0, 10)
+    assert recs[("Run", "5k", "2024")] == (1400.0, 11)
+
+    db.record_best_efforts(1, 11, {})  # lost the effort entirely
+    assert ("Run", "5k", "2024") not in records(db, 1)
+
+
+def test_rekey_moves_efforts_to_the_activity_sport(db):
+    db.record_best_efforts(1, 20, {"1k": {"seconds": 200.0, "start_s": 5}})  # no summary yet
+    assert records(db, 1)[("Other", "1k", "all")] == (200.0, 20)
+    db.sync_activity_summaries(1, [activity(20, "2024-03-02")])
+    recs = records(db, 1)
+    assert ("Other", "1k", "all") not in recs
+    assert recs[("Run", "1k", "all")] == (200.0, 20)
+    assert recs[("Run", "1k", "2024")] == (200.0, 20)
+
+    db.sync_activity_summaries(1, [activity(20, "2024-03-02", sport="Ride")])
+    recs = records(db, 1)
+    assert ("Run", "1k", "all") not in recs
+    assert recs[("Ride", "1k", "all")] == (200.0, 20)
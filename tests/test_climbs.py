@@ -0,0 +1,55 @@
+def profile():
+    """10 m samples: 2 km flat, 3 km at 6 %, 2 km descent, 1 km flat."""
+    d, alt, t = [], [], []
+    x, h = 0.0, 100.0
+    for km, grade in ((2, 0.0), (3, 6.0), (2, -5.0), (1, 0.0)):
+        for _ in range(km * 100):
+            d.append(x)
+            alt.append(h)
+            t.append(x / 5.0)
+            x += 10.0
+            h += grade / 10.0
+    return {"distance": d, "altitude": alt, "time": t,
+            "lat": [45.0 + i * 1e-5 for i in range(len(d))], "lng": [6.0] * len(d)}
+
+
+def test_detect_climbs_finds_the_climb(db):
+    streams = profile()
+    climbs = db.detect_climbs(streams)
+    assert len(climbs) == 1
+    c = climbs[0]
+    assert 1800 <= c["start_dist"] <= 2400
+    assert 2500 <= c["length_m"] <= 3200
+    assert 150 <= c["gain_m"] <= 185
+    assert 5.0 <= c["avg_grade"] <= 6.5
+    assert c["max_grade"] >= c["avg_grade"]
+    assert c["duration_s"] == c["length_m"] / 5.0
+    assert c["category"] == "3"  # score = length × grade ≈ 17 000
+    assert c["start_lat"] < c["end_lat"]
+
+
+def test_detect_climbs_flat_or_short(db):
+    assert db.detect_climbs({"distance": [0, 10, 20], "altitude": [1, 2, 3]}) == []
+    flat = profile()
+    flat["altitude"] = [100.0] * len(flat["distance"])
+    assert db.detect_climbs(flat) == []
+
+
+def test_max_grade_ignores_a_grade_stream_that_misses_the_climb(db):
+    streams = profile()
+    n = len(streams["distance"])
+    streams["grade_smooth"] = [25.0] * 150 + [None] * (n - 150)  # only covers the first 1.5 km
+    c = db.detect_climbs(streams)[0]
+    assert c["max_grade"] < 10  # from altitude, not the clamped 25 % grade samples
+
+    streams["grade_smooth"] = [6.0] * n
+    assert db.detect_climbs(streams)[0]["max_grade"] == 6.0
+
+
+def test_record_and_rekey_climbs(db):
+    db.record_climbs(1, 30, db.detect_climbs(profile()))
+    with db.get_db() as conn:
+        assert conn.execute("SELECT sport, day FROM climbs WHERE activity_id=30").fetchone()[:] == ("Other", None)
+    db.sync_activity_summaries(1, [{"id": 30, "sport_type": "Ride", "start_date_local": "2024-06-01T09:00:00Z"}])
+    with db.get_db() as conn:
+        assert conn.execute("SELECT sport, day FROM climbs WHERE activity_id=30").fetchone()[:] == ("Ride", "2024-06-01")
@@ -0,0 +1,53 @@
+from conftest import activity
+
+
+def curves(db, athlete_id):
+    with db.get_db() as conn:
+        return {r["year"]: tuple(bytes(r[f]) for f in db.PROGRESS_FIELDS)
+                for r in conn.execute("SELECT * FROM progress_curves WHERE athlete_id=?", (athlete_id,))}
+
+
+def assert_matches_full_build(db, athlete_id):
+    incremental = curves(db, athlete_id)
+    db.rebuild_progress(athlete_id)
+    assert curves(db, athlete_id) == incremental
+
+
+def test_nothing_stored_before_first_read(db):
+    db.sync_activity_summaries(1, [activity(1, "2024-01-10")])
+    assert db.update_progress_day(1, "2024-01-10") is None
+    assert curves(db, 1) == {}
+    at = db.progress_at(1, "2024-12-31")  # first read builds every year
+    assert at[2024]["distance"] == 10000.0
+
+
+def test_in_place_updates_match_full_build(db):
+    db.sync_activity_summaries(1, [activity(1, "2023-03-01"), activity(2, "2024-01-10")])
+    db.progress_at(1, "2024-01-01")
+    db.sync_activity_summaries(1, [activity(3, "2024-02-29", distance=5000.0), activity(4, "2024-01-10")])
+    at = db.progress_at(1, "2024-03-01")
+    assert at[2024]["distance"] == 25000.0
+    assert at[2023]["distance"] == 10000.0
+    assert db.progress_at(1, "2024-01-09")[2024]["distance"] == 0.0
+    assert_matches_full_build(db, 1)
+
+
+def test_new_year_after_first_build(db):
+    db.sync_activity_summaries(1, [activity(1, "2023-03-01")])
+    db.progress_at(1, "2023-03-01")
+    db.sync_activity_summaries(1, [activity(2, "2025-07-01", elevation=300.0)])
+    assert db.progress_at(1, "2025-12-31")[2025]["elevation"] == 300.0
+    assert_matches_full_build(db, 1)
+
+
+def test_moved_activity_leaves_its_old_day(db):
+    db.sync_activity_summaries(1, [activity(1, "2024-05-10"), activity(2, "2024-05-20")])
+    db.progress_at(1, "2024-05-10")
+    db.sync_activity_summaries(1, [activity(1, "2024-06-10")])
+    assert db.progress_at(1, "2024-05-31")[2024]["distance"] == 10000.0
+    assert db.progress_at(1, "2024-06-10")[2024]["distance"] == 20000.0
+
+    db.sync_activity_summaries(1, [activity(2, "2023-12-31")])  # and across a year boundary
+    assert db.progress_at(1, "2024-12-31")[2024]["distance"] == 10000.0
+    assert db.progress_at(1, "2024-12-31")[2023]["distance"] == 10000.0
+    assert_matches_full_build(db, 1)
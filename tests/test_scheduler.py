@@ -0,0 +1,32 @@
+import json
+
+
+def lease(db):
+    return json.loads(db.meta_get("scheduler_lease"))
+
+
+def test_only_one_owner_holds_the_lease(db):
+    assert db.acquire_lease("a", ttl=60)
+    assert not db.acquire_lease("b", ttl=60)
+    assert db.acquire_lease("a", ttl=60)  # renewal
+    assert lease(db)["owner"] == "a"
+
+
+def test_lease_fails_over_when_it_expires(db, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(db.time, "time", lambda: now[0])
+    assert db.acquire_lease("a", ttl=60)
+    now[0] += 59
+    assert not db.acquire_lease("b", ttl=60)
+    now[0] += 2
+    assert db.acquire_lease("b", ttl=60)
+    assert not db.acquire_lease("a", ttl=60)  # the old owner doesn't take it back
+    assert lease(db) == {"owner": "b", "expires": 1121.0, "since": 1061.0}
+
+
+def test_release_only_drops_own_lease(db):
+    assert db.acquire_lease("a", ttl=60)
+    db.release_lease("b")
+    assert not db.acquire_lease("b", ttl=60)
+    db.release_lease("a")
+    assert db.acquire_lease("b", ttl=60)